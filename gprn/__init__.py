@@ -10,6 +10,7 @@ from gprn import meanFunction
 
 #mean-field inference
 from gprn import simpleMeanField, completeMeanField, completeMeanField2
+from gprn import sparseMeanField
 
 #useful functions
 from gprn import utils
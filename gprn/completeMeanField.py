@@ -1,8 +1,18 @@
 import numpy as np
-from scipy.linalg import cholesky, LinAlgError
+from scipy.linalg import cho_solve, LinAlgError
 from scipy.stats import multivariate_normal
 from gprn.covFunction import Linear as covL
 from gprn.covFunction import Polynomial as covP
+from gprn.covFunction import Lags
+from gprn.linearAlgebra import LRUCache, SpectralFactor, kernelKey
+from gprn.linearAlgebra import spectralFactors
+from gprn.linearAlgebra import BufferPool
+from gprn.linearAlgebra import SemiseparableFactor, squarem
+from gprn.linearAlgebra import DiagonalCovariance, covarianceDiagonal
+from gprn.linearAlgebra import DenseCovariance
+from gprn.linearAlgebra import posteriors, BlockExecutor
+from gprn.linearAlgebra import cholNugget, CholeskyTelemetry
+from gprn.linearAlgebra import BandedFactor, bandedLags
 np.random.seed(23011990)
 
 class inference(object):
@@ -19,8 +29,44 @@ class inference(object):
     *args: arrays
         The actual data (or components), it needs be given in order of data1, 
         data1error, data2, data2error, etc...
+    storage: str
+        'dense' to keep the full variational covariance matrices, 'diagonal'
+        to keep only their diagonals, log-determinants and traces, which
+        avoids storing q*p*N*N numbers for the weights
+    cacheSize: int
+        Maximum number of kernel matrices and factorizations kept in memory,
+        by default enough for one set of hyperparameters
+    backend: str
+        How the kernel matrices are factorized in the variational updates:
+        'dense' uses their eigendecompositions, 'semiseparable' uses the
+        O(N) semi-separable representations of the kernels (only kernels
+        with an exact one, see covFunction.semiseparable()), 'banded' uses
+        the banded matrices of the kernels with compact support (see
+        covFunction.support()) and 'auto' uses the semi-separable or banded
+        ones when every kernel of the model has one of them and there are at
+        least semiseparableSize observations. All of them give the same
+        ELBO up to round-off
+    workers: int
+        Number of threads evaluating the independent blocks of the nodes and
+        weights concurrently, see linearAlgebra.BlockExecutor. Default: None,
+        one block after the other
+    precision: str
+        'double' to compute everything in float64, 'single' to keep the
+        kernel matrices and the lags in float32 and to compute the
+        variational updates in float32: the factors L of the kernel matrices,
+        the Cholesky factorizations and triangular solves of every update and
+        the full variational covariances, which halves their memory. The
+        eigendecomposition of each kernel matrix, done once per set of
+        hyperparameters, the log-determinants and the sums of the ELBO stay
+        in float64, as do the semi-separable and banded backends
     """ 
-    def  __init__(self, num_nodes, time, *args):
+    #number of observations from which backend='auto' may choose the
+    #semi-separable factorizations
+    semiseparableSize = 500
+    
+    def  __init__(self, num_nodes, time, *args, storage='dense',
+                  cacheSize=None, backend='auto', workers=None,
+                  precision='double'):
         #number of node functions; f(x) in Wilson et al. (2012)
         self.num_nodes = num_nodes
         self.q = num_nodes
@@ -49,6 +95,40 @@ class inference(object):
         self.y = np.array(ys).reshape(self.p, self.N) #matrix p*N of outputs
         self.yerr = np.array(yerrs).reshape(self.p, self.N) #matrix p*N of errors
         self.yerr2 = self.yerr**2
+        #precision of the kernel matrices and the variational covariances
+        assert precision in ('double', 'single'), \
+        "precision should be 'double' or 'single'"
+        self.precision = precision
+        self.dtype = np.float32 if precision == 'single' else float
+        #lags between the observations and the distance features built
+        #from them, shared by every kernel evaluated on self.time
+        self._lags = Lags((time[:, None] - time[None, :]).astype(self.dtype))
+        #on times symmetric about their midpoint, e.g. evenly spaced ones
+        #where they are symmetric Toeplitz, the matrices of the stationary
+        #kernels are centrosymmetric and decomposed as two halves
+        self._centrosymmetric = np.allclose(time + time[::-1],
+                                            time[0] + time[-1], rtol=0,
+                                            atol=1e-12 * np.ptp(time))
+        #how the variational covariances are stored
+        assert storage in ('dense', 'diagonal'), \
+        "storage should be 'dense' or 'diagonal'"
+        self.storage = storage
+        #kernel matrices and their factorizations, the matrices of each node
+        #and weight, their Cholesky factors and eigendecompositions
+        if cacheSize is None:
+            cacheSize = 3 * self.q * (self.p + 1)
+        self._cache = LRUCache(cacheSize, discard=self._discard)
+        #work arrays for the kernel matrices of the nodes and weights, the
+        #matrices dropped by the cache are used again for new hyperparameters
+        self._pool = BufferPool(self.q * (self.p + 1) + 2)
+        assert backend in ('auto', 'dense', 'semiseparable', 'banded'), \
+        "backend should be 'auto', 'dense', 'semiseparable' or 'banded'"
+        self.backend = backend
+        #evaluation of the independent nodes and weights
+        self._executor = BlockExecutor(workers)
+        #how often the Cholesky factorizations needed a nugget, and the
+        #eigendecompositions raised eigenvalues to their floor
+        self.telemetry = CholeskyTelemetry()
         #check if the input was correct
         assert int((i+1)/2) == self.p, \
         'Given data and number of components dont match'
@@ -88,30 +168,70 @@ class inference(object):
     
     
 ##### To create matrices and samples ###########################################
-    def _kernelMatrix(self, kernel, time = None):
+    def _kernelMatrix(self, kernel, time = None, dtype = None):
         """
         Returns the covariance matrix created by evaluating a given kernel 
         at inputs time
         
         Parameters
         ----------
+        dtype: data-type
+            Type of the matrix, by default self.dtype. Matrices of another
+            type, e.g. the float64 ones factorized in single precision, are
+            not cached
         
         Returns
         -------
         K: array
             Matrix of a covariance function
         """
-        r = time[:, None] - time[None, :]
+        if dtype is None:
+            dtype = self.dtype
+        cache = dtype == self.dtype
+        key = ('K', kernelKey(kernel), id(time))
+        cached = self._cache.get(key) if cache else None
+        if cached is not None:
+            return cached[1]
+        if time is self.time and cache:
+            r = self._lags
+        else:
+            r = Lags(time[:, None] - time[None, :])
         
         #to deal with the non-stationary kernels problem
         if isinstance(kernel, (covL, covP)):
-            K = kernel(None, time[:, None], time[None, :])
+            K = np.asarray(kernel(None, time[:, None], time[None, :]), dtype)
         else:
-            K = kernel(r) + 1e-6*np.diag(np.diag(np.ones_like(r)))
-        K[np.abs(K)<1e-12] = 0.
+            out = self._pool.take(r.shape, dtype) if cache else None
+            K = kernel.compile()(r, out=out, pool=self._pool)
+            K.flat[::time.size+1] += 1e-6
+        self._threshold(K, 1e-12)
+        if not cache:
+            return K
+        #cached matrices are shared, so they should not be changed in place;
+        #the time array is kept too so that its id is not reused
+        K.flags.writeable = False
+        self._cache[key] = (time, K)
         return K
     
     
+    def _discard(self, key, value):
+        """
+        Gives the kernel matrices dropped by the cache back to the pool of
+        work arrays, see linearAlgebra.LRUCache
+        """
+        if key[0] == 'K':
+            self._pool.release(value[1])
+    
+    
+    def _threshold(self, K, tol):
+        """
+        Sets to zero, in place, the entries of a kernel matrix below tol
+        """
+        work = self._pool.take(K.shape, K.dtype)
+        K[np.abs(K, out=work)<tol] = 0.
+        self._pool.release(work, now=True)
+    
+    
     def _predictKMatrix(self, kernel, time):
         """
         To be used in predict_gp()
@@ -124,14 +244,15 @@ class inference(object):
         K: array
             Matrix of a covariance function
         """
+        time = np.atleast_1d(time)
         if isinstance(kernel, (covL, covP)):
-            K = kernel(None, time, self.time[None, :])
+            K = kernel(None, time[:, None], self.time[None, :])
         else:
-            if time.size == 1:
-                r = time - self.time[None, :]
-            else:
-                r = time[:,None] - self.time[None,:]
-            K = kernel(r) 
+            r = time[:, None] - self.time[None, :]
+            #white noise never enters a cross-covariance, even when there
+            #are as many times as observations and r is square
+            cross = np.zeros(r.shape, dtype=bool)
+            K = kernel.compile()(Lags(r, diagonal=cross))
         return K
     
     
@@ -156,10 +277,29 @@ class inference(object):
         return f, w
     
     
+    def _weightBlocks(self):
+        """
+        Returns the indices j of the node and i of the output of each weight,
+        with the weights of each node together, as they are added in the
+        expected log prior and the entropy
+        
+        Returns
+        -------
+        j: list
+            Node of each weight
+        i: list
+            Output of each weight
+        """
+        j = [j for j in range(self.q) for _ in range(self.p)]
+        i = [i for _ in range(self.q) for i in range(self.p)]
+        return j, i
+    
+    
     def _cholNugget(self, matrix, maximum=10):
         """
         Returns the cholesky decomposition to a given matrix, if it is not
-        positive definite, a nugget is added to its diagonal.
+        positive definite, a nugget is added to its diagonal. The
+        factorization is recorded in self.telemetry.
         
         Parameters
         ----------
@@ -173,29 +313,199 @@ class inference(object):
         L: array
             Matrix containing the Cholesky factor
         nugget: float
-            Nugget added to the diagonal
-        """
-        nugget = 0 #our nugget starts as zero
-        try:
-            nugget += np.abs(np.diag(matrix).mean()) * 1e-5
-            L = cholesky(matrix, lower=True, overwrite_a=True)
-            return L, nugget
-        except LinAlgError:
-            #print('NUGGET ADDED TO DIAGONAL!')
-            n = 0 #number of tries
-            while n < maximum:
-                #print ('n:', n+1, ', nugget:', nugget)
-                try:
-                    L = cholesky(matrix + nugget*np.identity(matrix.shape[0]),
-                                 lower=True, overwrite_a=True)
-                    return L, nugget
-                except LinAlgError:
-                    nugget *= 10.0
-                finally:
-                    n += 1
-            raise LinAlgError("Not positive definite, even with nugget.")
+            Nugget added to the diagonal, 0 if none was needed
+        """
+        #in single precision the factorization is still done in float64
+        return cholNugget(np.asarray(matrix, float), maximum, self.telemetry)
             
             
+    def _kernelCholesky(self, kernel):
+        """
+        Returns the Cholesky factor of the kernel matrix of a given kernel, 
+        computed with _cholNugget() and cached on the kernel parameters
+        
+        Parameters
+        ----------
+        kernel: covFunction
+            Covariance function
+        
+        Returns
+        -------
+        L: array
+            Lower triangular Cholesky factor
+        """
+        key = ('L', kernelKey(kernel), id(self.time))
+        L = self._cache.get(key)
+        if L is None:
+            L = self._cholNugget(self._kernelMatrix(kernel, self.time,
+                                                    float))[0]
+            L.flags.writeable = False
+            self._cache[key] = L
+        return L
+    
+    
+    def _spectralFactor(self, kernel):
+        """
+        Returns the eigendecomposition of the kernel matrix of a given kernel.
+        It only depends on the kernel parameters, so it is computed once and
+        reused in all iterations of ELBOcalc().
+        
+        Parameters
+        ----------
+        kernel: covFunction
+            Covariance function
+        
+        Returns
+        -------
+        factor: SpectralFactor
+            Eigendecomposition of the kernel matrix
+        """
+        key = ('spectral', kernelKey(kernel), id(self.time))
+        factor = self._cache.get(key)
+        if factor is None:
+            centrosymmetric = self._centrosymmetric \
+                and not isinstance(kernel, (covL, covP))
+            #the matrix is decomposed in float64 in single precision too,
+            #only the factor used by the updates is kept in self.dtype
+            K = self._kernelMatrix(kernel, self.time, float)
+            factor = SpectralFactor(K, centrosymmetric=centrosymmetric,
+                                    dtype=self.dtype,
+                                    telemetry=self.telemetry)
+            self._cache[key] = factor
+        return factor
+    
+    
+    def _semiseparable(self, kernels):
+        """
+        Returns True if the kernel matrices of a model are to be factorized
+        with their semi-separable or banded representations, see the backend
+        argument
+    
+        Parameters
+        ----------
+        kernels: list
+            Covariance functions of the nodes and weights
+    
+        Returns
+        -------
+        semiseparable: bool
+            True to use SemiseparableFactor or BandedFactor, False to use
+            SpectralFactor
+        """
+        if self.backend == 'dense':
+            return False
+        if self.backend == 'banded':
+            for kernel in kernels:
+                if not np.isfinite(kernel.support()):
+                    raise ValueError('{0} has no compact '
+                                     'support'.format(kernel))
+            return True
+        if self.backend == 'semiseparable':
+            for kernel in kernels:
+                if kernel.semiseparable() is None:
+                    raise ValueError('{0} has no semi-separable '
+                                     'representation'.format(kernel))
+            return True
+        return self.N >= self.semiseparableSize \
+            and all(kernel.semiseparable() is not None
+                    or np.isfinite(kernel.support()) for kernel in kernels)
+    
+    
+    def _bandedFactor(self, kernel):
+        """
+        Returns the banded factorization of the kernel matrix of a kernel
+        with compact support, built from the kernel evaluated only inside its
+        support, or its eigendecomposition if the banded matrix is not
+        numerically positive definite
+    
+        Parameters
+        ----------
+        kernel: covFunction
+            Covariance function
+    
+        Returns
+        -------
+        factor: BandedFactor or SpectralFactor
+            Factorization of the kernel matrix
+        """
+        key = ('banded', kernelKey(kernel), id(self.time))
+        factor = self._cache.get(key)
+        if factor is None:
+            order, lags, valid = bandedLags(self.time, kernel.support())
+            #the first row of the band has the lags of each time with itself
+            diagonal = np.zeros(lags.shape, dtype=bool)
+            diagonal[0] = True
+            band = kernel.compile()(Lags(lags, diagonal=diagonal))
+            band[~valid] = 0.
+            band[np.abs(band)<1e-15] = 0.
+            #the same jitter as the semi-separable factorizations
+            band[0] += 1e-6
+            try:
+                factor = BandedFactor(order, band)
+            except LinAlgError:
+                factor = self._spectralFactor(kernel)
+            self._cache[key] = factor
+        return factor
+    
+    
+    def _kernelFactor(self, kernel, semiseparable=False):
+        """
+        Returns the factorization of the kernel matrix of a given kernel used
+        by the variational updates, BandedFactor or SemiseparableFactor if
+        semiseparable is True, for kernels with and without compact support,
+        and the kernel matrix is numerically positive definite, and
+        SpectralFactor otherwise
+    
+        Parameters
+        ----------
+        kernel: covFunction
+            Covariance function
+        semiseparable: bool
+            True to use the semi-separable or banded representation of the
+            kernel
+    
+        Returns
+        -------
+        factor: BandedFactor, SemiseparableFactor or SpectralFactor
+            Factorization of the kernel matrix
+        """
+        if not semiseparable:
+            return self._spectralFactor(kernel)
+        if self.backend != 'semiseparable' and np.isfinite(kernel.support()):
+            return self._bandedFactor(kernel)
+        key = ('semiseparable', kernelKey(kernel), id(self.time))
+        factor = self._cache.get(key)
+        if factor is None:
+            U, V, transition, white = kernel.semiseparable()
+            try:
+                factor = SemiseparableFactor(self.time, U, V, transition,
+                                             white + 1e-6)
+            except LinAlgError:
+                factor = self._spectralFactor(kernel)
+            self._cache[key] = factor
+        return factor
+    
+    
+    def _kernelGradient(self, kernel):
+        """
+        Returns the derivatives of the kernel matrix of a given kernel with
+        respect to each of its parameters, see covFunction.gradient()
+    
+        Parameters
+        ----------
+        kernel: covFunction
+            Covariance function
+    
+        Returns
+        -------
+        dK: array
+            Derivatives of the kernel matrix, shape (npars, N, N)
+        """
+        if isinstance(kernel, (covL, covP)):
+            return kernel.gradient(None, self.time[:, None], self.time[None, :])
+        return kernel.gradient(self._lags)
+    
+    
     def _CBMatrix(self, nodes, weight):
         """
         Creates the matrix CB (eq. 5 from Wilson et al. 2012), that will be 
@@ -274,7 +584,7 @@ class inference(object):
     
 ##### Mean-Field Inference functions ##########################################
     def ELBOcalc(self, nodes, weight, mean, jitter, iterations = 10000,
-                     mu = None, var = None):
+                     mu = None, var = None, accelerate = False):
         """
         Function to use in the the sampling of the GPRN
         
@@ -294,6 +604,9 @@ class inference(object):
             Variational means
         var: array
             Variational variances
+        accelerate: bool
+            True to extrapolate the iterations with squarem(), each iteration
+            then takes up to three updates of the variational parameters
             
         Returns
         -------
@@ -311,19 +624,27 @@ class inference(object):
             mu = np.random.randn(D, 1)
             var = np.random.rand(D, 1)
         varF, varW = self._u_to_fhatW(var.flatten())
-        sigF, sigW = [], []
-        for q in range(self.q):
-            sigF.append(np.diag(varF[0, q, :]))
-            for p in range(self.p):
-                sigW.append(np.diag(varW[p, q, :]))
+        #the starting covariances are diagonal, only their diagonals are
+        #kept as ELBO() works them out again from mu and var
+        sigF, sigW = varF[0], varW
+        #one update of the variational parameters, for squarem()
+        def step(state):
+            ELBO, mu, var, _, _ = self.ELBOaux(nodes, weight, mean, jitter,
+                                               state[0], state[1], sigF, sigW)
+            return ELBO, [mu, var]
+        positive = lambda state: np.all(state[1] > 0)
         elboArray = np.array([-1e15]) #To add new elbo values inside
         iterNumber = 0
         while iterNumber < iterations:
             #Ou calcular media de 10 elbos ou 
             
             #Optimize mu and var analytically
-            ELBO, mu, var, sigF, sigW= self.ELBOaux(nodes, weight, mean, jitter, 
-                                                       mu, var, sigF, sigW)
+            if accelerate:
+                ELBO, (mu, var) = squarem(step, [mu, var], positive)
+            else:
+                ELBO, mu, var, sigF, sigW= self.ELBOaux(nodes, weight, mean,
+                                                        jitter, mu, var,
+                                                        sigF, sigW)
             elboArray = np.append(elboArray, ELBO)
             iterNumber += 1
             #Stoping criteria:
@@ -364,6 +685,8 @@ class inference(object):
         new_var: array
             New variational variances
         """ 
+        #kernel matrices released by the last evaluation are used again
+        self._pool.recycle()
         #to separate the variational parameters between the nodes and weights
         muF, muW = self._u_to_fhatW(mu.flatten())
         varF, varW = self._u_to_fhatW(var.flatten())
@@ -372,19 +695,12 @@ class inference(object):
                                                        muW, varW)
         #new mean for the nodes
         muF = muF.reshape(1, self.q, self.N)
-        varF =  []
-        for i in range(self.q):
-            varF.append(np.diag(sigmaF[i]))
         #new variance for the nodes
-        varF = np.array(varF).reshape(1, self.q, self.N)
+        varF = covarianceDiagonal(sigmaF).reshape(1, self.q, self.N)
         #new mean for the weights
         muW = muW.reshape(self.p, self.q, self.N)
-        varW =  []
-        for j in range(self.q):
-            for i in range(self.p):
-                varW.append(np.diag(sigmaW[j, i, :]))
         #new variance for the weights
-        varW = np.array(varW).reshape(self.p, self.q, self.N)
+        varW = covarianceDiagonal(sigmaW).reshape(self.p, self.q, self.N)
         new_mu = np.concatenate((muF, muW))
         new_var = np.concatenate((varF, varW))
         #Entropy
@@ -400,6 +716,148 @@ class inference(object):
         return ELBO, new_mu, new_var, sigmaF, sigmaW
     
     
+    def ELBObatch(self, nodes, weight, mean, jitter, pars, mu, var):
+        """
+        Evidence lower bound of an ensemble of hyperparameters, e.g. all the
+        walkers of emcee, as used by run_sampler(vectorize=True). The kernel
+        matrices of every member are built in one vectorized pass per kernel
+        and, with the spectral backend, eigendecomposed in one stacked call
+        per kernel. The variational updates and the ELBO of each member are
+        still computed one member after the other, as in ELBOaux()
+    
+        Parameters
+        ----------
+        nodes: array
+            Node functions, only their types are used
+        weight: array
+            Weight functions, only their types are used
+        mean: array
+            Mean functions
+        jitter: array
+            Jitter terms
+        pars: array
+            Parameters of the nodes followed by those of the weights, one row
+            per member, shape (B, npars)
+        mu: array
+            Variational means
+        var: array
+            Variational variances
+    
+        Returns
+        -------
+        ELBO: array
+            Evidence lower bound of each member, shape (B,)
+        """
+        kernels = list(nodes) + list(weight)
+        pars = np.atleast_2d(pars)
+        sizes = np.cumsum([kernel.pars.size for kernel in kernels])[:-1]
+        pars = np.split(pars, sizes, axis=1)
+        #kernel matrices of all members, shape (B, N, N) for each kernel,
+        #in float64 in single precision too as they are factorized
+        lags = self._lags
+        if self.dtype != float:
+            lags = Lags(self.time[:, None] - self.time[None, :])
+        matrices = []
+        for kernel, kpars in zip(kernels, pars):
+            if isinstance(kernel, (covL, covP)):
+                K = kernel.batch(kpars, None, self.time[:, None],
+                                 self.time[None, :])
+            else:
+                K = kernel.batch(kpars, lags) + 1e-6*np.identity(self.N)
+            K[np.abs(K)<1e-12] = 0.
+            matrices.append(K)
+        #with the spectral backend the matrices of all members are
+        #eigendecomposed together, in one stacked call per kernel
+        factors = [None] * len(kernels)
+        if not self._semiseparable(kernels):
+            factors = []
+            for kernel, K in zip(kernels, matrices):
+                centrosymmetric = self._centrosymmetric \
+                    and not isinstance(kernel, (covL, covP))
+                factors.append(spectralFactors(K, None, centrosymmetric,
+                                               self.dtype, self.telemetry))
+        ELBO = np.zeros(pars[0].shape[0])
+        for b in range(ELBO.size):
+            member = [kernel._new(kpars[b])
+                      for kernel, kpars in zip(kernels, pars)]
+            #the matrices and their factors go into the cache, where
+            #_kernelMatrix() and _spectralFactor() find them
+            for kernel, K, F in zip(member, matrices, factors):
+                Kb = K[b].astype(self.dtype)
+                Kb.flags.writeable = False
+                key = ('K', kernelKey(kernel), id(self.time))
+                self._cache[key] = (self.time, Kb)
+                if F is not None:
+                    key = ('spectral', kernelKey(kernel), id(self.time))
+                    self._cache[key] = F[b]
+            memberNodes = member[:len(nodes)]
+            memberWeight = member[len(nodes):]
+            ELBO[b] = self.ELBOaux(memberNodes, memberWeight, mean, jitter,
+                                   mu, var, None, None)[0]
+        return ELBO
+    
+    
+    def ELBOgradient(self, nodes, weight, mean, jitter, mu, sigmaF, sigmaW):
+        """
+        Evidence lower bound and its gradient with respect to the parameters
+        of the nodes and weights, for a fixed variational distribution as
+        returned by ELBOaux(). This is the objective of the hyperparameters
+        step of variational EM, alternated with the updates of ELBOaux(), and
+        it can be maximized with gradient-based optimizers such as L-BFGS.
+    
+        Parameters
+        ----------
+        nodes: array
+            Node functions
+        weight: array
+            Weight functions
+        mean: array
+            Mean functions
+        jitter: array
+            Jitter terms
+        mu: array
+            Variational means
+        sigmaF: array
+            Variational covariance for each node
+        sigmaW: array
+            Variational covariance for each weight
+    
+        Returns
+        -------
+        ELBO: float
+            Evidence lower bound
+        gradient: array
+            Derivatives of the ELBO, parameters of the nodes followed by those
+            of the weights as in ELBObatch()
+        """
+        #kernel matrices released by the last evaluation are used again
+        self._pool.recycle()
+        assert isinstance(sigmaF, DenseCovariance) \
+            or not isinstance(sigmaF, DiagonalCovariance), \
+        'ELBOgradient() needs the dense variational covariances'
+        #the traces kept with the covariances are only valid for the kernels
+        #that built them
+        sigmaF, sigmaW = np.asarray(sigmaF), np.asarray(sigmaW)
+        muF, muW = self._u_to_fhatW(mu.flatten())
+        Entropy = self._entropy(sigmaF, sigmaW)
+        ExpLogPrior = self._expectedLogPrior(nodes, weight,
+                                             sigmaF, muF, sigmaW, muW)
+        ExpLogLike = self._expectedLogLike(nodes, weight, mean, jitter,
+                                           sigmaF, muF, sigmaW, muW)
+        ELBO = ExpLogLike + ExpLogPrior + Entropy
+        #only the expected log prior depends on the kernels parameters
+        stats = self._priorStatistics(nodes, weight, sigmaF, muF, sigmaW, muW)
+        gradient = []
+        for kernel, (c, M) in zip(list(nodes) + list(weight), stats):
+            L = self._kernelCholesky(kernel)
+            Kinv = cho_solve((L, True), np.identity(self.N))
+            #d(-0.5*(c*log|K| + tr(K^-1 M))) = 0.5*tr(A dK)
+            A = Kinv @ M @ Kinv - c*Kinv
+            dK = self._kernelGradient(kernel)
+            gradient.append(0.5 * np.einsum('ij,kij->k', A, dK))
+        return ELBO, np.concatenate(gradient)
+    
+    
     def Prediction(self, node, weights, means, tstar, mu):
         """
         Prediction for mean-field inference
@@ -422,39 +880,26 @@ class inference(object):
         final_ystar: array
             Predicted means
         """
-        Kf = np.array([self._kernelMatrix(i, self.time) for i in node])
-        Lf = np.array([self._cholNugget(i)[0] for i in Kf])
-        Kw = np.array([self._kernelMatrix(j, self.time) for j in weights])
-        Lw = np.array([self._cholNugget(j)[0] for j in Kw])
-        Kw = Kw.reshape(self.p, self.q, self.N, self.N)
+        Lf = np.array([self._kernelCholesky(i) for i in node])
+        Lw = np.array([self._kernelCholesky(j) for j in weights])
         Lw = Lw.reshape(self.p, self.q, self.N, self.N)
         #mean functions
         means = self._mean(means, tstar)
         means = np.array_split(means, self.p)
         muF, muW = self._u_to_fhatW(mu.flatten())
-        ystar = np.zeros((self.p, tstar.size))
-        for i in range(tstar.size):
-            Kfstar = np.array([self._predictKMatrix(i1, tstar[i]) for i1 in node])
-            Kwstar = np.array([self._predictKMatrix(i2, tstar[i]) for i2 in weights])
-            Kwstar = Kwstar.reshape(self.p, self.q, self.N)
-            #Lwstar = np.linalg.solve(np.squeeze(Lw), np.squeeze(Kwstar).T)
-            countF, countW = 1, 1
-            Wstar, fstar = np.zeros((self.p, self.q)), np.zeros((self.q, 1))
-            for q in range(self.q):
-                Lfstar = np.linalg.solve(np.squeeze(Lf[q,:,:]), 
-                                         np.squeeze(Kfstar[q,:]).T)
-                fstar[q] = Lfstar @ np.linalg.solve(np.squeeze(Lf[q,:,:]), 
-                                                     muF[:,q,:].T)
-                countF += self.N
-                for p in range(self.p):
-                    Wstar[p,q] = np.linalg.solve(Lw[p,q,:,:],Kwstar[p,q,:].T)\
-                                     @ np.linalg.solve(Lw[p,q,:,:], muW[p,q].T)
-                    countW += self.N
-            ystar[:,i] = ystar[:, i] + np.squeeze(Wstar @ fstar)
-        final_ystar = []
-        for i in range(self.p):
-            final_ystar.append(ystar[i] + means[i])
-        final_ystar = np.array(final_ystar)
+        #K^-1 mu of the nodes and weights, they do not depend on tstar
+        alphaF = np.array([cho_solve((Lf[q], True), muF[0,q])
+                           for q in range(self.q)])
+        alphaW = np.array([[cho_solve((Lw[p,q], True), muW[p,q])
+                            for q in range(self.q)] for p in range(self.p)])
+        #means of the nodes and weights at all tstar, shapes (q, T), (p, q, T)
+        fstar = np.array([self._predictKMatrix(node[q], tstar) @ alphaF[q]
+                          for q in range(self.q)])
+        Kwstar = np.array([self._predictKMatrix(j, tstar) for j in weights])
+        Kwstar = Kwstar.reshape(self.p, self.q, -1, self.N)
+        Wstar = np.einsum('pqtn,pqn->pqt', Kwstar, alphaW)
+        final_ystar = np.einsum('pqt,qt->pt', Wstar, fstar) \
+                        + np.array(means).reshape(self.p, -1)
         return final_ystar
     
     
@@ -484,11 +929,11 @@ class inference(object):
             
         Returns
         -------
-        sigma_f: array
+        sigma_f: DenseCovariance or DiagonalCovariance
             Updated variational covariance of each node
         mu_f: array
             Updated variational mean of each node
-        sigma_w: array
+        sigma_w: DenseCovariance or DiagonalCovariance
             Updated variational covariance of each weight
         mu_w: array
             Updated variational mean of each weight
@@ -496,55 +941,88 @@ class inference(object):
         new_y = np.concatenate(self.y) - self._mean(mean)
         new_y = np.array(np.array_split(new_y, self.p))
         jitt2 = np.array(jitter)**2 #jitters
-        #kernel matrix for the nodes
-        Kf = np.array([self._kernelMatrix(i, self.time) for i in nodes])
-        #kernel matrix for the weights
-        Kw = np.array([self._kernelMatrix(j, self.time) for j in weight]) 
-        Kw = Kw.reshape(self.p, self.q, self.N, self.N)
+        #factorizations of the kernel matrices of the nodes
+        semiseparable = self._semiseparable(list(nodes) + list(weight))
+        Ff = [self._kernelFactor(i, semiseparable) for i in nodes]
+        #factorizations of the kernel matrices of the weights
+        Fw = [self._kernelFactor(j, semiseparable) for j in weight]
         #we have Q nodes => j in the paper; we have P y(x)s => i in the paper
-        muF = np.squeeze(muF)
-        sigma_f, mu_f = [], [] #creation of Sigma_fj and mu_fj
+        muF = muF.reshape(self.q, self.N).copy()
+        diagonal = self.storage == 'diagonal'
+        bottom = jitt2[:, None] + self.yerr2
+        #the covariances of all nodes are independent and computed together,
+        #their means use the nodes already updated
+        diagF = np.sum((muW*muW + varW) / bottom[:, None, :], axis=0)
+        run = self._executor.map
+        posts = posteriors(Ff, diagF, run)
+        var_f = run(lambda Sigma: Sigma.variance(), posts)
+        logdet_f = [Sigma.logdet for Sigma in posts]
+        if not diagonal:
+            sigma_f = run(self._covariance, posts)
+        mu_f = [] #creation of mu_fj
         for j in range(self.q):
-            diagFj = np.zeros_like(self.N)
-            auxCalc = np.zeros_like(self.N)
-            for i in range(self.p):
-                diagFj = diagFj + (muW[i,j,:]*muW[i,j,:]+varW[i,j,:])\
-                                            /(jitt2[i] + self.yerr2[i,:])
-                sumNj = np.zeros(self.N)
-                for k in range(self.q):
-                    if k != j:
-                        sumNj += muW[i,k,:]*muF[k,:].reshape(self.N)
-                auxCalc = auxCalc + ((new_y[i,:]-sumNj)*muW[i,j,:]) \
-                                    / (jitt2[i] + self.yerr2[i,:])
-            CovF = np.diag(1 / diagFj) + Kf[j]
-            CovF = Kf[j] - Kf[j] @ np.linalg.solve(CovF, Kf[j])
-            sigma_f.append(CovF)
-            mu_f.append(CovF @ auxCalc)
-            muF = np.array(mu_f)
-        sigma_f = np.array(sigma_f)
+            sumNj = np.einsum('pqn,qn->pn', muW, muF) - muW[:,j,:]*muF[j]
+            auxCalc = np.sum((new_y - sumNj) * muW[:,j,:] / bottom, axis=0)
+            mu_f.append(posts[j].dot(auxCalc))
+            muF[j] = mu_f[j]
         mu_f = np.array(mu_f)
+        #the expected log prior uses tr(Kf_j^-1 (Sigma_f1 + ... + Sigma_fj))
+        trace_f = run(lambda j: np.sum([Ff[j].trace(posts[k])
+                                        for k in range(j+1)]),
+                      range(self.q))
+        if diagonal:
+            sigma_f = DiagonalCovariance(var_f, logdet_f, trace_f)
+        else:
+            sigma_f = DenseCovariance(sigma_f, logdet_f, trace_f)
+        del posts
         sigma_w, mu_w = [], np.zeros_like(muW) #creation of Sigma_wij and mu_wij
+        var_w, logdet_w, trace_w = [], [], []
+        #the covariances of the weights are independent and computed
+        #together, per node if only their diagonals are kept
+        diagW = (mu_f*mu_f + np.array(var_f))[None, :, :] / bottom[:, None, :]
+        if not diagonal:
+            posts = posteriors(Fw, diagW.reshape(-1, self.N), run)
+            sigma_w = run(self._covariance,
+                          [posts[i*self.q + j] for j in range(self.q)
+                           for i in range(self.p)])
         for j in range(self.q):
+            if diagonal:
+                posts_j = posteriors(Fw[j::self.q], diagW[:, j], run)
+            else:
+                posts_j = posts[j::self.q]
+            for var, logdet, trace in run(
+                    lambda Sigma, F: (Sigma.variance(), Sigma.logdet,
+                                      F.trace(Sigma)),
+                    posts_j, Fw[j::self.q]):
+                var_w.append(var)
+                logdet_w.append(logdet)
+                trace_w.append(trace)
+            sumNj = np.einsum('qn,pqn->pn', mu_f, muW) - mu_f[j]*muW[:,j,:]
+            auxCalc = (new_y - sumNj) * mu_f[j] / bottom
             for i in range(self.p):
-                mu_fj = mu_f[j]
-                var_fj = np.diag(sigma_f[j])
-                Diag_ij = (mu_fj*mu_fj+var_fj) /(jitt2[i] + self.yerr2[i,:])
-                Kw_ij = Kw[i,j,:,:]
-                CovWij = np.diag(1 / Diag_ij) + Kw_ij
-                CovWij = Kw_ij - Kw_ij @ np.linalg.solve(CovWij, Kw_ij)
-                sumNj = np.zeros(self.N)
-                for k in range(self.q):
-                    if k != j:
-                        sumNj += mu_f[k].reshape(self.N)*np.array(muW[i,k,:])
-                auxCalc = ((new_y[i,:]-sumNj)*mu_f[j,:]) \
-                                    / (jitt2[i] + self.yerr2[i,:])
-                sigma_w.append(CovWij)
-                muW[i,j,:] = CovWij @ auxCalc
-        sigma_w = np.array(sigma_w).reshape(self.q, self.p, self.N, self.N)
+                muW[i,j,:] = posts_j[i].dot(auxCalc[i])
+        if diagonal:
+            sigma_w = DiagonalCovariance(
+                np.reshape(var_w, (self.q, self.p, self.N)),
+                np.reshape(logdet_w, (self.q, self.p)),
+                np.reshape(trace_w, (self.q, self.p)))
+        else:
+            sigma_w = DenseCovariance(
+                np.reshape(sigma_w, (self.q, self.p, self.N, self.N)),
+                np.reshape(logdet_w, (self.q, self.p)),
+                np.reshape(trace_w, (self.q, self.p)))
         mu_w = np.array(muW)
         return sigma_f, mu_f, sigma_w, mu_w
     
     
+    def _covariance(self, posterior):
+        """
+        Full variational covariance of a posterior of the updates, stored
+        with the precision of the kernel matrices
+        """
+        return posterior.covariance().astype(self.dtype, copy=False)
+    
+    
     def _expectedLogLike(self, nodes, weight, mean, jitter, sigma_f, mu_f,
                          sigma_w, mu_w):
         """
@@ -574,45 +1052,17 @@ class inference(object):
             Expected log-likelihood value
         """
         new_y = np.concatenate(self.y) - self._mean(mean, self.time)
-        new_y = np.array(np.array_split(new_y, self.p)).T #NxP dimensional vector
-        jitt2 = np.array(jitter)**2 #jitters squared
-        ycalc = new_y.T #new_y0.shape = (p,n)
-        logl = 0
-        for p in range(self.p):
-            for n in range(self.N):
-                logl += np.log(jitt2[p] + self.yerr2[p,n])
-        logl = -0.5 * logl
-        #print('1st:',logl)
-        
-        Wcalc, Fcalc, bottom = [], [], []
-        for p in range(self.p):
-            Wcalc.append([])
-            Fcalc.append([])
-            bottom.append([])
-        for n in range(self.N):
-            for q in range(self.q):
-                for p in range(self.p):
-                    ycalc[p,n] = new_y.T[p,n]
-                    Wcalc[p].append(mu_w[p, :, n])
-                    Fcalc[p] = np.append(Fcalc[p],mu_f[0, q, n].T)
-                    bottom[p].append(jitt2[p]+self.yerr2[p,n])
-        Wcalc = np.array(Wcalc)#.reshape(self.p, self.N * self.q)
-        Fcalc = np.array(Fcalc)
-        Ymean = (Fcalc @ Wcalc).reshape(-1)
-        ycalc = ycalc.reshape(-1)
-        bottom = np.array(bottom).reshape(-1)
-        Ydiff = ((ycalc - Ymean).T * (ycalc - Ymean))/bottom
-        #print('2nd:', np.sum(Ydiff))
+        ycalc = np.array(np.array_split(new_y, self.p)) #PxN dimensional vector
+        bottom = np.array(jitter)[:, None]**2 + self.yerr2 #jitters squared
+        logl = -0.5 * np.sum(np.log(bottom))
+        #Ymean[p,n] = sum_q mu_f[q,n]*mu_w[p,q,n]
+        Ymean = np.einsum('qn,pqn->pn', mu_f[0], mu_w)
+        Ydiff = ((ycalc - Ymean) * (ycalc - Ymean))/bottom
         logl += -0.5 * np.sum(Ydiff)
-        
-        value = 0
-        for i in range(self.p):
-            for j in range(self.q):
-                value += np.sum((np.diag(sigma_f[j,:,:])*mu_w[i,j,:]*mu_w[i,j,:] +\
-                                np.diag(sigma_w[j,i,:,:])*mu_f[:,j,:]*mu_f[:,j,:] +\
-                                np.diag(sigma_f[j,:,:])*np.diag(sigma_w[j,i,:,:]))\
-                                /(jitt2[i]+self.yerr2[i,:]))
-        #print('3rd:', value)
+        diagSigmaF = covarianceDiagonal(sigma_f)[None, :, :]
+        diagSigmaW = covarianceDiagonal(sigma_w).transpose(1, 0, 2)
+        value = np.sum((diagSigmaF*mu_w*mu_w + diagSigmaW*mu_f*mu_f \
+                        + diagSigmaF*diagSigmaW) / bottom[:, None, :])
         logl += -0.5* value
         return logl
         
@@ -707,33 +1157,171 @@ class inference(object):
         logp: float
             Expected log prior value
         """
-        Kf = np.array([self._kernelMatrix(i, self.time) for i in nodes])
-        Kw0 = np.array([self._kernelMatrix(j, self.time) for j in weights])
-        Kw = Kw0.reshape(self.q, self.p, self.N, self.N)
+        if isinstance(sigma_f, DiagonalCovariance):
+            return self._expectedLogPriorDiagonal(nodes, weights, sigma_f, mu_f,
+                                                  sigma_w, mu_w)
+        if self._semiseparable(list(nodes) + list(weights)):
+            return self._expectedLogPriorSemiseparable(nodes, weights, sigma_f,
+                                                       mu_f, sigma_w, mu_w)
+        Kf = [self._kernelMatrix(i, self.time, float) for i in nodes]
+        Kw = [self._kernelMatrix(j, self.time, float) for j in weights]
         #we have Q nodes -> j in the paper; we have P y(x)s -> i in the paper
-        first_term = 0 #calculation of the first term of eq.15 of Nguyen & Bonilla (2013)
-        second_term = 0 #calculation of the second term of eq.15 of Nguyen & Bonilla (2013)
-        Lw = np.array([self._cholNugget(j)[0] for j in Kw0])
-        Lw = Lw.reshape(self.q, self.p, self.N, self.N)
-        muW = mu_w.reshape(self.q, self.p, self.N)
-        sumSigmaF = np.zeros_like(sigma_f[0])
-        for j in range(self.q):
-            Lf = self._cholNugget(Kf[j])[0]
-            logKf = np.float(np.sum(np.log(np.diag(Lf))))
-            muK =  np.linalg.solve(Lf, mu_f[:,j, :].reshape(self.N))
+        Lw = [self._kernelCholesky(j) for j in weights]
+        Lf = [self._kernelCholesky(i) for i in nodes]
+        sumSigmaF = np.cumsum(sigma_f, axis=0)
+        def nodeTerm(j):
+            logKf = float(np.sum(np.log(np.diag(Lf[j]))))
+            muK =  np.linalg.solve(Lf[j], mu_f[:,j, :].reshape(self.N))
             muKmu = muK @ muK
-            sumSigmaF = sumSigmaF + sigma_f[j]
-            trace = np.trace(np.linalg.solve(Kf[j], sumSigmaF))#sigma_f[j]))
-            first_term += -logKf - 0.5*(muKmu + trace)
+            trace = np.trace(np.linalg.solve(Kf[j], sumSigmaF[j]))
+            return -logKf - 0.5*(muKmu + trace)
+        def weightTerm(j, i):
+            #weight (i, j) has the kernel used in its update
+            k = i*self.q + j
+            muK = np.linalg.solve(Lw[k], mu_w[i,j])
+            muKmu = muK @ muK
+            trace = np.trace(np.linalg.solve(Kw[k], sigma_w[j,i,:,:]))
+            return -float(np.sum(np.log(np.diag(Lw[k])))) \
+                    - 0.5*(muKmu + trace)
+        #the terms are independent, they are added in a fixed order
+        run = self._executor.map
+        first_term = sum(run(nodeTerm, range(self.q)))
+        second_term = sum(run(weightTerm, *self._weightBlocks()))
+        logp = first_term + second_term
+        return logp
+    
+    
+    def _expectedLogPriorSemiseparable(self, nodes, weights, sigma_f, mu_f,
+                                       sigma_w, mu_w):
+        """
+        Same as _expectedLogPrior() when the kernel matrices are inverted
+        with their semi-separable factorizations, so that the prior uses the
+        same kernel matrices as the variational covariances
+        
+        Parameters
+        ----------
+            nodes: array
+                Node functions 
+            weight: array
+                Weight function
+            sigma_f: array
+                Variational covariance for each node
+            mu_f: array
+                Variational mean for each node
+            sigma_w: array
+                Variational covariance for each weight
+            mu_w: array
+                Variational mean for each weight
+        
+        Returns
+        -------
+        logp: float
+            Expected log prior value
+        """
+        Ff = [self._kernelFactor(i, True) for i in nodes]
+        Fw = [self._kernelFactor(j, True) for j in weights]
+        sumSigmaF = np.cumsum(sigma_f, axis=0)
+        def nodeTerm(j):
+            muKmu = Ff[j].quadratic(mu_f[:,j, :].reshape(self.N))
+            trace = np.trace(Ff[j].solve(sumSigmaF[j]))
+            return -0.5*Ff[j].logdet - 0.5*(muKmu + trace)
+        def weightTerm(j, i):
+            F = Fw[i*self.q + j]
+            muKmu = F.quadratic(mu_w[i,j])
+            trace = np.trace(F.solve(sigma_w[j,i,:,:]))
+            return -0.5*F.logdet - 0.5*(muKmu + trace)
+        #the terms are independent, they are added in a fixed order
+        run = self._executor.map
+        first_term = sum(run(nodeTerm, range(self.q)))
+        second_term = sum(run(weightTerm, *self._weightBlocks()))
+        logp = first_term + second_term
+        return logp
+
+    
+    
+    def _expectedLogPriorDiagonal(self, nodes, weights, sigma_f, mu_f,
+                                  sigma_w, mu_w):
+        """
+        Same as _expectedLogPrior() when the log-determinants and traces of
+        the variational covariances were already computed when updating
+        them, and the kernel matrices are inverted with their cached 
+        eigendecompositions. Each weight is paired with the kernel used in
+        its update.
+        
+        Parameters
+        ----------
+            nodes: array
+                Node functions 
+            weight: array
+                Weight function
+            sigma_f: DiagonalCovariance or DenseCovariance
+                Variational covariance for each node
+            mu_f: array
+                Variational mean for each node
+            sigma_w: DiagonalCovariance or DenseCovariance
+                Variational covariance for each weight
+            mu_w: array
+                Variational mean for each weight
+        
+        Returns
+        -------
+        logp: float
+            Expected log prior value
+        """
+        semiseparable = self._semiseparable(list(nodes) + list(weights))
+        first_term, second_term = 0, 0
+        for j in range(self.q):
+            Ff = self._kernelFactor(nodes[j], semiseparable)
+            muKmu = Ff.quadratic(mu_f[:,j, :].reshape(self.N))
+            first_term += -0.5*Ff.logdet - 0.5*(muKmu + sigma_f.trace[j])
             for i in range(self.p):
-                muK = np.linalg.solve(Lw[j,i,:,:], muW[j,i]) 
-                muKmu = muK @ muK
-                trace = np.trace(np.linalg.solve(Kw[j,i,:,:], sigma_w[j,i,:,:]))
-                second_term += -np.float(np.sum(np.log(np.diag(Lw[j,i,:,:])))) - 0.5*(muKmu + trace)
+                Fw = self._kernelFactor(weights[i*self.q + j], semiseparable)
+                muKmu = Fw.quadratic(mu_w[i,j])
+                second_term += -0.5*Fw.logdet - 0.5*(muKmu + sigma_w.trace[j,i])
         logp = first_term + second_term
         return logp
     
     
+    def _priorStatistics(self, nodes, weights, sigma_f, mu_f, sigma_w, mu_w):
+        """
+        Writes the expected log prior of _expectedLogPrior() as a sum over
+        the kernels of -0.5*(c*log|K| + tr(K^-1 M)) plus constants, and
+        returns c and M of each kernel, which is what its gradient needs
+    
+        Parameters
+        ----------
+            nodes: array
+                Node functions 
+            weight: array
+                Weight function
+            sigma_f: array
+                Variational covariance for each node
+            mu_f: array
+                Variational mean for each node
+            sigma_w: array
+                Variational covariance for each weight
+            mu_w: array
+                Variational mean for each weight
+    
+        Returns
+        -------
+        stats: list
+            Pairs (c, M) of the nodes followed by those of the weights
+        """
+        stats = []
+        sumSigmaF = np.zeros_like(sigma_f[0])
+        for j in range(self.q):
+            muF = mu_f[:, j, :].reshape(self.N)
+            sumSigmaF = sumSigmaF + sigma_f[j]
+            stats.append((1, np.outer(muF, muF) + sumSigmaF))
+        #weight kernel i*q + j goes with weight (i, j), as in the updates
+        for i in range(self.p):
+            for j in range(self.q):
+                stats.append((1, np.outer(mu_w[i,j], mu_w[i,j]) \
+                                 + sigma_w[j, i, :, :]))
+        return stats
+    
+    
     def _entropy(self, sigma_f, sigma_w):
         """
         Calculates the entropy in mean-field inference, corresponds to eq.14 
@@ -751,13 +1339,18 @@ class inference(object):
         entropy: float
             Final entropy value
         """
-        entropy = 0 #starts at zero then we sum everything
+        if isinstance(sigma_f, DiagonalCovariance):
+            entropy = 0.5 * (np.sum(sigma_f.logdet) + np.sum(sigma_w.logdet))
+            return entropy + self.qp*(1+np.log(2*np.pi))
+        #each node followed by its weights, added in this order
+        blocks = []
         for j in range(self.q):
-            L1 = self._cholNugget(sigma_f[j])
-            entropy += np.sum(np.log(np.diag(L1[0])))
+            blocks.append(sigma_f[j])
             for i in range(self.p):
-                L2 = self._cholNugget(sigma_w[j, i, :, :])
-                entropy += np.sum(np.log(np.diag(L2[0])))
+                blocks.append(sigma_w[j, i, :, :])
+        logdet = lambda sigma: np.sum(np.log(np.diag(
+                                        self._cholNugget(sigma)[0])))
+        entropy = sum(self._executor.map(logdet, blocks))
         return entropy + self.qp*(1+np.log(2*np.pi))
 
 
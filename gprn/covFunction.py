@@ -2,9 +2,165 @@
 Covariance functions to use on the GPRN
 """
 import numpy as np
+from scipy.special import ive
+from gprn.linearAlgebra import LRUCache
 #because it makes my life easier down the line
 PI, EXP, SINE, COSINE, SQRT = np.pi, np.exp, np.sin, np.cos, np.sqrt
 
+class Lags():
+    """
+    Pairwise lags r = t - t' together with the "distance features" the
+    stationary kernels are built from (|r|, r**2 and sin(pi*|r|/P)**2). Each
+    feature is computed the first time it is needed and then reused by every
+    kernel, and every part of a sum or product of kernels, evaluated on it.
+
+    Parameters
+    ----------
+    r: array
+        Matrix of lags t - t'
+    periods: int
+        Number of periods P for which sin(pi*|r|/P)**2 is kept, the least
+        recently used one is discarded first
+    diagonal: array
+        True where a lag is between an observation and itself, for the white
+        noise. Default: None, the diagonal of r if it is square
+    """
+    def __init__(self, r, periods=4, diagonal=None):
+        self.r = r
+        self.diagonal = diagonal
+        self._abs = None
+        self._square = None
+        self._sine2 = LRUCache(periods)
+
+    @property
+    def shape(self):
+        """ Shape of the lag matrix """
+        return self.r.shape
+
+    @property
+    def abs(self):
+        """ |r| """
+        if self._abs is None:
+            self._abs = np.abs(self.r)
+        return self._abs
+
+    @property
+    def square(self):
+        """ r**2 """
+        if self._square is None:
+            self._square = self.r**2
+        return self._square
+
+    def sine2(self, P):
+        """ sin(pi*|r|/P)**2, stored for the last few periods P """
+        if np.ndim(P) > 0:
+            #a batch of periods, see covFunction.batch()
+            return SINE(PI*self.abs/P)**2
+        sine2 = self._sine2.get(P)
+        if sine2 is None:
+            sine2 = SINE(PI*self.abs/P)**2
+            self._sine2[P] = sine2
+        return sine2
+
+
+def _lag(r):
+    """ Lag matrix of r, which can be an array or Lags """
+    return r.r if isinstance(r, Lags) else r
+
+def _abs(r):
+    """ |r|, taken from the precomputed features when r is Lags """
+    return r.abs if isinstance(r, Lags) else np.abs(r)
+
+def _square(r):
+    """ r**2, taken from the precomputed features when r is Lags """
+    return r.square if isinstance(r, Lags) else r**2
+
+def _sine2(r, P):
+    """ sin(pi*|r|/P)**2, taken from the precomputed features when r is Lags """
+    return r.sine2(P) if isinstance(r, Lags) else SINE(PI*np.abs(r)/P)**2
+
+def _output(K, out):
+    """ K, written into out when it is given """
+    if out is None:
+        return K
+    out[...] = K
+    return out
+
+
+##### Semi-separable representations ##########################################
+def _blockDiagonal(A, B):
+    """ Block diagonal stack of two stacks of square matrices """
+    M, J1, J2 = A.shape[0], A.shape[1], B.shape[1]
+    C = np.zeros((M, J1+J2, J1+J2))
+    C[:, :J1, :J1] = A
+    C[:, J1:, J1:] = B
+    return C
+
+def _semiseparableSum(ss1, ss2):
+    """ Semi-separable representation of the sum of two kernels """
+    U1, V1, transition1, white1 = ss1
+    U2, V2, transition2, white2 = ss2
+    transition = lambda dt: _blockDiagonal(transition1(dt), transition2(dt))
+    return (np.concatenate((U1, U2)), np.concatenate((V1, V2)), transition,
+            white1 + white2)
+
+def _semiseparableProduct(ss1, ss2):
+    """ Semi-separable representation of the product of two kernels """
+    U1, V1, transition1, white1 = ss1
+    U2, V2, transition2, white2 = ss2
+    def transition(dt):
+        A, B = transition1(dt), transition2(dt)
+        J = A.shape[1] * B.shape[1]
+        return np.einsum('mij,mkl->mikjl', A, B).reshape(dt.size, J, J)
+    k1, k2 = U1 @ V1, U2 @ V2
+    return (np.kron(U1, U2), np.kron(V1, V2), transition,
+            (k1 + white1)*(k2 + white2) - k1*k2)
+
+def _rotation(omega):
+    """ Transition of a cosine of angular frequency omega """
+    def transition(dt):
+        c, s = COSINE(omega*dt), SINE(omega*dt)
+        return np.stack((np.stack((c, -s), -1), np.stack((s, c), -1)), -2)
+    return transition
+
+def _matern(theta, lam, order):
+    """
+    Semi-separable representation of theta**2 * P(lam*r) * exp(-lam*r),
+    with P the polynomial of the Matern kernel with nu = order - 1/2
+    """
+    U = theta**2 * np.array([[1.], [1., lam], [1., lam, 2*lam**2/3]][order-1])
+    V = np.eye(order)[0]
+    def transition(dt):
+        #exp(-lam*dt) times the exponential of dt times a shift matrix
+        Phi = np.zeros((dt.size, order, order))
+        for k in range(order):
+            for j in range(k+1):
+                Phi[:, k, j] = dt**(k-j) / np.prod(np.arange(1, k-j+1))
+        return Phi * EXP(-lam*dt)[:, None, None]
+    return U, V, transition, 0.
+
+def _periodic(theta, P, ell, tol=1e-15, harmonics=25):
+    """
+    Semi-separable representation of the periodic kernel, from its expansion
+    exp(z*cos(x)) = I_0(z) + 2*sum_k I_k(z)*cos(k*x), with z = 1/ell**2,
+    truncated when the weight of the remaining harmonics is below tol, or
+    None if more than the given number of harmonics would be needed
+    """
+    z = 1 / ell**2
+    weights = np.append(ive(0, z), 2*ive(np.arange(1, harmonics+1), z))
+    tail = 1 - np.cumsum(weights)
+    if tail[-1] > tol:
+        return None
+    K = np.argmax(tail <= tol)
+    ss = (theta**2 * weights[:1], np.ones(1),
+          lambda dt: np.ones((dt.size, 1, 1)), 0.)
+    for k in range(1, K+1):
+        cosine = (theta**2 * np.array([weights[k], 0.]), np.array([1., 0.]),
+                  _rotation(2*PI*k/P), 0.)
+        ss = _semiseparableSum(ss, cosine)
+    return ss
+
+
 class covFunction():
     """
     Definition the covariance functions (kernels) of our GPRN, by default and
@@ -15,19 +171,118 @@ class covFunction():
         self.pars = np.array(args, dtype=float)
         self.pars[self.pars > 1e50] = 1e50
         #self.pars[self.pars < 1e-50] = 1e-50
-    def __call__(self, r, t1=None, t2=None):
+    def __call__(self, r, t1=None, t2=None, out=None):
         """
-        r = t - t'
+        r = t - t', either as an array or as Lags
         Not sure if this is a good approach since will make our life harder
         when defining certain non-stationary kernels, e.g linear kernel.
+        The kernel is written into out when it is given, an array of the
+        shape of r, using the out arguments of the NumPy ufuncs so that no
+        new N x N array is needed.
         """
         raise NotImplementedError
 
+    def gradient(self, r, t1=None, t2=None):
+        """
+        Derivatives of the kernel with respect to each of its parameters, in
+        the order of pars, so that dK[i] = dK/dpars[i] has the shape of K
+        """
+        raise NotImplementedError
+
+    def semiseparable(self):
+        """
+        Semi-separable (celerite-like) representation of the kernel,
+        k(r) = U.T @ Phi(r) @ V for r > 0 and k(0) = U.T @ V + white, with
+        transitions that compose, Phi(r1 + r2) = Phi(r1) @ Phi(r2). Used by
+        linearAlgebra.SemiseparableFactor. Only kernels with an exact
+        representation have one, so that the semi-separable factorizations
+        give the same matrices as the dense ones.
+
+        Returns
+        -------
+        ss: tuple
+            U, V, transition (function of an array of lags returning Phi with
+            shape (M, J, J)) and white, or None if there is no representation
+        """
+        return None
+
+    def support(self):
+        """
+        Radius of the compact support of the kernel, k(r) = 0 for
+        |r| > support(), used by linearAlgebra.BandedFactor
+
+        Returns
+        -------
+        radius: float
+            Support radius, np.inf if the support is not compact
+        """
+        return np.inf
+
+    def _terms(self):
+        """
+        The kernel as a sum of product terms, used by compile(). Each term is
+        (scale, exponent, factors, diagonal) for
+        scale * exp(sum(exponent[f] * f)) * prod(factors) * (white noise),
+        with exponent mapping the features of Lags ('abs', 'square' or
+        ('sine2', P)) to their coefficients, factors kernels evaluated as
+        they are and diagonal True for a white noise term. By default the
+        kernel is a single factor.
+        """
+        return [(1., {}, (self,), False)]
+
+    def compile(self):
+        """
+        Flattens the kernel, and every sum or product of kernels in it, into
+        one fused evaluation plan, see KernelPlan
+
+        Returns
+        -------
+        plan: KernelPlan
+            Callable evaluating the kernel on a lag matrix
+        """
+        return KernelPlan(self._terms())
+
     def __repr__(self):
         """ Representation of each kernel instance """
         return "{0}({1})".format(self.__class__.__name__,
                                  ", ".join(map(str, self.pars)))
 
+    def _new(self, pars):
+        """ Kernel of the same type with parameters pars (first axis) """
+        return self.__class__(*pars)
+
+    def batch(self, pars, r, t1=None, t2=None):
+        """
+        Evaluates the kernel for B sets of parameters at once. The parameters
+        are broadcast against the lags, so the B matrices are computed in one
+        vectorized pass instead of B calls.
+
+        Parameters
+        ----------
+        pars: array
+            Parameters of the kernel, shape (B, npars), in the order of pars
+        r: array or Lags
+            Lags t - t', shape (N, M)
+        t1, t2: arrays
+            Times, only used by the non-stationary kernels
+
+        Returns
+        -------
+        K: array
+            Covariance matrices, shape (B, N, M)
+        """
+        pars = np.atleast_2d(np.array(pars, dtype=float))
+        kernel = self._new(pars.T[..., None, None])
+        if t1 is None:
+            K = kernel(r)
+        else:
+            K = kernel(r, t1, t2)
+        shape = pars.shape[:1] + np.shape(K)[-2:]
+        if np.shape(K) != shape:
+            #kernels that do not depend on any of their parameters
+            K = np.broadcast_to(K, shape).copy()
+        return K
+
     def __add__(self, b):
         return Sum(self, b)
     def __radd__(self, b):
@@ -41,7 +296,7 @@ class covFunction():
 class _operator(covFunction):
     """ To allow operations between two kernels """
     def __init__(self, k1, k2):
-        super(_operator, self).__init__(k1, k2)
+        #the parameters are those of k1 and k2, see the pars property
         self.k1 = k1
         self.k2 = k2
         self.kerneltype = 'complex'
@@ -51,11 +306,34 @@ class _operator(covFunction):
         """ Parameters og the two kernels """
         return np.append(self.k1.pars, self.k2.pars)
 
+    def _new(self, pars):
+        """ Kernel of the same type with parameters pars (first axis) """
+        n = self.k1.pars.size
+        return self.__class__(self.k1._new(pars[:n]), self.k2._new(pars[n:]))
+
 
 class Sum(_operator):
     """ To allow the sum of kernels """
-    def __call__(self, r):
-        return self.k1(r) + self.k2(r)
+    def __call__(self, r, out=None):
+        K = self.k1(r, out=out)
+        K += self.k2(r)
+        return K
+
+    def gradient(self, r):
+        return np.concatenate((self.k1.gradient(r), self.k2.gradient(r)))
+
+    def semiseparable(self):
+        ss1 = self.k1.semiseparable()
+        ss2 = self.k2.semiseparable()
+        if ss1 is None or ss2 is None:
+            return None
+        return _semiseparableSum(ss1, ss2)
+
+    def support(self):
+        return max(self.k1.support(), self.k2.support())
+
+    def _terms(self):
+        return self.k1._terms() + self.k2._terms()
 
     def __repr__(self):
         return "{0} + {1}".format(self.k1, self.k2)
@@ -64,13 +342,174 @@ class Sum(_operator):
 
 class Multiplication(_operator):
     """ To allow the multiplication of kernels """
-    def __call__(self, r):
-        return self.k1(r) * self.k2(r)
+    def __call__(self, r, out=None):
+        K = self.k1(r, out=out)
+        K *= self.k2(r)
+        return K
+
+    def gradient(self, r):
+        return np.concatenate((self.k1.gradient(r) * self.k2(r),
+                               self.k1(r) * self.k2.gradient(r)))
+
+    def semiseparable(self):
+        ss1 = self.k1.semiseparable()
+        ss2 = self.k2.semiseparable()
+        if ss1 is None or ss2 is None:
+            return None
+        return _semiseparableProduct(ss1, ss2)
+
+    def support(self):
+        return min(self.k1.support(), self.k2.support())
+
+    def _terms(self):
+        terms = []
+        for scale1, exponent1, factors1, diagonal1 in self.k1._terms():
+            for scale2, exponent2, factors2, diagonal2 in self.k2._terms():
+                exponent = dict(exponent1)
+                for feature, coefficient in exponent2.items():
+                    exponent[feature] = exponent.get(feature, 0.) + coefficient
+                terms.append((scale1*scale2, exponent, factors1 + factors2,
+                              diagonal1 or diagonal2))
+        return terms
 
     def __repr__(self):
         return "{0} * {1}".format(self.k1, self.k2)
 
 
+##### Compiled kernels #########################################################
+def _mergeTerms(terms):
+    """
+    Adds up the terms of KernelPlan that only differ by their scale, so that
+    e.g. SE(1, 2) + SE(3, 2) is one exponential
+    """
+    merged = {}
+    for scale, exponent, factors, diagonal in terms:
+        exponent = {feature: coefficient for feature, coefficient
+                    in exponent.items() if coefficient != 0}
+        if factors:
+            #factors are evaluated as they are, they are never merged
+            key = len(merged)
+        else:
+            key = (tuple(sorted(exponent.items(), key=repr)), diagonal)
+        if key in merged:
+            merged[key][0] += scale
+        else:
+            merged[key] = [scale, exponent, factors, diagonal]
+    return [tuple(term) for term in merged.values()]
+
+
+class KernelPlan(object):
+    """
+    Fused evaluation of a kernel given by covFunction.compile(). The sums and
+    products of kernels are flattened into terms, the exponentials of each
+    product become a single exponential of a linear combination of the
+    features of Lags (computed once and shared by every term), and every term
+    is accumulated in place into one output array. A quasi-periodic kernel
+    plus white noise is then one exponential and an update of the diagonal,
+    instead of a new matrix for each of its parts.
+
+    Parameters
+    ----------
+    terms: list
+        Product terms of the kernel, see covFunction._terms()
+    """
+    def __init__(self, terms):
+        self.terms = _mergeTerms(terms)
+        #white noise terms only update the diagonal of the output
+        white = lambda term: term[3] and not term[1] and not term[2]
+        self._white = [term[0] for term in self.terms if white(term)]
+        self._matrix = [term for term in self.terms if not white(term)]
+
+    @staticmethod
+    def _feature(r, feature):
+        """ Feature of the lags r """
+        if feature == 'abs':
+            return r.abs
+        if feature == 'square':
+            return r.square
+        return r.sine2(feature[1])
+
+    @staticmethod
+    def _diagonal(r):
+        """ Mask of the white noise, as given by WhiteNoise """
+        if r.diagonal is not None:
+            return r.diagonal
+        if r.shape[0] == r.shape[1]:
+            return np.identity(r.shape[0], dtype=bool)
+        return np.ones(r.shape, dtype=bool)
+
+    def _evaluate(self, term, r, out, work):
+        """ Writes a term into out, work is used by its exponent """
+        scale, exponent, factors, diagonal = term
+        if exponent:
+            features = iter(exponent.items())
+            feature, coefficient = next(features)
+            np.multiply(self._feature(r, feature), coefficient, out=out)
+            for feature, coefficient in features:
+                np.multiply(self._feature(r, feature), coefficient, out=work)
+                out += work
+            np.exp(out, out=out)
+            out *= scale
+        else:
+            out.fill(scale)
+        for factor in factors:
+            out *= factor(r)
+        if diagonal:
+            out *= self._diagonal(r)
+        return out
+
+    def __call__(self, r, out=None, pool=None):
+        """
+        Evaluates the kernel
+
+        Parameters
+        ----------
+        r: array or Lags
+            Lags t - t'
+        out: array
+            Array of the shape of r where the kernel is written. Default:
+            None, a new array
+        pool: BufferPool
+            Pool of the work arrays of the plan, they are given back to it
+            at the end. Default: None, new arrays
+
+        Returns
+        -------
+        K: array
+            Covariance matrix
+        """
+        if not isinstance(r, Lags):
+            r = Lags(r)
+        if out is None:
+            out = np.empty(r.shape)
+        #the first term is written into out and the next ones into work,
+        #spare holds the parts of their exponents
+        empty = np.empty if pool is None else pool.take
+        first, rest = self._matrix[:1], self._matrix[1:]
+        work = empty(r.shape, out.dtype) if rest else None
+        spare = None
+        if any(len(term[1]) > 1 for term in self._matrix):
+            spare = empty(r.shape, out.dtype)
+        for term in first:
+            self._evaluate(term, r, out, spare)
+        if not first:
+            out.fill(0.)
+        for term in rest:
+            out += self._evaluate(term, r, work, spare)
+        for scale in self._white:
+            if r.diagonal is not None:
+                np.add(out, scale, out=out, where=r.diagonal)
+            elif r.shape[0] == r.shape[1]:
+                out.flat[::r.shape[1]+1] += scale
+            else:
+                out += scale
+        if pool is not None:
+            for array in (work, spare):
+                if array is not None:
+                    pool.release(array, now=True)
+        return out
+
+
 
 ##### Constant #################################################################
 class Constant(covFunction):
@@ -90,8 +529,22 @@ class Constant(covFunction):
         self.tag = 'C'
         self.c = c
 
-    def __call__(self, r):
-        return self.c**2 * np.ones_like(r)
+    def __call__(self, r, out=None):
+        if out is None:
+            return self.c**2 * np.ones(r.shape)
+        out[...] = self.c**2
+        return out
+
+    def gradient(self, r):
+        #the white noise amplitude is not used
+        return np.array([2*self.c * np.ones(r.shape), np.zeros(r.shape)])
+
+    def semiseparable(self):
+        return (self.c**2 * np.ones(1), np.ones(1),
+                lambda dt: np.ones((dt.size, 1, 1)), 0.)
+
+    def _terms(self):
+        return [(self.c**2, {}, (), False)]
 
 
 ##### White Noise ##############################################################
@@ -112,10 +565,26 @@ class WhiteNoise(covFunction):
         self.tag = 'WN'
         self.wn = wn
 
-    def __call__(self, r):
+    def __call__(self, r, out=None):
+        if isinstance(r, Lags) and r.diagonal is not None:
+            return np.multiply(self.wn**2, r.diagonal, out=out)
+        r = _lag(r)
         if r[0, :].shape == r[:, 0].shape:
-            return self.wn**2 * np.diag(np.diag(np.ones_like(r)))
-        return self.wn**2 * np.ones_like(r)
+            return np.multiply(self.wn**2, np.identity(r.shape[0]), out=out)
+        return np.multiply(self.wn**2, np.ones_like(r), out=out)
+
+    def gradient(self, r):
+        return np.array([2/self.wn * self(r)])
+
+    def semiseparable(self):
+        return (np.zeros(0), np.zeros(0),
+                lambda dt: np.zeros((dt.size, 0, 0)), self.wn**2)
+
+    def support(self):
+        return 0.
+
+    def _terms(self):
+        return [(self.wn**2, {}, (), True)]
 
 
 ##### Squared exponential ######################################################
@@ -140,8 +609,18 @@ class SquaredExponential(covFunction):
         self.theta = theta
         self.ell = ell
 
-    def __call__(self, r):
-        return self.theta**2 * EXP(-0.5 * r**2 / self.ell**2)
+    def __call__(self, r, out=None):
+        K = np.multiply(_square(r), -0.5/self.ell**2, out=out)
+        EXP(K, out=K)
+        K *= self.theta**2
+        return K
+
+    def gradient(self, r):
+        K = self(r)
+        return np.array([2/self.theta * K, _square(r)/self.ell**3 * K])
+
+    def _terms(self):
+        return [(self.theta**2, {'square': -0.5/self.ell**2}, (), False)]
 
 
 ##### Periodic #################################################################
@@ -168,8 +647,24 @@ class Periodic(covFunction):
         self.ell = ell
         self.P = P
 
-    def __call__(self, r):
-        return self.theta**2 * EXP(-2*SINE(PI*np.abs(r)/self.P)**2/self.ell**2)
+    def __call__(self, r, out=None):
+        K = np.multiply(_sine2(r, self.P), -2/self.ell**2, out=out)
+        EXP(K, out=K)
+        K *= self.theta**2
+        return K
+
+    def gradient(self, r):
+        K = self(r)
+        dP = 2*PI*_abs(r) * SINE(2*PI*_abs(r)/self.P) / (self.P*self.ell)**2
+        return np.array([2/self.theta * K, dP * K,
+                         4*_sine2(r, self.P)/self.ell**3 * K])
+
+    def semiseparable(self):
+        return _periodic(self.theta, self.P, self.ell)
+
+    def _terms(self):
+        return [(self.theta**2, {('sine2', self.P): -2/self.ell**2}, (),
+                 False)]
 
 
 ##### Quasi Periodic ###########################################################
@@ -201,9 +696,22 @@ class QuasiPeriodic(covFunction):
         self.P = P
         self.ell_p = ell_p
 
-    def __call__(self, r):
-        return self.theta**2 * EXP(-2*SINE(PI*np.abs(r)/self.P)**2 \
-                       /self.ell_p**2 - r**2/(2*self.ell_e**2))
+    def __call__(self, r, out=None):
+        K = np.multiply(_sine2(r, self.P), -2/self.ell_p**2, out=out)
+        K -= _square(r)/(2*self.ell_e**2)
+        EXP(K, out=K)
+        K *= self.theta**2
+        return K
+
+    def gradient(self, r):
+        K = self(r)
+        dP = 2*PI*_abs(r) * SINE(2*PI*_abs(r)/self.P) / (self.P*self.ell_p)**2
+        return np.array([2/self.theta * K, _square(r)/self.ell_e**3 * K,
+                         dP * K, 4*_sine2(r, self.P)/self.ell_p**3 * K])
+
+    def _terms(self):
+        return [(self.theta**2, {('sine2', self.P): -2/self.ell_p**2,
+                                 'square': -0.5/self.ell_e**2}, (), False)]
 
 
 ##### Rational Quadratic #######################################################
@@ -231,8 +739,19 @@ class RationalQuadratic(covFunction):
         self.alpha = alpha
         self.ell = ell
 
-    def __call__(self, r):
-        return self.theta**2 /(1+r**2/(2*self.alpha*self.ell**2))**(-self.alpha)
+    def __call__(self, r, out=None):
+        K = np.multiply(_square(r), 1/(2*self.alpha*self.ell**2), out=out)
+        K += 1
+        #theta**2 / K**(-alpha)
+        np.power(K, self.alpha, out=K)
+        K *= self.theta**2
+        return K
+
+    def gradient(self, r):
+        K = self(r)
+        u = 1 + _square(r)/(2*self.alpha*self.ell**2)
+        return np.array([2/self.theta * K, (np.log(u) - (u-1)/u) * K,
+                         -2*self.alpha*(u-1)/(u*self.ell) * K])
 
 
 ##### RQP kernel ###############################################################
@@ -267,9 +786,21 @@ class RQP(covFunction):
         self.P = P
         self.ell_p = ell_p
 
-    def __call__(self, r):
-        return self.theta**2 *EXP(-2*SINE(PI*np.abs(r)/self.P)**2/self.ell_p**2) \
-                        *(1+r**2/(2*self.alpha*self.ell_e**2))**(-self.alpha)
+    def __call__(self, r, out=None):
+        K = np.multiply(_square(r), 1/(2*self.alpha*self.ell_e**2), out=out)
+        K += 1
+        np.power(K, -self.alpha, out=K)
+        K *= EXP(-2*_sine2(r, self.P)/self.ell_p**2)
+        K *= self.theta**2
+        return K
+
+    def gradient(self, r):
+        K = self(r)
+        u = 1 + _square(r)/(2*self.alpha*self.ell_e**2)
+        dP = 2*PI*_abs(r) * SINE(2*PI*_abs(r)/self.P) / (self.P*self.ell_p)**2
+        return np.array([2/self.theta * K, ((u-1)/u - np.log(u)) * K,
+                         2*self.alpha*(u-1)/(u*self.ell_e) * K, dP * K,
+                         4*_sine2(r, self.P)/self.ell_p**3 * K])
 
 
 ##### CoSINE ###################################################################
@@ -293,8 +824,19 @@ class CoSINE(covFunction):
         self.theta = theta
         self.P = P
 
-    def __call__(self, r):
-        return self.theta**2 *COSINE(2*PI*np.abs(r) / self.P)
+    def __call__(self, r, out=None):
+        K = np.multiply(_abs(r), 2*PI/self.P, out=out)
+        COSINE(K, out=K)
+        K *= self.theta**2
+        return K
+
+    def gradient(self, r):
+        dP = self.theta**2 * SINE(2*PI*_abs(r)/self.P) * 2*PI*_abs(r)/self.P**2
+        return np.array([2/self.theta * self(r), dP])
+
+    def semiseparable(self):
+        return (self.theta**2 * np.array([1., 0.]), np.array([1., 0.]),
+                _rotation(2*PI/self.P), 0.)
 
 
 ##### Laplacian ##############################################################
@@ -318,8 +860,21 @@ class Laplacian(covFunction):
         self.theta = theta
         self.ell = ell
         
-    def __call__(self, r):
-        return self.theta**2 * EXP(-np.abs(r)/self.ell)
+    def __call__(self, r, out=None):
+        K = np.multiply(_abs(r), -1/self.ell, out=out)
+        EXP(K, out=K)
+        K *= self.theta**2
+        return K
+
+    def gradient(self, r):
+        K = self(r)
+        return np.array([2/self.theta * K, _abs(r)/self.ell**2 * K])
+
+    def semiseparable(self):
+        return _matern(self.theta, 1/self.ell, 1)
+
+    def _terms(self):
+        return [(self.theta**2, {'abs': -1/self.ell}, (), False)]
 
 
 ##### Exponential ##############################################################
@@ -343,8 +898,21 @@ class Exponential(covFunction):
         self.theta = theta
         self.ell = ell
 
-    def __call__(self, r):
-        return self.theta**2 * EXP(-np.abs(r)/self.ell)
+    def __call__(self, r, out=None):
+        K = np.multiply(_abs(r), -1/self.ell, out=out)
+        EXP(K, out=K)
+        K *= self.theta**2
+        return K
+
+    def gradient(self, r):
+        K = self(r)
+        return np.array([2/self.theta * K, _abs(r)/self.ell**2 * K])
+
+    def semiseparable(self):
+        return _matern(self.theta, 1/self.ell, 1)
+
+    def _terms(self):
+        return [(self.theta**2, {'abs': -1/self.ell}, (), False)]
 
 
 ##### Matern 3/2 ###############################################################
@@ -369,9 +937,21 @@ class Matern32(covFunction):
         self.theta = theta
         self.ell = ell
 
-    def __call__(self, r):
-        return self.theta**2 * (1.0+SQRT(3.0)*np.abs(r)/self.ell) \
-                        *np.exp(-SQRT(3.0)*np.abs(r) / self.ell)
+    def __call__(self, r, out=None):
+        K = np.multiply(_abs(r), SQRT(3.0)/self.ell, out=out)
+        exponential = EXP(-K)
+        K += 1
+        K *= exponential
+        K *= self.theta**2
+        return K
+
+    def gradient(self, r):
+        a = SQRT(3.0)*_abs(r) / self.ell
+        return np.array([2/self.theta * self(r),
+                         self.theta**2 * a**2 * EXP(-a) / self.ell])
+
+    def semiseparable(self):
+        return _matern(self.theta, SQRT(3.0)/self.ell, 2)
 
 
 #### Matern 5/2 ################################################################
@@ -396,10 +976,18 @@ class Matern52(covFunction):
         self.theta = theta
         self.ell = ell
 
-    def __call__(self, r):
-        return self.theta**2*(1.0+(3*SQRT(5)*self.ell*np.abs(r) \
-                           +5*np.abs(r)**2)/(3* self.ell**2)) \
-                           *EXP(-SQRT(5.0)*np.abs(r)/self.ell)
+    def __call__(self, r, out=None):
+        return _output(self.theta**2*(1.0+(3*SQRT(5)*self.ell*_abs(r) \
+                           +5*_square(r))/(3* self.ell**2)) \
+                           *EXP(-SQRT(5.0)*_abs(r)/self.ell), out)
+
+    def gradient(self, r):
+        a = SQRT(5.0)*_abs(r) / self.ell
+        dell = self.theta**2 * a**2 * (1+a) * EXP(-a) / (3*self.ell)
+        return np.array([2/self.theta * self(r), dell])
+
+    def semiseparable(self):
+        return _matern(self.theta, SQRT(5.0)/self.ell, 3)
 
 
 #### Linear ####################################################################
@@ -423,8 +1011,13 @@ class Linear(covFunction):
         self.theta = theta
         self.c = c
 
-    def __call__(self, r, t1, t2):
-        return  (t1 - self.c) * (t2 - self.c)
+    def __call__(self, r, t1, t2, out=None):
+        return np.multiply(t1 - self.c, t2 - self.c, out=out)
+
+    def gradient(self, r, t1, t2):
+        #the amplitude is not used
+        dc = 2*self.c - t1 - t2
+        return np.array([np.zeros_like(dc), dc])
 
 
 ##### Gamma-exponential ########################################################
@@ -451,8 +1044,22 @@ class GammaEXP(covFunction):
         self.gamma = gamma
         self.ell = ell
 
-    def __call__(self, r):
-        return self.theta**2 * EXP(-(np.abs(r)/self.ell) ** self.gamma)
+    def __call__(self, r, out=None):
+        K = np.divide(_abs(r), self.ell, out=out)
+        np.power(K, self.gamma, out=K)
+        np.negative(K, out=K)
+        EXP(K, out=K)
+        K *= self.theta**2
+        return K
+
+    def gradient(self, r):
+        K = self(r)
+        x = _abs(r) / self.ell
+        xgamma = x**self.gamma
+        #x**gamma * log(x) goes to zero at x = 0
+        logx = np.log(np.where(x > 0, x, 1))
+        return np.array([2/self.theta * K, -xgamma * logx * K,
+                         self.gamma * xgamma / self.ell * K])
 
 
 ##### Polinomial ###############################################################
@@ -484,8 +1091,15 @@ class Polynomial(covFunction):
         self.b = b
         self.c = c
 
-    def __call__(self, r, t1, t2):
-        return (self.a * t1 * t2 + self.b)**self.c
+    def __call__(self, r, t1, t2, out=None):
+        return _output((self.a * t1 * t2 + self.b)**self.c, out)
+
+    def gradient(self, r, t1, t2):
+        #the amplitude is not used and c is an integer, their derivatives
+        #are set to zero
+        dK = self.c * (self.a * t1 * t2 + self.b)**(self.c - 1)
+        zeros = np.zeros_like(dK)
+        return np.array([zeros, dK * t1 * t2, dK, zeros])
 
 
 ##### Piecewise ################################################################
@@ -502,11 +1116,23 @@ class Piecewise(covFunction):
         self.type = 'unknown'
         self.derivatives = 0    #number of derivatives in this kernel
         self.params_number = 0    #number of hyperparameters
-    def __call__(self, r):
-        r = r/(0.5*self.eta3)
-        piecewise = (3*np.abs(r) +1) * (1 - np.abs(r))**3
-        piecewise = np.where(np.abs(r)>1, 0, piecewise)
-        return piecewise
+    def __call__(self, r, out=None):
+        K = np.divide(_abs(r), 0.5*self.eta3, out=out)
+        #(3*r + 1) * (1 - r)**3 is already 0 at r = 1
+        np.minimum(K, 1, out=K)
+        cube = (1 - K)**3
+        K *= 3
+        K += 1
+        K *= cube
+        return K
+
+    def gradient(self, r):
+        r = _abs(r)/(0.5*self.eta3)
+        deta3 = 12 * r**2 * (1 - r)**2 / self.eta3
+        return np.array([np.where(r>1, 0, deta3)])
+
+    def support(self):
+        return 0.5 * self.eta3
 
 
 ### END
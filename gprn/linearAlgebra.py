@@ -0,0 +1,1650 @@
+"""
+Linear algebra tools shared by the mean-field inference engines
+"""
+from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import numpy as np
+from scipy.linalg import cholesky, cho_solve, solve_triangular, LinAlgError
+from scipy.linalg import cholesky_banded, cho_solve_banded
+from scipy.linalg.lapack import get_lapack_funcs
+
+
+##### Kernel keys ##############################################################
+def kernelKey(kernel):
+    """
+    Returns a hashable key that identifies a kernel by its class and its
+    parameters, sums and products of kernels are identified recursively
+
+    Parameters
+    ----------
+    kernel: covFunction
+        Covariance function
+
+    Returns
+    -------
+    key: tuple
+        Key of the kernel
+    """
+    if hasattr(kernel, 'k1') and hasattr(kernel, 'k2'):
+        return (kernel.__class__.__name__,
+                kernelKey(kernel.k1), kernelKey(kernel.k2))
+    return (kernel.__class__.__name__, tuple(np.ravel(kernel.pars)))
+
+
+##### LRU cache ################################################################
+class LRUCache(object):
+    """
+    Dictionary with a maximum number of entries, when it is full the least
+    recently used entry is discarded
+
+    Parameters
+    ----------
+    maxsize: int
+        Maximum number of stored entries
+    discard: callable
+        Function called with the key and the value of each discarded entry,
+        e.g. to give its arrays back to a BufferPool. Default: None
+    """
+    def __init__(self, maxsize, discard=None):
+        self.maxsize = maxsize
+        self.discard = discard
+        self._data = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __getitem__(self, key):
+        value = self._data[key]
+        self._data.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            key, value = self._data.popitem(last=False)
+            if self.discard is not None:
+                self.discard(key, value)
+
+    def get(self, key, default=None):
+        """ Returns the value of key if stored, default otherwise """
+        if key in self._data:
+            return self[key]
+        return default
+
+    def clear(self):
+        """ Removes all entries """
+        self._data.clear()
+
+
+class BufferPool(object):
+    """
+    Work arrays that are used again instead of being allocated for every new
+    set of hyperparameters, e.g. the N x N kernel matrices of the nodes and
+    weights along an MCMC. An array given back with release() can still be
+    read until recycle() is called, at the start of the next evaluation of
+    the ELBO, and only then it is handed out again by take().
+
+    Parameters
+    ----------
+    maxsize: int
+        Maximum number of arrays kept, the oldest ones are dropped first
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._free = []
+        self._released = []
+        self._lock = Lock()
+
+    def __getstate__(self):
+        #the lock can not be pickled and the arrays are only work space,
+        #an empty pool is created again
+        return {'maxsize': self.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(state['maxsize'])
+
+    def __len__(self):
+        return len(self._free) + len(self._released)
+
+    def take(self, shape, dtype=float):
+        """
+        Returns an array of a given shape, its values are not initialized
+
+        Parameters
+        ----------
+        shape: tuple
+            Shape of the array
+        dtype: data-type
+            Type of the array, float or np.float32
+
+        Returns
+        -------
+        array: array
+            Array from the pool, or a new one if there is none of that shape
+        """
+        shape = tuple(shape)
+        with self._lock:
+            for i, array in enumerate(self._free):
+                if array.shape == shape and array.dtype == dtype:
+                    return self._free.pop(i)
+        return np.empty(shape, dtype)
+
+    def release(self, array, now=False):
+        """
+        Gives an array back to the pool, views of other arrays are not kept
+
+        Parameters
+        ----------
+        array: array
+            Array that is no longer used
+        now: bool
+            True if the array can be handed out again right away, e.g. a
+            scratch array, instead of after the next recycle()
+        """
+        if array.base is not None or array.dtype.kind != 'f':
+            return
+        array.flags.writeable = True
+        with self._lock:
+            (self._free if now else self._released).append(array)
+            while len(self._free) + len(self._released) > self.maxsize:
+                (self._free or self._released).pop(0)
+
+    def recycle(self):
+        """ Hands out again the arrays released since the last call """
+        with self._lock:
+            self._free.extend(self._released)
+            self._released = []
+
+
+class WarmStartCache(LRUCache):
+    """
+    Converged variational parameters of recently evaluated hyperparameters,
+    e.g. the last samples of an MCMC. A new optimization starts from the
+    state of the closest stored hyperparameters, which needs far fewer
+    iterations than a random start when the hyperparameters change little.
+    The distance is measured relative to the size of each parameter.
+
+    Parameters
+    ----------
+    maxsize: int
+        Maximum number of stored states
+    """
+    @staticmethod
+    def hyperparameters(nodes, weight, mean, jitter):
+        """
+        Returns the parameters of the nodes, weights, means and jitters as
+        one vector
+
+        Parameters
+        ----------
+        nodes: array
+            Node functions
+        weight: array
+            Weight functions
+        mean: array
+            Mean functions
+        jitter: array
+            Jitter terms
+
+        Returns
+        -------
+        pars: tuple
+            Hyperparameters, used as key of the states
+        """
+        pars = [np.ravel(function.pars) for function in list(nodes) \
+                + list(weight) + list(mean) if function is not None]
+        pars.append(np.ravel(jitter))
+        return tuple(np.concatenate(pars).astype(float))
+
+    def nearest(self, pars):
+        """
+        Returns the state stored for the hyperparameters closest to pars,
+        None if there is no state with the same number of hyperparameters
+
+        Parameters
+        ----------
+        pars: tuple
+            Hyperparameters, as given by hyperparameters()
+
+        Returns
+        -------
+        state: object
+            Stored state
+        """
+        keys = [key for key in self._data if len(key) == len(pars)]
+        if not keys:
+            return None
+        stored, pars = np.array(keys), np.array(pars)
+        scale = np.abs(stored) + np.abs(pars) + np.finfo(float).tiny
+        distance = np.sum(((stored - pars) / scale)**2, axis=1)
+        return self[keys[int(np.argmin(distance))]]
+
+
+##### Cholesky with nugget #####################################################
+class CholeskyTelemetry(object):
+    """
+    Counters of the factorizations done by cholNugget(), to see how often,
+    and by how much, a nugget had to be added to the kernel matrices, and of
+    the eigendecompositions of SpectralFactor, to see how often eigenvalues
+    fell below its floor. An inference engine keeps one for all its
+    factorizations, it can be reset between runs, e.g. for each set of
+    hyperparameters.
+
+    Attributes
+    ----------
+    calls: int
+        Number of matrices given to cholNugget()
+    attempts: int
+        Number of calls to potrf, one more than calls for each failed try
+    escalated: int
+        Number of matrices that needed a nugget
+    failed: int
+        Number of matrices that were not positive definite even with the
+        largest nugget
+    maxNugget: float
+        Largest nugget added
+    levels: Counter
+        Number of factorized matrices per number of failed tries, a matrix
+        with k failed tries got a nugget of 1e-5 * 10**(k-1) times the mean
+        of its diagonal. The failed matrices are only counted in failed
+    spectral: int
+        Number of matrices decomposed by SpectralFactor
+    floored: int
+        Number of them with eigenvalues raised to the floor
+    flooredEigenvalues: int
+        Total number of eigenvalues raised to the floor
+    minEigenvalue: float
+        Smallest eigenvalue found, relative to the largest one of its
+        matrix, before the floor
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def __getstate__(self):
+        #the lock can not be pickled, it is created again
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = Lock()
+
+    def reset(self):
+        """ Sets all counters to zero """
+        with self._lock:
+            self.calls = 0
+            self.attempts = 0
+            self.escalated = 0
+            self.failed = 0
+            self.maxNugget = 0.
+            self.levels = Counter()
+            self.spectral = 0
+            self.floored = 0
+            self.flooredEigenvalues = 0
+            self.minEigenvalue = np.inf
+
+    def record(self, tries, nugget, failed=False):
+        """
+        Adds one factorization to the counters
+
+        Parameters
+        ----------
+        tries: int
+            Number of nuggets added, potrf was called tries + 1 times
+        nugget: float
+            Last nugget added
+        failed: bool
+            True if the matrix could not be factorized
+        """
+        with self._lock:
+            self.calls += 1
+            self.attempts += tries + 1
+            self.escalated += tries > 0
+            self.failed += failed
+            self.maxNugget = max(self.maxNugget, float(nugget))
+            if not failed:
+                self.levels[tries] += 1
+
+    def recordSpectral(self, floored, minEigenvalue):
+        """
+        Adds one eigendecomposition to the counters
+
+        Parameters
+        ----------
+        floored: int
+            Number of eigenvalues raised to the floor
+        minEigenvalue: float
+            Smallest eigenvalue relative to the largest one, before the floor
+        """
+        with self._lock:
+            self.spectral += 1
+            self.floored += floored > 0
+            self.flooredEigenvalues += int(floored)
+            self.minEigenvalue = min(self.minEigenvalue, float(minEigenvalue))
+
+    def summary(self):
+        """ Returns the counters as a dictionary """
+        with self._lock:
+            return {'calls': self.calls, 'attempts': self.attempts,
+                    'escalated': self.escalated, 'failed': self.failed,
+                    'maxNugget': self.maxNugget,
+                    'levels': dict(self.levels), 'spectral': self.spectral,
+                    'floored': self.floored,
+                    'flooredEigenvalues': self.flooredEigenvalues,
+                    'minEigenvalue': self.minEigenvalue}
+
+
+def cholNugget(matrix, maximum=10, telemetry=None):
+    """
+    Returns the lower Cholesky factor of a symmetric matrix, computed with
+    LAPACK potrf. If the matrix is not positive definite, a nugget of 1e-5
+    times the mean of its diagonal is added to the diagonal, and multiplied
+    by 10 at each failed try. The matrix is copied once: potrf only
+    overwrites the lower triangle, so it is restored from the upper one and
+    the nugget is added in place between tries.
+
+    Parameters
+    ----------
+    matrix: array
+        Symmetric matrix to decompose
+    maximum: int
+        Number of times a nugget is added
+    telemetry: CholeskyTelemetry
+        Counters where the factorization is recorded, if given
+
+    Returns
+    -------
+    L: array
+        Lower triangular Cholesky factor
+    nugget: float
+        Nugget added to the diagonal, 0 if none was needed
+    """
+    a = np.array(matrix, dtype=float, order='F')
+    potrf, = get_lapack_funcs(('potrf',), (a,))
+    n = a.shape[0]
+    diag = a.diagonal().copy()
+    scale = np.abs(diag.mean())
+    upper = np.triu_indices(n, 1)
+    nugget, tries = 0., 0
+    while True:
+        L, info = potrf(a, lower=1, clean=0, overwrite_a=1)
+        if info == 0:
+            break
+        if info < 0:
+            raise ValueError("Illegal value in argument %d of potrf" % -info)
+        if tries == maximum:
+            if telemetry is not None:
+                telemetry.record(tries, nugget, True)
+            raise LinAlgError("Not positive definite, even with nugget.")
+        nugget = scale * 1e-5 * 10.0**tries
+        tries += 1
+        a[upper[::-1]] = a[upper]
+        np.fill_diagonal(a, diag + nugget)
+    L[upper] = 0
+    if telemetry is not None:
+        telemetry.record(tries, nugget)
+    return L, nugget
+
+
+##### Spectral factorization ###################################################
+class SpectralFactor(object):
+    """
+    Eigendecomposition K = Q diag(lambda) Q.T of a kernel matrix, stored as the
+    factor L = Q diag(sqrt(lambda)) so that K = L @ L.T. Eigenvalues below the
+    round-off level of the matrix are raised to that level instead of being
+    discarded: the factor keeps its full rank, and the log-determinant and
+    the traces stay continuous functions of the kernel parameters, as those
+    of a Cholesky factorization. The engines add a small nugget to their
+    kernel matrices, so that this floor is only reached by round-off.
+
+    Parameters
+    ----------
+    matrix: array
+        Kernel matrix to decompose, None if eigh is given
+    tol: float
+        Relative tolerance, eigenvalues smaller than tol*max(lambda) are
+        raised to tol*max(lambda). Default: N times the machine precision
+    centrosymmetric: bool
+        True if the matrix is also centrosymmetric, as the symmetric Toeplitz
+        matrices of stationary kernels on evenly spaced times, to decompose it
+        with _centrosymmetricEigh()
+    dtype: data-type
+        Type of the factor L, and so of the matrices of posterior() and the
+        covariances built from them. The matrix is decomposed, and the
+        eigenvalues and log-determinants are kept, in float64 anyway: in
+        float32 the small eigenvalues of smooth kernels are lost in the
+        round-off. Default: float
+    eigh: tuple
+        Eigenvalues and eigenvectors of the matrix, if they were already
+        computed, e.g. by spectralFactors()
+    telemetry: CholeskyTelemetry
+        Counters where the eigenvalues raised to the floor are recorded, if
+        given
+    """
+    def __init__(self, matrix, tol=None, centrosymmetric=False, dtype=float,
+                 eigh=None, telemetry=None):
+        if eigh is not None:
+            eigval, eigvec = eigh
+        elif centrosymmetric:
+            eigval, eigvec = _centrosymmetricEigh(matrix)
+        else:
+            eigval, eigvec = np.linalg.eigh(matrix)
+        self.N = eigvec.shape[0]
+        if tol is None:
+            tol = self.N * np.finfo(float).eps
+        largest = max(eigval[-1], np.finfo(float).tiny)
+        self.eigval = np.maximum(eigval, tol * largest)
+        if telemetry is not None:
+            telemetry.recordSpectral(np.sum(eigval < tol * largest),
+                                     eigval[0] / largest)
+        self.eigvec = eigvec
+        self.rank = self.eigval.size
+        self.L = (self.eigvec * np.sqrt(self.eigval)).astype(dtype,
+                                                              copy=False)
+        #log-determinant of the kernel matrix
+        self.logdet = np.sum(np.log(self.eigval), dtype=float)
+
+    def quadratic(self, x):
+        """
+        Returns x.T K^-1 x
+
+        Parameters
+        ----------
+        x: array
+            Vector of size N
+
+        Returns
+        -------
+        xKx: float
+            Quadratic form
+        """
+        z = (self.eigvec.T @ x) / np.sqrt(self.eigval)
+        return z @ z
+
+    def trace(self, posterior):
+        """
+        Returns tr(K^-1 Sigma) for a variational covariance given by
+        posterior()
+
+        Parameters
+        ----------
+        posterior: SpectralPosterior or SemiseparablePosterior
+            Variational covariance, as given by posterior()
+
+        Returns
+        -------
+        trace: float
+            Trace of K^-1 Sigma
+        """
+        if isinstance(posterior, SpectralPosterior):
+            if posterior.factor is self:
+                #tr(K^-1 Sigma) = tr(B^-1) = N - tr(diag Sigma)
+                return self.rank - posterior.diag @ posterior.variance()
+            Z = (self.eigvec.T @ posterior.V.T) / np.sqrt(self.eigval)[:, None]
+            return np.sum(Z * Z)
+        #sum of q.T Sigma q / lambda over the eigenvectors
+        SigmaQ = posterior.dot(self.eigvec)
+        return np.sum(np.sum(self.eigvec * SigmaQ, axis=0) / self.eigval)
+
+    def posterior(self, diag):
+        """
+        Returns the variational covariance (K^-1 + diag)^-1 as a factor V,
+        Sigma = V.T @ V, written in the Woodbury form K - K(diag^-1 + K)^-1 K.
+        Only the factor V is stored, so the covariance never needs to be
+        built, and the matrix I + L.T diag L has all its eigenvalues >= 1,
+        so its factorization never needs a nugget.
+
+        Parameters
+        ----------
+        diag: array
+            Diagonal to add to the precision matrix
+
+        Returns
+        -------
+        posterior: SpectralPosterior
+            Variational covariance
+        """
+        if self.rank == 0:
+            return SpectralPosterior(np.zeros((0, self.N)), 0.)
+        dtype = self.L.dtype
+        B = np.identity(self.rank, dtype) \
+            + (self.L.T * diag.astype(dtype, copy=False)) @ self.L
+        C = cholesky(B, lower=True, overwrite_a=True)
+        V = solve_triangular(C, self.L.T, lower=True)
+        logdet = self.logdet - 2*np.sum(np.log(np.diag(C)), dtype=float)
+        return SpectralPosterior(V, logdet, self, diag)
+
+    def posteriors(self, diags, map=map):
+        """
+        Returns the variational covariances (K^-1 + diag)^-1 of several
+        diagonals, as posterior() but with the matrices I + L.T diag L of all
+        of them built and factorized together in stacked calls
+
+        Parameters
+        ----------
+        diags: array
+            Diagonals to add to the precision matrix, shape (B, N)
+        map: callable
+            Used to apply the triangular solves to the members, e.g.
+            BlockExecutor.map. Default: the built-in map
+
+        Returns
+        -------
+        posteriors: list
+            SpectralPosterior of each diagonal
+        """
+        diags = np.asarray(diags)
+        if self.rank == 0:
+            return [SpectralPosterior(np.zeros((0, self.N)), 0.)
+                    for _ in diags]
+        B = (self.L.T * diags[:, None, :].astype(self.L.dtype)) @ self.L
+        B[:, np.arange(self.rank), np.arange(self.rank)] += 1
+        C = np.linalg.cholesky(B)
+        V = map(lambda Cb: solve_triangular(Cb, self.L.T, lower=True), C)
+        logdet = self.logdet - 2*np.sum(np.log(np.diagonal(C, 0, 1, 2)),
+                                        axis=1, dtype=float)
+        return [SpectralPosterior(Vb, l, self, d)
+                for Vb, l, d in zip(V, logdet, diags)]
+
+    def covariance(self, diag):
+        """
+        Returns the variational covariance (K^-1 + diag)^-1
+
+        Parameters
+        ----------
+        diag: array
+            Diagonal to add to the precision matrix
+
+        Returns
+        -------
+        sigma: array
+            Variational covariance matrix
+        """
+        return self.posterior(diag).covariance()
+
+
+def spectralFactors(matrices, tol=None, centrosymmetric=False, dtype=float,
+                    telemetry=None):
+    """
+    Returns the SpectralFactor of each matrix of a stack, e.g. the kernel
+    matrices of all the walkers of an ensemble, with all of them decomposed
+    in one stacked call of np.linalg.eigh() instead of one call each
+
+    Parameters
+    ----------
+    matrices: array
+        Kernel matrices to decompose, shape (B, N, N)
+    tol: float
+        Relative tolerance of SpectralFactor
+    centrosymmetric: bool
+        True if the matrices are also centrosymmetric
+    dtype: data-type
+        Type of the factors L
+    telemetry: CholeskyTelemetry
+        Counters of the eigendecompositions, if given
+
+    Returns
+    -------
+    factors: list
+        SpectralFactor of each matrix
+    """
+    if centrosymmetric:
+        eigval, eigvec = _centrosymmetricEigh(matrices)
+    else:
+        eigval, eigvec = np.linalg.eigh(matrices)
+    return [SpectralFactor(None, tol, dtype=dtype, eigh=pair,
+                           telemetry=telemetry)
+            for pair in zip(eigval, eigvec)]
+
+
+def _centrosymmetricEigh(matrix):
+    """
+    Same as np.linalg.eigh() for a symmetric matrix K that is also
+    centrosymmetric, J K J = K with J the exchange matrix. Its eigenvectors
+    are either symmetric or antisymmetric, so in the basis
+    (e_i +- e_{N-1-i})/sqrt(2) it splits in two symmetric matrices of half
+    the size, and decomposing them takes about a quarter of the work.
+
+    Parameters
+    ----------
+    matrix: array
+        Symmetric and centrosymmetric N x N matrix, or a stack of them of
+        shape (..., N, N)
+
+    Returns
+    -------
+    eigval: array
+        Eigenvalues in ascending order
+    eigvec: array
+        Corresponding eigenvectors, as columns
+    """
+    N = matrix.shape[-1]
+    m = N // 2
+    #K[i, j] +- K[i, N-1-j] for i, j < m
+    K, R = matrix[..., :m, :m], matrix[..., :m, :N-m-1:-1]
+    even, odd = K + R, K - R
+    if N % 2:
+        #the middle element e_m is symmetric
+        middle = np.sqrt(2) * matrix[..., :m, m]
+        even = np.block([[even, middle[..., :, None]],
+                         [middle[..., None, :], matrix[..., m:m+1, m:m+1]]])
+    valEven, vecEven = np.linalg.eigh(even)
+    valOdd, vecOdd = np.linalg.eigh(odd)
+    e = valEven.shape[-1]
+    eigvec = np.zeros(matrix.shape)
+    eigvec[..., :m, :e] = vecEven[..., :m, :] / np.sqrt(2)
+    eigvec[..., N-m:, :e] = vecEven[..., m-1::-1, :] / np.sqrt(2)
+    if N % 2:
+        eigvec[..., m, :e] = vecEven[..., m, :]
+    eigvec[..., :m, e:] = vecOdd / np.sqrt(2)
+    eigvec[..., N-m:, e:] = -vecOdd[..., ::-1, :] / np.sqrt(2)
+    eigval = np.concatenate([valEven, valOdd], axis=-1)
+    order = np.argsort(eigval, axis=-1, kind='stable')
+    return np.take_along_axis(eigval, order, axis=-1), \
+        np.take_along_axis(eigvec, order[..., None, :], axis=-1)
+
+
+class SpectralPosterior(object):
+    """
+    Variational covariance Sigma = V.T @ V given by SpectralFactor.posterior()
+
+    Parameters
+    ----------
+    V: array
+        Factor of the variational covariance, with one row per eigenvalue
+        of K
+    logdet: float
+        Pseudo log-determinant of the variational covariance
+    factor: SpectralFactor
+        Kernel matrix K, if Sigma = (K^-1 + diag)^-1
+    diag: array
+        Diagonal added to the precision matrix
+    """
+    def __init__(self, V, logdet, factor=None, diag=None):
+        self.V = V
+        self.logdet = logdet
+        self.factor = factor
+        self.diag = diag
+
+    def variance(self):
+        """ Diagonal of Sigma """
+        return np.sum(self.V * self.V, axis=0)
+
+    def dot(self, b):
+        """ Sigma @ b, for b of shape (N,) or (N, m) """
+        return self.V.T @ (self.V @ b)
+
+    def covariance(self):
+        """ Sigma as a N x N array """
+        return self.V.T @ self.V
+
+
+##### Semi-separable factorization #############################################
+def _semiseparableFactor(U, V, Phi, a):
+    """
+    LDL factorization of A = K + diag(a - K_nn), for a kernel matrix with
+    the semi-separable form K_nm = U.T Phi_n ... Phi_m+1 V for n > m, as in
+    celerite (Foreman-Mackey et al. 2017). The factor L has the same form,
+    L_nm = U.T Phi_n ... Phi_m+1 W_m, and it costs O(N*J**3) operations.
+
+    Parameters
+    ----------
+    U, V: arrays
+        Vectors of size J of the semi-separable representation
+    Phi: array
+        Transitions between consecutive times, shape (N-1, J, J)
+    a: array
+        Diagonal of A
+
+    Returns
+    -------
+    d: array
+        Diagonal of D
+    W: array
+        Vectors W_m of the factor L, shape (N, J)
+    """
+    N, J = a.size, U.size
+    d, W = np.empty(N), np.empty((N, J))
+    S = np.zeros((J, J))
+    for n in range(N):
+        if n > 0:
+            S = Phi[n-1] @ (S + d[n-1]*np.outer(W[n-1], W[n-1])) @ Phi[n-1].T
+        SU = S @ U
+        d[n] = a[n] - U @ SU
+        if d[n] <= 0:
+            raise LinAlgError('Semi-separable matrix is not positive definite')
+        W[n] = (V - SU) / d[n]
+    return d, W
+
+
+def _semiseparableSolve(U, Phi, d, W, y):
+    """
+    Returns A^-1 y for a matrix factorized by _semiseparableFactor()
+
+    Parameters
+    ----------
+    U: array
+        Vector of size J of the semi-separable representation
+    Phi: array
+        Transitions between consecutive times, shape (N-1, J, J)
+    d, W: arrays
+        Factorization of A
+    y: array
+        Right-hand side, shape (N,) or (N, m)
+
+    Returns
+    -------
+    x: array
+        Solution of A x = y
+    """
+    N = d.size
+    z = np.array(y, dtype=float)
+    #forward substitution, L z = y
+    F = np.zeros((U.size,) + z.shape[1:])
+    for n in range(1, N):
+        F = Phi[n-1] @ (F + np.multiply.outer(W[n-1], z[n-1]))
+        z[n] -= U @ F
+    z /= d.reshape((N,) + (1,)*(z.ndim-1))
+    #backward substitution, L.T x = z
+    G = np.zeros_like(F)
+    for n in range(N-2, -1, -1):
+        G = Phi[n].T @ (G + np.multiply.outer(U, z[n+1]))
+        z[n] -= W[n] @ G
+    return z
+
+
+def _semiseparableInverse(U, Phi, d, W):
+    """
+    Returns the quasi-separable representation of A^-1 = L^-T D^-1 L^-1 for
+    a matrix factorized by _semiseparableFactor(), without building any
+    N x N matrix. The columns of L^-1 are (L^-1)_nm = -U.T h_nm, with
+    h_nm = M_n-1 ... M_m+1 f_m, f_m = Phi_m+1 W_m and M_k = Phi_k+1 - f_k U.T,
+    so that the lower triangle of A^-1 is (A^-1)_nm = left_n.T h_nm, with
+    left_n following from a backward recursion on a J x J matrix.
+
+    Parameters
+    ----------
+    U: array
+        Vector of size J of the semi-separable representation
+    Phi: array
+        Transitions between consecutive times, shape (N-1, J, J)
+    d, W: arrays
+        Factorization of A
+
+    Returns
+    -------
+    diag: array
+        Diagonal of A^-1
+    left: array
+        Vectors left_n, shape (N, J)
+    M: array
+        Transitions M_n, shape (N-1, J, J)
+    right: array
+        Vectors f_m, shape (N-1, J)
+    """
+    N = d.size
+    right = np.einsum('nij,nj->ni', Phi, W[:-1])
+    M = Phi - right[:, :, None] * U
+    diag, left = 1 / d, np.outer(-1 / d, U)
+    UU = np.outer(U, U)
+    R = UU / d[-1]
+    for m in range(N-2, -1, -1):
+        RF = R @ right[m]
+        diag[m] += right[m] @ RF
+        left[m] += M[m].T @ RF
+        R = UU / d[m] + M[m].T @ R @ M[m]
+    return diag, left, M, right
+
+
+def _quasiseparableTrace(A, B):
+    """
+    Returns tr(A B) for two symmetric matrices given by their quasi-separable
+    representations (diag, left, M, right), as returned by
+    _semiseparableInverse(), in O(N*J**3) operations
+
+    Parameters
+    ----------
+    A, B: tuples
+        Quasi-separable representations of the two matrices
+
+    Returns
+    -------
+    trace: float
+        Trace of A B
+    """
+    diagA, leftA, MA, rightA = A
+    diagB, leftB, MB, rightB = B
+    trace = diagA @ diagB
+    #H_n = sum over m < n of h_nm (h'_nm).T
+    H = np.zeros((leftA.shape[1], leftB.shape[1]))
+    for n in range(1, diagA.size):
+        H = MA[n-1] @ H @ MB[n-1].T + np.outer(rightA[n-1], rightB[n-1])
+        trace += 2 * leftA[n] @ H @ leftB[n]
+    return trace
+
+
+class SemiseparableFactor(object):
+    """
+    Kernel matrix of a kernel with a semi-separable representation, see
+    covFunction.semiseparable(). Solves, log-determinants and the diagonals
+    and the traces of the variational covariances cost O(N*J**3) operations
+    and O(N*J**2) memory instead of the O(N**3) and O(N**2) of SpectralFactor.
+
+    Parameters
+    ----------
+    time: array
+        Time coordinates, they do not need to be sorted
+    U, V: arrays
+        Vectors of size J of the semi-separable representation
+    transition: function
+        Returns the transitions Phi for an array of lags, shape (M, J, J)
+    white: float
+        Variance only on the diagonal of the kernel matrix
+    """
+    def __init__(self, time, U, V, transition, white=0.):
+        self.N = time.size
+        self.order = np.argsort(time, kind='mergesort')
+        self.U = np.array(U, dtype=float)
+        self.V = np.array(V, dtype=float)
+        self.Phi = transition(np.diff(time[self.order]))
+        #diagonal of the kernel matrix
+        self.kdiag = self.U @ self.V + white
+        self._d, self._W = _semiseparableFactor(self.U, self.V, self.Phi,
+                                                np.full(self.N, self.kdiag))
+        self.logdet = np.sum(np.log(self._d))
+        self._Kinv = None
+
+    def _inverse(self):
+        """ Quasi-separable representation of K^-1, in increasing times """
+        if self._Kinv is None:
+            self._Kinv = _semiseparableInverse(self.U, self.Phi,
+                                               self._d, self._W)
+        return self._Kinv
+
+    def _sort(self, x):
+        """ From the order of time to increasing times """
+        return x[self.order]
+
+    def _unsort(self, x):
+        """ From increasing times to the order of time """
+        out = np.empty_like(x)
+        out[self.order] = x
+        return out
+
+    def solve(self, y):
+        """
+        Returns K^-1 y
+
+        Parameters
+        ----------
+        y: array
+            Right-hand side, shape (N,) or (N, m)
+
+        Returns
+        -------
+        x: array
+            Solution of K x = y
+        """
+        x = _semiseparableSolve(self.U, self.Phi, self._d, self._W,
+                                self._sort(y))
+        return self._unsort(x)
+
+    def quadratic(self, x):
+        """
+        Returns x.T K^-1 x
+
+        Parameters
+        ----------
+        x: array
+            Vector of size N
+
+        Returns
+        -------
+        xKx: float
+            Quadratic form
+        """
+        return x @ self.solve(x)
+
+    def trace(self, posterior):
+        """
+        Returns tr(K^-1 Sigma) for a variational covariance given by
+        posterior(). For the posteriors of this kernel K^-1 Sigma is
+        I - diag Sigma, for those of other semi-separable kernels both K^-1
+        and Sigma are quasi-separable, and for spectral posteriors
+        Sigma = V.T @ V has a low rank.
+
+        Parameters
+        ----------
+        posterior: SpectralPosterior or SemiseparablePosterior
+            Variational covariance, as given by posterior()
+
+        Returns
+        -------
+        trace: float
+            Trace of K^-1 Sigma
+        """
+        if isinstance(posterior, SpectralPosterior):
+            return np.sum(posterior.V.T * self.solve(posterior.V.T))
+        if posterior.factor is self:
+            return self.N - posterior.diag @ posterior.variance()
+        if isinstance(posterior, SemiseparablePosterior) \
+                and np.array_equal(posterior.factor.order, self.order):
+            return _quasiseparableTrace(self._inverse(),
+                                        posterior._generators())
+        return np.trace(self.solve(posterior.covariance()))
+
+    def posterior(self, diag):
+        """
+        Returns the variational covariance (K^-1 + diag)^-1, written in the
+        form diag^-1 - diag^-1 (K + diag^-1)^-1 diag^-1, where K + diag^-1
+        is again semi-separable
+
+        Parameters
+        ----------
+        diag: array
+            Diagonal to add to the precision matrix, it should be positive
+
+        Returns
+        -------
+        posterior: SemiseparablePosterior
+            Variational covariance
+        """
+        return SemiseparablePosterior(self, diag)
+
+    def covariance(self, diag):
+        """
+        Returns the variational covariance (K^-1 + diag)^-1
+
+        Parameters
+        ----------
+        diag: array
+            Diagonal to add to the precision matrix
+
+        Returns
+        -------
+        sigma: array
+            Variational covariance matrix
+        """
+        return self.posterior(diag).covariance()
+
+
+class SemiseparablePosterior(object):
+    """
+    Variational covariance Sigma = (K^-1 + diag)^-1 given by
+    SemiseparableFactor.posterior()
+
+    Parameters
+    ----------
+    factor: SemiseparableFactor
+        Kernel matrix K
+    diag: array
+        Diagonal added to the precision matrix
+    """
+    def __init__(self, factor, diag):
+        self.factor = factor
+        self.diag = diag
+        self._dinv = factor._sort(1 / diag)
+        #factorization of A = K + diag^-1
+        self._d, self._W = _semiseparableFactor(factor.U, factor.V,
+                                                factor.Phi,
+                                                factor.kdiag + self._dinv)
+        #|Sigma| = |K| / (|A| |diag|)
+        self.logdet = factor.logdet - np.sum(np.log(self._d)) \
+                        - np.sum(np.log(diag))
+        self._Ainv = None
+
+    def _generators(self):
+        """
+        Quasi-separable representation of Sigma, in increasing times, from
+        the one of A^-1 and Sigma = diag^-1 - diag^-1 A^-1 diag^-1
+        """
+        if self._Ainv is None:
+            self._Ainv = _semiseparableInverse(self.factor.U, self.factor.Phi,
+                                               self._d, self._W)
+        diag, left, M, right = self._Ainv
+        dinv = self._dinv
+        return (dinv - dinv**2 * diag, -dinv[:, None] * left, M,
+                dinv[:-1, None] * right)
+
+    def variance(self):
+        """ Diagonal of Sigma """
+        return self.factor._unsort(self._generators()[0])
+
+    def dot(self, b):
+        """ Sigma @ b, for b of shape (N,) or (N, m) """
+        dinv = self._dinv.reshape((-1,) + (1,)*(np.ndim(b)-1))
+        x = dinv * self.factor._sort(b)
+        x = x - dinv * _semiseparableSolve(self.factor.U, self.factor.Phi,
+                                           self._d, self._W, x)
+        return self.factor._unsort(x)
+
+    def covariance(self):
+        """ Sigma as a N x N array """
+        return self.dot(np.identity(self.factor.N))
+
+
+##### Banded factorization #####################################################
+def bandedLags(time, support):
+    """
+    Returns the lags t_{j+k} - t_j between each time t_j and the k = 0..b
+    following times within the support of a kernel, in increasing times.
+    Evaluating the kernel on them gives the lower banded storage of its
+    kernel matrix used by BandedFactor.
+
+    Parameters
+    ----------
+    time: array
+        Time coordinates, they do not need to be sorted
+    support: float
+        Radius of the compact support of the kernel
+
+    Returns
+    -------
+    order: array
+        Indices that sort the times
+    lags: array
+        Lags t_{j+k} - t_j, shape (b+1, N), 0 where j+k >= N
+    valid: array
+        False where j+k >= N
+    """
+    order = np.argsort(time, kind='mergesort')
+    sortedTime = time[order]
+    N = time.size
+    #number of later times within the support of each time
+    later = np.searchsorted(sortedTime, sortedTime + support, 'right')
+    b = int(np.max(later - np.arange(N))) - 1 if N else 0
+    k = np.arange(b + 1)[:, None]
+    j = np.arange(N)[None, :]
+    valid = j + k < N
+    lags = np.where(valid, sortedTime[np.minimum(j + k, N - 1)] - sortedTime,
+                    0.)
+    return order, lags, valid
+
+
+def _bandedInverseDiagonal(C):
+    """
+    Diagonal of A^-1 from the banded Cholesky factor C of A, computed with
+    the recursion of Takahashi et al. (1973), which only needs the entries of
+    A^-1 inside the band: O(N*b**2) operations instead of O(N**3)
+    """
+    b, N = C.shape[0] - 1, C.shape[1]
+    #entries of A^-1 between times j+1..j+b+1, the next ones are zero
+    window = np.zeros((b + 1, b + 1))
+    diag = np.empty(N)
+    for j in range(N - 1, -1, -1):
+        l = C[1:, j] / C[0, j]
+        z = -window[:b, :b] @ l
+        window[1:, 1:] = window[:b, :b].copy()
+        window[0, 0] = 1 / C[0, j]**2 - l @ z
+        window[1:, 0] = z
+        window[0, 1:] = z
+        diag[j] = window[0, 0]
+    return diag
+
+
+class BandedFactor(object):
+    """
+    Kernel matrix of a kernel with compact support, see covFunction.support(),
+    which is banded in increasing times. Solves, log-determinants and the
+    diagonals of the variational covariances cost O(N*b**2) operations and
+    O(N*b) memory, for b times within the support of each time, instead of
+    the O(N**3) and O(N**2) of SpectralFactor.
+
+    Parameters
+    ----------
+    order: array
+        Indices that sort the times, as given by bandedLags()
+    band: array
+        Lower banded storage of the kernel matrix in increasing times,
+        band[k, j] = K[j+k, j], shape (b+1, N)
+    """
+    def __init__(self, order, band):
+        self.N = order.size
+        self.order = order
+        self.band = band
+        self._C = cholesky_banded(band, lower=True)
+        self.logdet = 2 * np.sum(np.log(self._C[0]))
+
+    def _sort(self, x):
+        """ From the order of time to increasing times """
+        return x[self.order]
+
+    def _unsort(self, x):
+        """ From increasing times to the order of time """
+        out = np.empty_like(x)
+        out[self.order] = x
+        return out
+
+    def solve(self, y):
+        """
+        Returns K^-1 y
+
+        Parameters
+        ----------
+        y: array
+            Right-hand side, shape (N,) or (N, m)
+
+        Returns
+        -------
+        x: array
+            Solution of K x = y
+        """
+        return self._unsort(cho_solve_banded((self._C, True), self._sort(y)))
+
+    def quadratic(self, x):
+        """
+        Returns x.T K^-1 x
+
+        Parameters
+        ----------
+        x: array
+            Vector of size N
+
+        Returns
+        -------
+        xKx: float
+            Quadratic form
+        """
+        return x @ self.solve(x)
+
+    def trace(self, posterior):
+        """
+        Returns tr(K^-1 Sigma) for a variational covariance given by
+        posterior(). For the posteriors of this kernel K^-1 Sigma is
+        I - diag Sigma, for spectral posteriors Sigma = V.T @ V has a low
+        rank, and the other ones are built with O(N**2*b) operations.
+
+        Parameters
+        ----------
+        posterior: SpectralPosterior, SemiseparablePosterior or
+            BandedPosterior
+            Variational covariance, as given by posterior()
+
+        Returns
+        -------
+        trace: float
+            Trace of K^-1 Sigma
+        """
+        if isinstance(posterior, SpectralPosterior):
+            return np.sum(posterior.V.T * self.solve(posterior.V.T))
+        if posterior.factor is self:
+            return self.N - posterior.diag @ posterior.variance()
+        return np.trace(self.solve(posterior.covariance()))
+
+    def posterior(self, diag):
+        """
+        Returns the variational covariance (K^-1 + diag)^-1, written in the
+        form diag^-1 - diag^-1 (K + diag^-1)^-1 diag^-1, where K + diag^-1
+        is again banded
+
+        Parameters
+        ----------
+        diag: array
+            Diagonal to add to the precision matrix, it should be positive
+
+        Returns
+        -------
+        posterior: BandedPosterior
+            Variational covariance
+        """
+        return BandedPosterior(self, diag)
+
+    def covariance(self, diag):
+        """
+        Returns the variational covariance (K^-1 + diag)^-1
+
+        Parameters
+        ----------
+        diag: array
+            Diagonal to add to the precision matrix
+
+        Returns
+        -------
+        sigma: array
+            Variational covariance matrix
+        """
+        return self.posterior(diag).covariance()
+
+
+class BandedPosterior(object):
+    """
+    Variational covariance Sigma = (K^-1 + diag)^-1 given by
+    BandedFactor.posterior()
+
+    Parameters
+    ----------
+    factor: BandedFactor
+        Kernel matrix K
+    diag: array
+        Diagonal added to the precision matrix
+    """
+    def __init__(self, factor, diag):
+        self.factor = factor
+        self.diag = diag
+        self._dinv = factor._sort(1 / diag)
+        #banded factorization of A = K + diag^-1
+        A = factor.band.copy()
+        A[0] += self._dinv
+        self._C = cholesky_banded(A, lower=True, overwrite_ab=True)
+        #|Sigma| = |K| / (|A| |diag|)
+        self.logdet = factor.logdet - 2*np.sum(np.log(self._C[0])) \
+                        - np.sum(np.log(diag))
+        self._variance = None
+
+    def variance(self):
+        """ Diagonal of Sigma """
+        if self._variance is None:
+            dinv = self._dinv
+            self._variance = self.factor._unsort(
+                dinv - dinv**2 * _bandedInverseDiagonal(self._C))
+        return self._variance
+
+    def dot(self, b):
+        """ Sigma @ b, for b of shape (N,) or (N, m) """
+        dinv = self._dinv.reshape((-1,) + (1,)*(np.ndim(b)-1))
+        x = dinv * self.factor._sort(b)
+        x = x - dinv * cho_solve_banded((self._C, True), x)
+        return self.factor._unsort(x)
+
+    def covariance(self):
+        """ Sigma as a N x N array """
+        return self.dot(np.identity(self.factor.N))
+
+
+##### Batched posteriors #######################################################
+def _stackedPosteriors(factors, diags, map=map):
+    """
+    Same as SpectralFactor.posteriors() for different SpectralFactor, e.g.
+    of nodes or weights with different kernels: the matrices I + L.T diag L
+    of all of them are built and factorized in stacked calls. The factors L
+    of lower rank are padded with columns of zeros, which only add an
+    identity block to I + L.T diag L, so the padded rows of the solves are
+    dropped and the log-determinants are unchanged.
+
+    Parameters
+    ----------
+    factors: list
+        SpectralFactor of each member, of rank > 0
+    diags: array
+        Diagonal of each member, shape (B, N)
+    map: callable
+        Used to apply the triangular solves to the members
+
+    Returns
+    -------
+    posteriors: list
+        SpectralPosterior of each member
+    """
+    ranks = [factor.rank for factor in factors]
+    rank = max(ranks)
+    L = np.zeros((len(factors), factors[0].N, rank),
+                 np.result_type(*[factor.L for factor in factors]))
+    for Lb, factor in zip(L, factors):
+        Lb[:, :factor.rank] = factor.L
+    B = (np.swapaxes(L, 1, 2) * diags[:, None, :].astype(L.dtype)) @ L
+    B[:, np.arange(rank), np.arange(rank)] += 1
+    C = np.linalg.cholesky(B)
+    V = map(lambda Cb, Lb, r: solve_triangular(Cb[:r, :r], Lb[:, :r].T,
+                                               lower=True), C, L, ranks)
+    logdet = np.array([factor.logdet for factor in factors]) \
+                - 2*np.sum(np.log(np.diagonal(C, 0, 1, 2)), axis=1,
+                           dtype=float)
+    return [SpectralPosterior(Vb, l, factor, d)
+            for Vb, l, factor, d in zip(V, logdet, factors, diags)]
+
+
+def posteriors(factors, diags, map=map):
+    """
+    Returns factors[b].posterior(diags[b]) for every b. The members with a
+    SpectralFactor compute their posteriors together in stacked calls, with
+    SpectralFactor.posteriors() when they all share the factor, e.g. weights
+    sharing a kernel, and with _stackedPosteriors() when their kernels
+    differ. The SemiseparableFactor and BandedFactor are computed one by
+    one.
+
+    Parameters
+    ----------
+    factors: list
+        SpectralFactor, SemiseparableFactor or BandedFactor of each member
+    diags: array
+        Diagonal of each member, shape (B, N)
+    map: callable
+        Used to apply the independent computations to the members, e.g.
+        BlockExecutor.map. Default: the built-in map
+
+    Returns
+    -------
+    posteriors: list
+        Variational covariance of each member
+    """
+    result = [None] * len(factors)
+    groups = OrderedDict()
+    for b, factor in enumerate(factors):
+        if isinstance(factor, SpectralFactor) and factor.rank > 0:
+            key = SpectralFactor
+        else:
+            key = id(factor)
+        groups.setdefault(key, []).append(b)
+    for members in groups.values():
+        group = [factors[b] for b in members]
+        diag = np.asarray([diags[b] for b in members])
+        if not isinstance(group[0], SpectralFactor):
+            batch = map(group[0].posterior, diag)
+        elif all(factor is group[0] for factor in group):
+            batch = group[0].posteriors(diag, map)
+        else:
+            batch = _stackedPosteriors(group, diag, map)
+        for b, posterior in zip(members, batch):
+            result[b] = posterior
+    return result
+
+
+class BlockExecutor(object):
+    """
+    Evaluates a function on independent blocks, e.g. the nodes or weights of
+    the variational updates, one after the other or concurrently in a pool
+    of threads. NumPy and LAPACK release the GIL, so the threads factorize
+    different blocks on different cores, which works best with a
+    single-threaded BLAS. The results are returned in the order of the
+    blocks and are added by the callers in that order, so they do not depend
+    on the number of workers.
+
+    Parameters
+    ----------
+    workers: int
+        Number of threads, None or 1 to evaluate the blocks in the calling
+        thread
+    """
+    def __init__(self, workers=None):
+        self.workers = workers
+        self._pool = None
+
+    def __getstate__(self):
+        #the pool of threads can not be pickled, it is created again
+        return {'workers': self.workers, '_pool': None}
+
+    def map(self, function, *blocks):
+        """ Returns the list of function(*block) for each block """
+        if self.workers is None or self.workers <= 1:
+            return list(map(function, *blocks))
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(self.workers)
+        return list(self._pool.map(function, *blocks))
+
+
+##### Inducing points #########################################################
+class InducingFactor(object):
+    """
+    Projection of a kernel on a set of M inducing points z. With
+    K(z, z) = L @ L.T, the values of a latent function at the observations
+    are g = A.T @ v + e, where v ~ N(0, I) are the whitened values at the
+    inducing points, A = L^-1 K(z, time) and e is independent noise of
+    variance residual = diag(K(time, time)) - diag(A.T @ A). The
+    variational distributions q(v) = N(m, S) then cost O(N*M**2) operations
+    and O(M**2) memory instead of O(N**3) and O(N**2).
+
+    Parameters
+    ----------
+    L: array
+        Lower triangular Cholesky factor of the M x M kernel matrix of the
+        inducing points
+    Kzx: array
+        M x N covariance between the inducing points and the observations
+    kdiag: array
+        Diagonal of the kernel matrix of the observations
+    """
+    def __init__(self, L, Kzx, kdiag):
+        self.L = L
+        self.M = L.shape[0]
+        self.A, self.residual = self.project(Kzx, kdiag)
+
+    def project(self, Kzx, kdiag):
+        """
+        Returns the projection of a set of times on the inducing points
+
+        Parameters
+        ----------
+        Kzx: array
+            Covariance between the inducing points and the times, M x T
+        kdiag: array
+            Diagonal of the kernel matrix of the times
+
+        Returns
+        -------
+        A: array
+            M x T array L^-1 Kzx
+        residual: array
+            Variances that are not explained by the inducing points
+        """
+        A = solve_triangular(self.L, Kzx, lower=True)
+        return A, np.maximum(kdiag - np.sum(A*A, axis=0), 0)
+
+    def posterior(self, diag, b):
+        """
+        Returns the q(v) = N(m, S) maximizing -0.5*E[g.T diag g] + b.T E[g]
+        minus the KL divergence from the prior N(0, I), that is
+        S = (I + A diag A.T)^-1 and m = S A b
+
+        Parameters
+        ----------
+        diag: array
+            Precision added at each observation
+        b: array
+            Linear term at each observation
+
+        Returns
+        -------
+        m: array
+            Whitened variational mean, size M
+        S: array
+            Whitened variational covariance, M x M
+        """
+        B = np.identity(self.M) + (self.A * diag) @ self.A.T
+        C = cholesky(B, lower=True, overwrite_a=True)
+        S = cho_solve((C, True), np.identity(self.M))
+        return S @ (self.A @ b), S
+
+    def step(self, diag, b, m, S, rho):
+        """
+        Returns the natural-gradient step of size rho from q(v) = N(m, S)
+        towards posterior(diag, b), that is the distribution whose natural
+        parameters S^-1 m and S^-1 are the weighted averages of those of
+        the two, as in stochastic variational inference (Hoffman et al. 2013)
+
+        Parameters
+        ----------
+        diag: array
+            Precision added at each observation
+        b: array
+            Linear term at each observation
+        m: array
+            Current whitened variational mean
+        S: array
+            Current whitened variational covariance
+        rho: float
+            Step size, between 0 and 1
+
+        Returns
+        -------
+        m: array
+            New whitened variational mean
+        S: array
+            New whitened variational covariance
+        """
+        if rho == 1:
+            return self.posterior(diag, b)
+        I = np.identity(self.M)
+        P = cho_solve((cholesky(S, lower=True), True), I)
+        theta = (1-rho) * (P @ m) + rho * (self.A @ b)
+        P = (1-rho) * P + rho * (I + (self.A * diag) @ self.A.T)
+        S = cho_solve((cholesky(P, lower=True), True), I)
+        return S @ theta, S
+
+    def marginals(self, m, S, A=None, residual=None):
+        """
+        Returns the means and variances of g at the observations, or at the
+        times of a projection given by project()
+
+        Parameters
+        ----------
+        m: array
+            Whitened variational mean
+        S: array
+            Whitened variational covariance
+        A, residual: arrays
+            Projection of other times, by default the observations
+
+        Returns
+        -------
+        mean: array
+            Means of g
+        var: array
+            Variances of g
+        """
+        if A is None:
+            A, residual = self.A, self.residual
+        return A.T @ m, residual + np.sum(A * (S @ A), axis=0)
+
+
+##### Diagonal storage #########################################################
+class DiagonalCovariance(object):
+    """
+    Stack of variational covariances of which only the diagonals, the
+    log-determinants and the traces against the prior kernels are kept
+
+    Parameters
+    ----------
+    diag: array
+        Diagonals of the covariances, shape (..., N), they are kept in
+        float64 even for float32 covariances
+    logdet: array
+        Log-determinants of the covariances, shape (...)
+    trace: array
+        Traces tr(K^-1 Sigma) entering the expected log prior, shape (...)
+    """
+    def __init__(self, diag, logdet, trace):
+        self.diag = np.array(diag, dtype=float)
+        self.logdet = np.array(logdet)
+        self.trace = np.array(trace)
+
+    @property
+    def shape(self):
+        """ Shape of the stack of full covariances it stands for """
+        return self.diag.shape + self.diag.shape[-1:]
+
+
+class DenseCovariance(DiagonalCovariance):
+    """
+    Stack of full variational covariances that also keeps, as
+    DiagonalCovariance, their log-determinants and traces against the prior
+    kernels computed with the factorizations that built them. It is indexed
+    and converted to an array as the stack of covariance matrices.
+
+    Parameters
+    ----------
+    matrix: array
+        Covariance matrices, shape (..., N, N)
+    logdet: array
+        Log-determinants of the covariances, shape (...)
+    trace: array
+        Traces tr(K^-1 Sigma) entering the expected log prior, shape (...)
+    """
+    def __init__(self, matrix, logdet, trace):
+        self.matrix = np.array(matrix)
+        super(DenseCovariance, self).__init__(
+            np.diagonal(self.matrix, 0, -2, -1), logdet, trace)
+
+    def __getitem__(self, index):
+        return self.matrix[index]
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.matrix, dtype)
+
+
+def covarianceDiagonal(sigma):
+    """
+    Returns the diagonals of a stack of covariance matrices, stored either as
+    dense arrays or as a DiagonalCovariance
+
+    Parameters
+    ----------
+    sigma: array or DiagonalCovariance
+        Stack of covariance matrices
+
+    Returns
+    -------
+    diag: array
+        Diagonals of the covariances
+    """
+    if isinstance(sigma, DiagonalCovariance):
+        return sigma.diag
+    return np.diagonal(sigma, axis1=-2, axis2=-1)
+
+
+##### Fixed-point acceleration #################################################
+def squarem(step, state, feasible=None):
+    """
+    One cycle of the SQUAREM extrapolation (Varadhan & Roland 2008) of a
+    fixed-point iteration state = step(state) that increases an objective.
+    The extrapolation uses the directions of two plain steps, and is pulled
+    back towards the second step until it is feasible. One more step is
+    taken from the extrapolated state. If that step fails or lowers the
+    objective, the result of the two plain steps is kept.
+
+    Parameters
+    ----------
+    step: callable
+        Returns the objective at the new state and the new state, a list of
+        arrays
+    state: list
+        Arrays of the current state, reshaped to those returned by step
+    feasible: callable
+        Returns False if an extrapolated state is not valid, e.g. has
+        negative variances. Default: every state is valid
+
+    Returns
+    -------
+    objective: float
+        Objective at the new state
+    state: list
+        New state
+    """
+    _, state1 = step(state)
+    objective2, state2 = step(state1)
+    state = [np.reshape(s0, s1.shape) for s0, s1 in zip(state, state1)]
+    r = [s1 - s0 for s0, s1 in zip(state, state1)]
+    v = [s2 - s1 - ri for s1, s2, ri in zip(state1, state2, r)]
+    normR = np.sqrt(sum(np.sum(ri**2) for ri in r))
+    normV = np.sqrt(sum(np.sum(vi**2) for vi in v))
+    if normV == 0:
+        return objective2, state2
+    #steplength, alpha = -1 gives the second plain step
+    alpha = min(-normR / normV, -1.)
+    for _ in range(10):
+        extrapolated = [s0 - 2*alpha*ri + alpha**2*vi
+                        for s0, ri, vi in zip(state, r, v)]
+        if feasible is None or feasible(extrapolated):
+            break
+        alpha = (alpha - 1) / 2
+    else:
+        return objective2, state2
+    try:
+        objective, new_state = step(extrapolated)
+    except LinAlgError:
+        return objective2, state2
+    if not objective >= objective2:
+        return objective2, state2
+    return objective, new_state
+
+
+### END
@@ -2,10 +2,21 @@
     Mean-field inference
 """
 import numpy as np
-from scipy.linalg import cholesky, LinAlgError
+from scipy.linalg import cho_solve, solve_triangular, LinAlgError
 from scipy.stats import multivariate_normal
 from gprn.covFunction import Linear as covL
 from gprn.covFunction import Polynomial as covP
+from gprn.covFunction import Lags
+from gprn.linearAlgebra import LRUCache, SpectralFactor, kernelKey
+from gprn.linearAlgebra import spectralFactors
+from gprn.linearAlgebra import BufferPool
+from gprn.linearAlgebra import WarmStartCache, squarem
+from gprn.linearAlgebra import posteriors, BlockExecutor
+from gprn.linearAlgebra import SemiseparableFactor
+from gprn.linearAlgebra import DiagonalCovariance, covarianceDiagonal
+from gprn.linearAlgebra import DenseCovariance
+from gprn.linearAlgebra import cholNugget, CholeskyTelemetry
+from gprn.linearAlgebra import BandedFactor, bandedLags
 #np.random.seed(23011990)
 
 class inference(object):
@@ -22,8 +33,50 @@ class inference(object):
     *args: arrays
         The actual data (or components), it needs be given in order of data1,
         data1error, data2, data2error, etc...
+    storage: str
+        'dense' to keep the full variational covariance matrices, 'diagonal'
+        to keep only their diagonals, log-determinants and traces, which
+        avoids storing q*p*N*N numbers for the weights
+    cacheSize: int
+        Maximum number of kernel matrices and factorizations kept in memory,
+        by default enough for one set of hyperparameters
+    backend: str
+        How the kernel matrices are factorized in the variational updates:
+        'dense' uses their eigendecompositions, 'semiseparable' uses the
+        O(N) semi-separable representations of the kernels (only kernels
+        with an exact one, see covFunction.semiseparable()), 'banded' uses
+        the banded matrices of the kernels with compact support (see
+        covFunction.support()) and 'auto' uses the semi-separable or banded
+        ones when every kernel of the model has one of them and there are at
+        least semiseparableSize observations. All of them give the same
+        ELBO up to round-off
+    warmStart: int
+        Number of converged variational parameters kept for the last
+        hyperparameters given to optVarParams(), which then starts from
+        those of the closest hyperparameters instead of at random when no mu
+        and var are given, e.g. when sampling the hyperparameters with an
+        MCMC. Default: None, always start at random
+    workers: int
+        Number of threads evaluating the independent blocks of the nodes and
+        weights concurrently, see linearAlgebra.BlockExecutor. Default: None,
+        one block after the other
+    precision: str
+        'double' to compute everything in float64, 'single' to keep the
+        kernel matrices and the lags in float32 and to compute the
+        variational updates in float32: the factors L of the kernel matrices,
+        the Cholesky factorizations and triangular solves of every update and
+        the full variational covariances, which halves their memory. The
+        eigendecomposition of each kernel matrix, done once per set of
+        hyperparameters, the log-determinants and the sums of the ELBO stay
+        in float64, as do the semi-separable and banded backends
     """
-    def __init__(self, num_nodes, time, *args):
+    #number of observations from which backend='auto' may choose the
+    #semi-separable factorizations
+    semiseparableSize = 500
+
+    def __init__(self, num_nodes, time, *args, storage='dense',
+                 cacheSize=None, backend='auto', warmStart=None,
+                 workers=None, precision='double'):
         #number of node functions; f(x) in Wilson et al. (2012)
         self.num_nodes = num_nodes
         self.q = num_nodes
@@ -52,6 +105,42 @@ class inference(object):
         self.y = np.array(ys).reshape(self.p, self.N) #matrix p*N of outputs
         self.yerr = np.array(yerrs).reshape(self.p, self.N) #matrix p*N of errors
         self.yerr2 = self.yerr**2
+        #precision of the kernel matrices and the variational covariances
+        assert precision in ('double', 'single'), \
+        "precision should be 'double' or 'single'"
+        self.precision = precision
+        self.dtype = np.float32 if precision == 'single' else float
+        #lags between the observations and the distance features built
+        #from them, shared by every kernel evaluated on self.time
+        self._lags = Lags((time[:, None] - time[None, :]).astype(self.dtype))
+        #on times symmetric about their midpoint, e.g. evenly spaced ones
+        #where they are symmetric Toeplitz, the matrices of the stationary
+        #kernels are centrosymmetric and decomposed as two halves
+        self._centrosymmetric = np.allclose(time + time[::-1],
+                                            time[0] + time[-1], rtol=0,
+                                            atol=1e-12 * np.ptp(time))
+        #how the variational covariances are stored
+        assert storage in ('dense', 'diagonal'), \
+        "storage should be 'dense' or 'diagonal'"
+        self.storage = storage
+        #kernel matrices and their factorizations, the matrices of each node
+        #and weight, their Cholesky factors and eigendecompositions
+        if cacheSize is None:
+            cacheSize = 3 * self.q * (self.p + 1)
+        self._cache = LRUCache(cacheSize, discard=self._discard)
+        #work arrays for the kernel matrices of the nodes and weights, the
+        #matrices dropped by the cache are used again for new hyperparameters
+        self._pool = BufferPool(self.q * (self.p + 1) + 2)
+        assert backend in ('auto', 'dense', 'semiseparable', 'banded'), \
+        "backend should be 'auto', 'dense', 'semiseparable' or 'banded'"
+        self.backend = backend
+        #converged variational parameters of the last hyperparameters
+        self._warmStart = WarmStartCache(warmStart) if warmStart else None
+        #evaluation of the independent nodes and weights
+        self._executor = BlockExecutor(workers)
+        #how often the Cholesky factorizations needed a nugget, and the
+        #eigendecompositions raised eigenvalues to their floor
+        self.telemetry = CholeskyTelemetry()
         #check if the input was correct
         assert int((len(args)+1)/2) == self.p, \
         'Given data and number of components dont match'
@@ -91,13 +180,17 @@ class inference(object):
 
 
 ##### To create matrices and samples ###########################################
-    def _kernelMatrix(self, kernel, time=None):
+    def _kernelMatrix(self, kernel, time=None, dtype=None):
         """
         Returns the covariance matrix created by evaluating a given kernel 
         at inputs time
 
         Parameters
         ----------
+        dtype: data-type
+            Type of the matrix, by default self.dtype. Matrices of another
+            type, e.g. the float64 ones factorized in single precision, are
+            not cached
 
         Returns
         -------
@@ -106,16 +199,54 @@ class inference(object):
         """
         if time is None:
             time = self.time
-        r = time[:, None] - time[None, :]
+        if dtype is None:
+            dtype = self.dtype
+        cache = dtype == self.dtype
+        key = ('K', kernelKey(kernel), id(time))
+        cached = self._cache.get(key) if cache else None
+        if cached is not None:
+            return cached[1]
+        if time is self.time and cache:
+            r = self._lags
+        else:
+            r = Lags(time[:, None] - time[None, :])
         #to deal with the non-stationary kernels problem
         if isinstance(kernel, (covL, covP)):
-            K = kernel(None, time[:, None], time[None, :])
+            K = np.asarray(kernel(None, time[:, None], time[None, :]), dtype)
         else:
-            K = kernel(r) #+ 1e-6*np.diag(np.diag(np.ones_like(r)))
-        K[np.abs(K)<1e-15] = 0.
+            out = self._pool.take(r.shape, dtype) if cache else None
+            K = kernel.compile()(r, out=out, pool=self._pool)
+            #the same jitter as the complete engines, so that every
+            #factorization of K has its full rank
+            K.flat[::time.size+1] += 1e-6
+        self._threshold(K, 1e-15)
+        if not cache:
+            return K
+        #cached matrices are shared, so they should not be changed in place;
+        #the time array is kept too so that its id is not reused
+        K.flags.writeable = False
+        self._cache[key] = (time, K)
         return K
 
 
+    def _discard(self, key, value):
+        """
+        Gives the kernel matrices dropped by the cache back to the pool of
+        work arrays, see linearAlgebra.LRUCache
+        """
+        if key[0] == 'K':
+            self._pool.release(value[1])
+
+
+    def _threshold(self, K, tol):
+        """
+        Sets to zero, in place, the entries of a kernel matrix below tol
+        """
+        work = self._pool.take(K.shape, K.dtype)
+        K[np.abs(K, out=work)<tol] = 0.
+        self._pool.release(work, now=True)
+
+
     def _predictKMatrix(self, kernel, time):
         """
         To be used in predict_gp()
@@ -128,17 +259,40 @@ class inference(object):
         K: array
             Matrix of a covariance function
         """
+        time = np.atleast_1d(time)
         if isinstance(kernel, (covL, covP)):
-            K = kernel(None, time, self.time[None, :])
+            K = kernel(None, time[:, None], self.time[None, :])
         else:
-            if time.size == 1:
-                r = time - self.time[None, :]
-            else:
-                r = time[:,None] - self.time[None,:]
-            K = kernel(r) 
+            r = time[:, None] - self.time[None, :]
+            #white noise never enters a cross-covariance, even when there
+            #are as many times as observations and r is square
+            cross = np.zeros(r.shape, dtype=bool)
+            K = kernel.compile()(Lags(r, diagonal=cross))
         return K
 
 
+    def _kernelDiagonal(self, kernel, time):
+        """
+        Returns the diagonal of the covariance matrix of a given kernel at
+        inputs time, without building the matrix
+
+        Parameters
+        ----------
+        kernel: covFunction
+            Covariance function
+        time: array
+            Time coordinates
+
+        Returns
+        -------
+        kdiag: array
+            Variances of the covariance function
+        """
+        if isinstance(kernel, (covL, covP)):
+            return kernel(None, time, time)
+        return kernel(Lags(np.zeros((time.size, 1)))).reshape(time.size)
+
+
     def _u_to_fhatW(self, u):
         """
         Given an array of values, divides it in the corresponding nodes (f hat)
@@ -160,10 +314,29 @@ class inference(object):
         return f, w
 
 
+    def _weightBlocks(self):
+        """
+        Returns the indices j of the node and i of the output of each weight,
+        with the weights of each node together, as they are added in the
+        expected log prior and the entropy
+
+        Returns
+        -------
+        j: list
+            Node of each weight
+        i: list
+            Output of each weight
+        """
+        j = [j for j in range(self.q) for _ in range(self.p)]
+        i = [i for _ in range(self.q) for i in range(self.p)]
+        return j, i
+
+
     def _cholNugget(self, matrix, maximum=10):
         """
         Returns the cholesky decomposition to a given matrix, if it is not
-        positive definite, a nugget is added to its diagonal.
+        positive definite, a nugget is added to its diagonal. The
+        factorization is recorded in self.telemetry.
 
         Parameters
         ----------
@@ -177,25 +350,197 @@ class inference(object):
         L: array
             Matrix containing the Cholesky factor
         nugget: float
-            Nugget added to the diagonal
-        """
-        nugget = 0 #our nugget starts as zero
-        try:
-            nugget += np.abs(np.diag(matrix).mean()) * 1e-5
-            L = cholesky(matrix, lower=True, overwrite_a=True)
-            return L, nugget
-        except LinAlgError:
-            n = 0 #number of tries
-            while n < maximum:
-                try:
-                    L = cholesky(matrix + nugget*np.identity(matrix.shape[0]),
-                                 lower=True, overwrite_a=True)
-                    return L, nugget
-                except LinAlgError:
-                    nugget *= 10.0
-                finally:
-                    n += 1
-            raise LinAlgError("Not positive definite, even with nugget.")
+            Nugget added to the diagonal, 0 if none was needed
+        """
+        #in single precision the factorization is still done in float64
+        return cholNugget(np.asarray(matrix, float), maximum, self.telemetry)
+
+
+    def _kernelCholesky(self, kernel):
+        """
+        Returns the Cholesky factor of the kernel matrix of a given kernel, 
+        computed with _cholNugget() and cached on the kernel parameters
+
+        Parameters
+        ----------
+        kernel: covFunction
+            Covariance function
+
+        Returns
+        -------
+        L: array
+            Lower triangular Cholesky factor
+        """
+        key = ('L', kernelKey(kernel), id(self.time))
+        L = self._cache.get(key)
+        if L is None:
+            L = self._cholNugget(self._kernelMatrix(kernel, self.time,
+                                                    float))[0]
+            L.flags.writeable = False
+            self._cache[key] = L
+        return L
+
+
+    def _spectralFactor(self, kernel):
+        """
+        Returns the eigendecomposition of the kernel matrix of a given kernel.
+        It only depends on the kernel parameters, so it is computed once and
+        reused in all iterations of optVarParams().
+
+        Parameters
+        ----------
+        kernel: covFunction
+            Covariance function
+
+        Returns
+        -------
+        factor: SpectralFactor
+            Eigendecomposition of the kernel matrix
+        """
+        key = ('spectral', kernelKey(kernel), id(self.time))
+        factor = self._cache.get(key)
+        if factor is None:
+            centrosymmetric = self._centrosymmetric \
+                and not isinstance(kernel, (covL, covP))
+            #the matrix is decomposed in float64 in single precision too,
+            #only the factor used by the updates is kept in self.dtype
+            K = self._kernelMatrix(kernel, self.time, float)
+            factor = SpectralFactor(K, centrosymmetric=centrosymmetric,
+                                    dtype=self.dtype,
+                                    telemetry=self.telemetry)
+            self._cache[key] = factor
+        return factor
+
+
+    def _semiseparable(self, kernels):
+        """
+        Returns True if the kernel matrices of a model are to be factorized
+        with their semi-separable or banded representations, see the backend
+        argument
+
+        Parameters
+        ----------
+        kernels: list
+            Covariance functions of the nodes and weights
+
+        Returns
+        -------
+        semiseparable: bool
+            True to use SemiseparableFactor or BandedFactor, False to use
+            SpectralFactor
+        """
+        if self.backend == 'dense':
+            return False
+        if self.backend == 'banded':
+            for kernel in kernels:
+                if not np.isfinite(kernel.support()):
+                    raise ValueError('{0} has no compact '
+                                     'support'.format(kernel))
+            return True
+        if self.backend == 'semiseparable':
+            for kernel in kernels:
+                if kernel.semiseparable() is None:
+                    raise ValueError('{0} has no semi-separable '
+                                     'representation'.format(kernel))
+            return True
+        return self.N >= self.semiseparableSize \
+            and all(kernel.semiseparable() is not None
+                    or np.isfinite(kernel.support()) for kernel in kernels)
+
+
+    def _bandedFactor(self, kernel):
+        """
+        Returns the banded factorization of the kernel matrix of a kernel
+        with compact support, built from the kernel evaluated only inside its
+        support, or its eigendecomposition if the banded matrix is not
+        numerically positive definite
+
+        Parameters
+        ----------
+        kernel: covFunction
+            Covariance function
+
+        Returns
+        -------
+        factor: BandedFactor or SpectralFactor
+            Factorization of the kernel matrix
+        """
+        key = ('banded', kernelKey(kernel), id(self.time))
+        factor = self._cache.get(key)
+        if factor is None:
+            order, lags, valid = bandedLags(self.time, kernel.support())
+            #the first row of the band has the lags of each time with itself
+            diagonal = np.zeros(lags.shape, dtype=bool)
+            diagonal[0] = True
+            band = kernel.compile()(Lags(lags, diagonal=diagonal))
+            band[~valid] = 0.
+            band[np.abs(band)<1e-15] = 0.
+            #the same jitter as the semi-separable factorizations
+            band[0] += 1e-6
+            try:
+                factor = BandedFactor(order, band)
+            except LinAlgError:
+                factor = self._spectralFactor(kernel)
+            self._cache[key] = factor
+        return factor
+
+
+    def _kernelFactor(self, kernel, semiseparable=False):
+        """
+        Returns the factorization of the kernel matrix of a given kernel used
+        by the variational updates, BandedFactor or SemiseparableFactor if
+        semiseparable is True, for kernels with and without compact support,
+        and the kernel matrix is numerically positive definite, and
+        SpectralFactor otherwise
+
+        Parameters
+        ----------
+        kernel: covFunction
+            Covariance function
+        semiseparable: bool
+            True to use the semi-separable or banded representation of the
+            kernel
+
+        Returns
+        -------
+        factor: BandedFactor, SemiseparableFactor or SpectralFactor
+            Factorization of the kernel matrix
+        """
+        if not semiseparable:
+            return self._spectralFactor(kernel)
+        if self.backend != 'semiseparable' and np.isfinite(kernel.support()):
+            return self._bandedFactor(kernel)
+        key = ('semiseparable', kernelKey(kernel), id(self.time))
+        factor = self._cache.get(key)
+        if factor is None:
+            U, V, transition, white = kernel.semiseparable()
+            try:
+                factor = SemiseparableFactor(self.time, U, V, transition,
+                                             white + 1e-6)
+            except LinAlgError:
+                factor = self._spectralFactor(kernel)
+            self._cache[key] = factor
+        return factor
+
+
+    def _kernelGradient(self, kernel):
+        """
+        Returns the derivatives of the kernel matrix of a given kernel with
+        respect to each of its parameters, see covFunction.gradient()
+
+        Parameters
+        ----------
+        kernel: covFunction
+            Covariance function
+
+        Returns
+        -------
+        dK: array
+            Derivatives of the kernel matrix, shape (npars, N, N)
+        """
+        if isinstance(kernel, (covL, covP)):
+            return kernel.gradient(None, self.time[:, None], self.time[None, :])
+        return kernel.gradient(self._lags)
 
 
     def _CBMatrix(self, nodes, weight):
@@ -275,7 +620,7 @@ class inference(object):
 
 ##### Mean-Field Inference functions ##########################################
     def optVarParams(self, nodes, weight, mean, jitter, iterations=1000,
-                     mu=None, var=None):
+                     mu=None, var=None, history=False, accelerate=False):
         """
         Function to use in the the sampling of the GPRN
 
@@ -295,6 +640,11 @@ class inference(object):
             Variational means
         var: array
             Variational variances
+        history: bool
+            True to also return the ELBO of every iteration
+        accelerate: bool
+            True to extrapolate the iterations with squarem(), each iteration
+            then takes up to three updates of the variational parameters
 
         Returns
         -------
@@ -304,24 +654,38 @@ class inference(object):
             Optimized variational means
         var: array
             Optimized variational variance (diagonal of sigma)
+        elboArray: array
+            ELBO of every iteration, only if history is True
         """
         #initial variational parameters (they start as random)
         D = self.time.size * self.q *(self.p+1)
+        if self._warmStart is not None:
+            pars = self._warmStart.hyperparameters(nodes, weight, mean, jitter)
+            if mu is None and var is None:
+                mu, var = self._warmStart.nearest(pars) or (None, None)
         if mu is None and var is None:
             mu = np.random.randn(D, 1)
             var = np.random.rand(D, 1)
         varF, varW = self._u_to_fhatW(var.flatten())
-        sigF, sigW = [], []
-        for q in range(self.q):
-            sigF.append(np.diag(varF[0, q, :]))
-            for p in range(self.p):
-                sigW.append(np.diag(varW[p, q, :]))
+        #the starting covariances are diagonal, only their diagonals are
+        #kept as ELBO() works them out again from mu and var
+        sigF, sigW = varF[0], varW
+        #one update of the variational parameters, for squarem()
+        def step(state):
+            ELBO, mu, var, _, _ = self.ELBO(nodes, weight, mean, jitter,
+                                            state[0], state[1], sigF, sigW)
+            return ELBO, [mu, var]
+        positive = lambda state: np.all(state[1] > 0)
         elboArray = np.array([-1e15]) #To add new elbo values inside
         iterNumber = 0
         while iterNumber < iterations:
             #Optimize mu and var analytically
-            ELBO, mu, var, sigF, sigW = self.ELBO(nodes, weight, mean, jitter, 
-                                                  mu, var, sigF, sigW)
+            if accelerate:
+                ELBO, (mu, var) = squarem(step, [mu, var], positive)
+            else:
+                ELBO, mu, var, sigF, sigW = self.ELBO(nodes, weight, mean,
+                                                      jitter, mu, var,
+                                                      sigF, sigW)
             elboArray = np.append(elboArray, ELBO)
             iterNumber += 1
             #Stoping criteria:
@@ -329,7 +693,11 @@ class inference(object):
             if elboArray[-2] > ELBO:
                 break
             if criteria < 1e-1 and criteria !=0:
-                return ELBO, mu, var
+                break
+        if self._warmStart is not None:
+            self._warmStart[pars] = (mu, var)
+        if history:
+            return ELBO, mu, var, elboArray[1:]
         return ELBO, mu, var
 
 
@@ -361,6 +729,8 @@ class inference(object):
         new_var: array
             New variational variances
         """ 
+        #kernel matrices released by the last evaluation are used again
+        self._pool.recycle()
         #to separate the variational parameters between the nodes and weights
         muF, muW = self._u_to_fhatW(mu.flatten())
         varF, varW = self._u_to_fhatW(var.flatten())
@@ -369,19 +739,12 @@ class inference(object):
                                                      muW, varW)
         #new mean for the nodes
         muF = muF.reshape(1, self.q, self.N)
-        varF =  []
-        for i in range(self.q):
-            varF.append(np.diag(sigmaF[i]))
         #new variance for the nodes
-        varF = np.array(varF).reshape(1, self.q, self.N)
+        varF = covarianceDiagonal(sigmaF).reshape(1, self.q, self.N)
         #new mean for the weights
         muW = muW.reshape(self.p, self.q, self.N)
-        varW =  []
-        for j in range(self.q):
-            for i in range(self.p):
-                varW.append(np.diag(sigmaW[j, i, :]))
         #new variance for the weights
-        varW = np.array(varW).reshape(self.p, self.q, self.N)
+        varW = covarianceDiagonal(sigmaW).reshape(self.p, self.q, self.N)
         new_mu = np.concatenate((muF, muW))
         new_var = np.concatenate((varF, varW))
         #Entropy
@@ -397,7 +760,150 @@ class inference(object):
         return ELBO, new_mu, new_var, sigmaF, sigmaW
 
 
-    def Prediction(self, node, weights, means, jitter, tstar, mu, std=False):
+    def ELBObatch(self, nodes, weight, mean, jitter, pars, mu, var):
+        """
+        Evidence lower bound of an ensemble of hyperparameters, e.g. all the
+        walkers of emcee, as used by run_sampler(vectorize=True). The kernel
+        matrices of every member are built in one vectorized pass per kernel
+        and, with the spectral backend, eigendecomposed in one stacked call
+        per kernel. The variational updates and the ELBO of each member are
+        still computed one member after the other, as in ELBO()
+
+        Parameters
+        ----------
+        nodes: array
+            Node functions, only their types are used
+        weight: array
+            Weight functions, only their types are used
+        mean: array
+            Mean functions
+        jitter: array
+            Jitter terms
+        pars: array
+            Parameters of the nodes followed by those of the weights, one row
+            per member, shape (B, npars)
+        mu: array
+            Variational means
+        var: array
+            Variational variances
+
+        Returns
+        -------
+        ELBO: array
+            Evidence lower bound of each member, shape (B,)
+        """
+        kernels = list(nodes) + list(weight)
+        pars = np.atleast_2d(pars)
+        sizes = np.cumsum([kernel.pars.size for kernel in kernels])[:-1]
+        pars = np.split(pars, sizes, axis=1)
+        #kernel matrices of all members, shape (B, N, N) for each kernel,
+        #in float64 in single precision too as they are factorized
+        lags = self._lags
+        if self.dtype != float:
+            lags = Lags(self.time[:, None] - self.time[None, :])
+        matrices = []
+        for kernel, kpars in zip(kernels, pars):
+            if isinstance(kernel, (covL, covP)):
+                K = kernel.batch(kpars, None, self.time[:, None],
+                                 self.time[None, :])
+            else:
+                K = kernel.batch(kpars, lags) + 1e-6*np.identity(self.N)
+            K[np.abs(K)<1e-15] = 0.
+            matrices.append(K)
+        #with the spectral backend the matrices of all members are
+        #eigendecomposed together, in one stacked call per kernel
+        factors = [None] * len(kernels)
+        if not self._semiseparable(kernels):
+            factors = []
+            for kernel, K in zip(kernels, matrices):
+                centrosymmetric = self._centrosymmetric \
+                    and not isinstance(kernel, (covL, covP))
+                factors.append(spectralFactors(K, None, centrosymmetric,
+                                               self.dtype, self.telemetry))
+        ELBO = np.zeros(pars[0].shape[0])
+        for b in range(ELBO.size):
+            member = [kernel._new(kpars[b])
+                      for kernel, kpars in zip(kernels, pars)]
+            #the matrices and their factors go into the cache, where
+            #_kernelMatrix() and _spectralFactor() find them
+            for kernel, K, F in zip(member, matrices, factors):
+                Kb = K[b].astype(self.dtype)
+                Kb.flags.writeable = False
+                key = ('K', kernelKey(kernel), id(self.time))
+                self._cache[key] = (self.time, Kb)
+                if F is not None:
+                    key = ('spectral', kernelKey(kernel), id(self.time))
+                    self._cache[key] = F[b]
+            memberNodes = member[:len(nodes)]
+            memberWeight = member[len(nodes):]
+            ELBO[b] = self.ELBO(memberNodes, memberWeight, mean, jitter,
+                                mu, var, None, None)[0]
+        return ELBO
+
+
+    def ELBOgradient(self, nodes, weight, mean, jitter, mu, sigmaF, sigmaW):
+        """
+        Evidence lower bound and its gradient with respect to the parameters
+        of the nodes and weights, for a fixed variational distribution as
+        returned by ELBO(). This is the objective of the hyperparameters
+        step of variational EM, alternated with the updates of ELBO(), and
+        it can be maximized with gradient-based optimizers such as L-BFGS.
+
+        Parameters
+        ----------
+        nodes: array
+            Node functions
+        weight: array
+            Weight functions
+        mean: array
+            Mean functions
+        jitter: array
+            Jitter terms
+        mu: array
+            Variational means
+        sigmaF: array
+            Variational covariance for each node
+        sigmaW: array
+            Variational covariance for each weight
+
+        Returns
+        -------
+        ELBO: float
+            Evidence lower bound
+        gradient: array
+            Derivatives of the ELBO, parameters of the nodes followed by those
+            of the weights as in ELBObatch()
+        """
+        #kernel matrices released by the last evaluation are used again
+        self._pool.recycle()
+        assert isinstance(sigmaF, DenseCovariance) \
+            or not isinstance(sigmaF, DiagonalCovariance), \
+        'ELBOgradient() needs the dense variational covariances'
+        #the traces kept with the covariances are only valid for the kernels
+        #that built them
+        sigmaF, sigmaW = np.asarray(sigmaF), np.asarray(sigmaW)
+        muF, muW = self._u_to_fhatW(mu.flatten())
+        Entropy = self._entropy(sigmaF, sigmaW)
+        ExpLogPrior = self._expectedLogPrior(nodes, weight,
+                                             sigmaF, muF, sigmaW, muW)
+        ExpLogLike = self._expectedLogLike(nodes, weight, mean, jitter,
+                                           sigmaF, muF, sigmaW, muW)
+        ELBO = ExpLogLike + ExpLogPrior + Entropy
+        #only the expected log prior depends on the kernels parameters
+        stats = self._priorStatistics(nodes, weight, sigmaF, muF, sigmaW, muW)
+        gradient = []
+        for kernel, (c, M) in zip(list(nodes) + list(weight), stats):
+            L = self._kernelCholesky(kernel)
+            Kinv = cho_solve((L, True), np.identity(self.N))
+            #d(-0.5*(c*log|K| + tr(K^-1 M))) = 0.5*tr(A dK)
+            A = Kinv @ M @ Kinv - c*Kinv
+            dK = self._kernelGradient(kernel)
+            gradient.append(0.5 * np.einsum('ij,kij->k', A, dK))
+        return ELBO, np.concatenate(gradient)
+
+
+    def Prediction(self, node, weights, means, jitter, tstar, mu, std=False,
+                   chunkSize=1000):
         """
         Prediction for mean-field inference
 
@@ -416,91 +922,86 @@ class inference(object):
         mu: array
             Variational means
         std: bool
-            True to calculate the standard deviation on the prediction, False
-            otherwise
+            True to calculate the variance of the prediction, False otherwise
+        chunkSize: int
+            Number of prediction times computed at once, the memory used is
+            proportional to chunkSize*N
 
         Returns
         -------
         final_ystar: array
             Predicted means
+        final_ystd: array
+            Predicted variances, if std is True
         """
-        Kf = np.array([self._kernelMatrix(i, self.time) for i in node])
-        Lf = np.array([self._cholNugget(i)[0] for i in Kf])
-        Kw = np.array([self._kernelMatrix(j, self.time) for j in weights])
-        Lw = np.array([self._cholNugget(j)[0] for j in Kw])
+        Lf = [self._kernelCholesky(i) for i in node]
+        #all weights share the same kernel
+        Lw = self._kernelCholesky(weights[0])
         #mean functions
         means = self._mean(means, tstar)
-        means = np.array_split(means, self.p)
+        means = np.array(np.array_split(means, self.p))
         muF, muW = self._u_to_fhatW(mu.flatten())
-        ystar = np.zeros((self.p, tstar.size))
-        for i in range(tstar.size):
-            Kfstar = np.array([self._predictKMatrix(i1, tstar[i]) for i1 in node])
-            Kwstar = np.array([self._predictKMatrix(i2, tstar[i]) for i2 in weights])
-            Lwstar = np.linalg.solve(np.squeeze(Lw), np.squeeze(Kwstar).T)
-            countF, countW = 1, 1
-            Wstar, fstar = np.zeros((self.p, self.q)), np.zeros((self.q, 1))
-            for q in range(self.q):
-                Lfstar = np.linalg.solve(np.squeeze(Lf[q,:,:]), 
-                                         np.squeeze(Kfstar[q,:]).T)
-                fstar[q] = Lfstar @ np.linalg.solve(np.squeeze(Lf[q,:,:]), 
-                                                     muF[:,q,:].T)
-                countF += self.N
-                for p in range(self.p):
-                    Wstar[p, q] = Lwstar @ np.linalg.solve(np.squeeze(Lw[0]), 
-                                                             muW[p][q].T)
-                    countW += self.N
-            ystar[:,i] = ystar[:, i] + np.squeeze(Wstar @ fstar)
-        final_ystar = []
-        for i in range(self.p):
-            final_ystar.append(ystar[i] + means[i])
-        final_ystar = np.array(final_ystar)
+        #K^-1 mu of the nodes and weights, they do not depend on tstar
+        alphaF = [cho_solve((Lf[q], True), muF[0,q]) for q in range(self.q)]
+        alphaW = cho_solve((Lw, True), muW.reshape(-1, self.N).T)
+        final_ystar = np.zeros((self.p, tstar.size))
+        final_ystd = np.zeros((self.p, tstar.size))
+        for start in range(0, tstar.size, chunkSize):
+            chunk = slice(start, start + chunkSize)
+            #means and variances of the nodes and weights, shapes (q, T) and
+            #(p, q, T) for the means, the weights share their variance
+            fstar, varF = zip(*[self._predictMoments(node[q], Lf[q], alphaF[q],
+                                                     tstar[chunk], std)
+                                for q in range(self.q)])
+            fstar, varF = np.array(fstar), np.array(varF)
+            Wstar, varW = self._predictMoments(weights[0], Lw, alphaW,
+                                               tstar[chunk], std)
+            Wstar = Wstar.T.reshape(self.p, self.q, -1)
+            final_ystar[:, chunk] = np.einsum('pqt,qt->pt', Wstar, fstar)
+            if std:
+                #Var(w f) = Var(w)Var(f) + Var(w)E(f)^2 + E(w)^2 Var(f)
+                final_ystd[:, chunk] = np.sum(varW*varF + varW*fstar**2 \
+                                              + Wstar**2*varF, axis=1)
+        final_ystar += means
         if std:
-            jitt2 = 0*np.array(jitter)**2 #jitters
-            Kfstar = np.array([self._predictKMatrix(i1, tstar) for i1 in node])
-            Kwstar = np.array([self._predictKMatrix(i2, tstar) for i2 in weights])
-            Kfstarxx = np.array([self._kernelMatrix(i1, tstar) for i1 in node])
-            Kwstarxx = np.array([self._kernelMatrix(i2, tstar) for i2 in weights])
-            final_ystd = []
-            for i in range(self.p):
-                #WWmu = Kwstar[0,:,:] @ invKw[0,:,:] @ muW[i,:,:].Tsolve
-                WWmu = Kwstar[0,:,:] @ np.linalg.solve(Lw[0,:,:], muW[i,:,:].T)
-                #the zeros here is to substitute by self.q
-                LfKfstar = np.linalg.solve(Lf[0,:,:], Kfstar[0,:,:].T)
-                first = WWmu@WWmu.T@(Kfstarxx[0,:,:] - LfKfstar.T @ LfKfstar)
-                Fmu = np.linalg.solve(np.squeeze(Lf[0,:,:]), muF[0,:,:].T)
-                FFmu =Fmu.T @ np.linalg.solve(np.squeeze(Lf[0,:,:]), 
-                                              Kfstar[0,:,:].T)
-                invKwKw = np.linalg.solve(Lw[0,:,:], Kwstar[0,:,:].T)
-                invKfKf = np.linalg.solve(Lf[0,:,:], Kfstar[0,:,:].T)
-                second = (Kwstarxx[0,:,:]- invKwKw.T @ invKwKw) \
-                        @ (Kfstarxx[0,:,:]- invKfKf.T @ invKfKf \
-                          + FFmu@FFmu.T)
-                final_ystd.append(np.diag(first + second + jitt2[i]))
-            final_ystd = np.array(final_ystd)
             return final_ystar, final_ystd
-#        if std:
-#            jitt2 = np.array(jitter)**2 #jitters
-#            Kfstar = np.array([self._predictKMatrix(i1, tstar) for i1 in node])
-#            Kwstar = np.array([self._predictKMatrix(i2, tstar) for i2 in weights])
-#            Kfstarxx = np.array([self._kernelMatrix(i1, tstar) for i1 in node])
-#            Kwstarxx = np.array([self._kernelMatrix(i2, tstar) for i2 in weights])
-#            final_ystd = []
-#            for i in range(self.p):
-#                WWmu = Kwstar[0,:,:] @ np.linalg.solve(Lw[0,:,:], muW[i,:,:].T)
-#                first = WWmu@WWmu.T@(Kfstarxx[0,:,:] -\
-#                    Kfstar[0,:,:]@ np.linalg.solve(np.squeeze(Lf[0,:,:]), Kfstar[0,:,:].T))
-#                FFmu = Kfstar[0,:,:] @ np.linalg.solve(np.squeeze(Lf[0,:,:]), muF[0,:,:].T)
-#                second = (Kwstarxx[0,:,:] - \
-#                          Kwstar[0,:,:] @ np.linalg.solve(np.squeeze(Lf[0,:,:]),Kwstar[0,:,:].T)\
-#                          @(Kfstarxx[0,:,:] - \
-#                          Kfstar[0,:,:] @ np.linalg.solve(np.squeeze(Lf[0,:,:]),Kfstar[0,:,:].T)\
-#                          + FFmu@FFmu.T))
-#                final_ystd.append(np.diag(first + second + jitt2[i]))
-#            final_ystd = np.array(final_ystd)
-#            return final_ystar, final_ystd
         return final_ystar
 
 
+    def _predictMoments(self, kernel, L, alpha, time, variance=True):
+        """
+        Returns the predictive means, and the predictive variances given the
+        values at the observations, of a latent function at times time
+
+        Parameters
+        ----------
+        kernel: covFunction
+            Covariance function
+        L: array
+            Cholesky factor of the kernel matrix of the observations
+        alpha: array
+            K^-1 mu for the variational means mu, shape (N,) or (N, m)
+        time: array
+            Predictions time
+        variance: bool
+            True to calculate the variances, False to return zeros
+
+        Returns
+        -------
+        mean: array
+            Predictive means, shape (T,) or (T, m)
+        var: array
+            Predictive variances, shape (T,)
+        """
+        Kstar = self._predictKMatrix(kernel, time)
+        mean = Kstar @ alpha
+        if not variance:
+            return mean, np.zeros(time.size)
+        V = solve_triangular(L, Kstar.T, lower=True)
+        var = self._kernelDiagonal(kernel, time) - np.sum(V*V, axis=0)
+        return mean, np.maximum(var, 0)
+
+
     def _updateSigMu(self, nodes, weight, mean, jitter, muF, varF, muW, varW):
         """
         Efficient closed-form updates fot variational parameters. This
@@ -527,11 +1028,11 @@ class inference(object):
 
         Returns
         -------
-        sigma_f: array
+        sigma_f: DenseCovariance or DiagonalCovariance
             Updated variational covariance of each node
         mu_f: array
             Updated variational mean of each node
-        sigma_w: array
+        sigma_w: DenseCovariance or DiagonalCovariance
             Updated variational covariance of each weight
         mu_w: array
             Updated variational mean of each weight
@@ -539,54 +1040,87 @@ class inference(object):
         new_y = np.concatenate(self.y) - self._mean(mean)
         new_y = np.array(np.array_split(new_y, self.p))
         jitt2 = np.array(jitter)**2 #jitters
-        #kernel matrix for the nodes
-        Kf = np.array([self._kernelMatrix(i, self.time) for i in nodes])
-        #kernel matrix for the weights
-        Kw = np.array([self._kernelMatrix(j, self.time) for j in weight])
+        #factorizations of the kernel matrices of the nodes
+        semiseparable = self._semiseparable(list(nodes) + [weight[0]])
+        Ff = [self._kernelFactor(i, semiseparable) for i in nodes]
+        #all weights share the same kernel, so there is only one to factorize
+        Fw = self._kernelFactor(weight[0], semiseparable)
         #we have Q nodes => j in the paper; we have P y(x)s => i in the paper
-        muF = np.squeeze(muF)
-        sigma_f, mu_f = [], [] #creation of Sigma_fj and mu_fj
+        muF = muF.reshape(self.q, self.N).copy()
+        diagonal = self.storage == 'diagonal'
+        bottom = jitt2[:, None] + self.yerr2
+        #the covariances of all nodes are independent and computed together,
+        #their means use the nodes already updated
+        diagF = np.sum((muW*muW + varW) / bottom[:, None, :], axis=0)
+        run = self._executor.map
+        posts = posteriors(Ff, diagF, run)
+        var_f = run(lambda Sigma: Sigma.variance(), posts)
+        logdet_f = [Sigma.logdet for Sigma in posts]
+        if not diagonal:
+            sigma_f = run(self._covariance, posts)
+        mu_f = [] #creation of mu_fj
         for j in range(self.q):
-            diagFj = np.zeros_like(self.N)
-            auxCalc = np.zeros_like(self.N)
-            for i in range(self.p):
-                diagFj = diagFj + (muW[i,j,:]*muW[i,j,:]+varW[i,j,:])\
-                                            /(jitt2[i] + self.yerr2[i,:])
-                sumNj = np.zeros(self.N)
-                for k in range(self.q):
-                    if k != j:
-                        sumNj += muW[i,k,:]*muF[k,:].reshape(self.N)
-                auxCalc = auxCalc + ((new_y[i,:]-sumNj)*muW[i,j,:]) \
-                                    / (jitt2[i] + self.yerr2[i,:])
-            CovF = np.diag(1 / diagFj) + Kf[j]
-            CovF = Kf[j] - Kf[j] @ np.linalg.solve(CovF, Kf[j])
-            sigma_f.append(CovF)
-            mu_f.append(CovF @ auxCalc)
-            muF = np.array(mu_f)
-        sigma_f = np.array(sigma_f)
+            sumNj = np.einsum('pqn,qn->pn', muW, muF) - muW[:,j,:]*muF[j]
+            auxCalc = np.sum((new_y - sumNj) * muW[:,j,:] / bottom, axis=0)
+            mu_f.append(posts[j].dot(auxCalc))
+            muF[j] = mu_f[j]
         mu_f = np.array(mu_f)
+        #the expected log prior uses tr(Kf_j^-1 (Sigma_f1 + ... + Sigma_fj))
+        trace_f = run(lambda j: np.sum([Ff[j].trace(posts[k])
+                                        for k in range(j+1)]),
+                      range(self.q))
+        if diagonal:
+            sigma_f = DiagonalCovariance(var_f, logdet_f, trace_f)
+        else:
+            sigma_f = DenseCovariance(sigma_f, logdet_f, trace_f)
+        del posts
         sigma_w, mu_w = [], np.zeros_like(muW) #creation of Sigma_wij and mu_wij
+        var_w, logdet_w, trace_w = [], [], []
+        #the covariances of the weights are independent and computed
+        #together, per node if only their diagonals are kept
+        diagW = (mu_f*mu_f + np.array(var_f))[None, :, :] / bottom[:, None, :]
+        if not diagonal:
+            posts = posteriors([Fw] * self.qp, diagW.reshape(-1, self.N), run)
+            sigma_w = run(self._covariance,
+                          [posts[i*self.q + j] for j in range(self.q)
+                           for i in range(self.p)])
         for j in range(self.q):
+            if diagonal:
+                posts_j = posteriors([Fw] * self.p, diagW[:, j], run)
+            else:
+                posts_j = posts[j::self.q]
+            for var, logdet, trace in run(
+                    lambda Sigma: (Sigma.variance(), Sigma.logdet,
+                                   Fw.trace(Sigma)), posts_j):
+                var_w.append(var)
+                logdet_w.append(logdet)
+                trace_w.append(trace)
+            sumNj = np.einsum('qn,pqn->pn', mu_f, muW) - mu_f[j]*muW[:,j,:]
+            auxCalc = (new_y - sumNj) * mu_f[j] / bottom
             for i in range(self.p):
-                mu_fj = mu_f[j]
-                var_fj = np.diag(sigma_f[j])
-                Diag_ij = (mu_fj*mu_fj+var_fj) /(jitt2[i] + self.yerr2[i,:])
-                Kw = np.squeeze(Kw)
-                CovWij = np.diag(1 / Diag_ij) + Kw
-                CovWij = Kw - Kw @ np.linalg.solve(CovWij, Kw)
-                sumNj = np.zeros(self.N)
-                for k in range(self.q):
-                    if k != j:
-                        sumNj += mu_f[k].reshape(self.N)*np.array(muW[i,k,:])
-                auxCalc = ((new_y[i,:]-sumNj)*mu_f[j,:]) \
-                                    / (jitt2[i] + self.yerr2[i,:])
-                sigma_w.append(CovWij)
-                muW[i,j,:] = CovWij @ auxCalc
-        sigma_w = np.array(sigma_w).reshape(self.q, self.p, self.N, self.N)
+                muW[i,j,:] = posts_j[i].dot(auxCalc[i])
+        if diagonal:
+            sigma_w = DiagonalCovariance(
+                np.reshape(var_w, (self.q, self.p, self.N)),
+                np.reshape(logdet_w, (self.q, self.p)),
+                np.reshape(trace_w, (self.q, self.p)))
+        else:
+            sigma_w = DenseCovariance(
+                np.reshape(sigma_w, (self.q, self.p, self.N, self.N)),
+                np.reshape(logdet_w, (self.q, self.p)),
+                np.reshape(trace_w, (self.q, self.p)))
         mu_w = np.array(muW)
         return sigma_f, mu_f, sigma_w, mu_w
 
 
+    def _covariance(self, posterior):
+        """
+        Full variational covariance of a posterior of the updates, stored
+        with the precision of the kernel matrices
+        """
+        return posterior.covariance().astype(self.dtype, copy=False)
+
+
     def _expectedLogLike(self, nodes, weight, mean, jitter, sigma_f, mu_f,
                          sigma_w, mu_w):
         """
@@ -616,43 +1150,17 @@ class inference(object):
             Expected log-likelihood value
         """
         new_y = np.concatenate(self.y) - self._mean(mean, self.time)
-        new_y = np.array(np.array_split(new_y, self.p)).T #NxP dimensional vector
-        jitt = np.array(jitter) #jitters
-        jitt2 = np.array(jitter)**2 #jitters squared
-        ycalc = new_y.T #new_y0.shape = (p,n)
-        logl = 0
-        for p in range(self.p):
-            ycalc[p] = new_y.T[p,:] / (jitt[p] + self.yerr[p,:])
-            for n in range(self.N):
-                logl += np.log(jitt2[p] + self.yerr2[p,n])
-        logl = -0.5 * logl
-        Wcalc = []
-        for p in range(self.p):
-            Wcalc.append([])
-        for n in range(self.N):
-            for p in range(self.p):
-                Wcalc[p].append(mu_w[p, :, n])
-        Wcalc = np.array(Wcalc).reshape(self.p, self.N * self.q)
-        Fcalc = []#np.array([])
-        for p in range(self.p):
-            Fcalc.append([])
-            #Fcalc1.append([])
-        for n in range(self.N):
-            for q in range(self.q):
-                for p in range(self.p):
-                    Fcalc[p] = np.append(Fcalc[p],
-                         (mu_f[:, q, n] / (jitt[p] + self.yerr[p,n])))
-        Wcalc, Fcalc = np.array(Wcalc), np.array(Fcalc)
-        Ymean = np.sum((Wcalc * Fcalc).T, axis=1).reshape(self.N, self.q)
-        Ydiff = (ycalc - Ymean.T) * (ycalc - Ymean.T)
+        ycalc = np.array(np.array_split(new_y, self.p)) #PxN dimensional vector
+        bottom = np.array(jitter)[:, None]**2 + self.yerr2 #jitters squared
+        logl = -0.5 * np.sum(np.log(bottom))
+        #Ymean[p,n] = sum_q mu_f[q,n]*mu_w[p,q,n]
+        Ymean = np.einsum('qn,pqn->pn', mu_f[0], mu_w)
+        Ydiff = ((ycalc - Ymean) * (ycalc - Ymean))/bottom
         logl += -0.5 * np.sum(Ydiff)
-        value = 0
-        for i in range(self.p):
-            for j in range(self.q):
-                value += np.sum((np.diag(sigma_f[j,:,:])*mu_w[i,j,:]*mu_w[i,j,:] +\
-                                np.diag(sigma_w[j,i,:,:])*mu_f[:,j,:]*mu_f[:,j,:] +\
-                                np.diag(sigma_f[j,:,:])*np.diag(sigma_w[j,i,:,:]))\
-                                /(jitt2[p] + self.yerr2[p,:]))
+        diagSigmaF = covarianceDiagonal(sigma_f)[None, :, :]
+        diagSigmaW = covarianceDiagonal(sigma_w).transpose(1, 0, 2)
+        value = np.sum((diagSigmaF*mu_w*mu_w + diagSigmaW*mu_f*mu_f \
+                        + diagSigmaF*diagSigmaW) / bottom[:, None, :])
         logl += -0.5* value
         return logl
 
@@ -682,32 +1190,175 @@ class inference(object):
         logp: float
             Expected log prior value
         """
-        Kf = np.array([self._kernelMatrix(i, self.time) for i in nodes])
-        Kw = np.array([self._kernelMatrix(j, self.time) for j in weights])
+        if isinstance(sigma_f, DiagonalCovariance):
+            return self._expectedLogPriorDiagonal(nodes, weights, sigma_f, mu_f,
+                                                  sigma_w, mu_w)
+        if self._semiseparable(list(nodes) + [weights[0]]):
+            return self._expectedLogPriorSemiseparable(nodes, weights, sigma_f,
+                                                       mu_f, sigma_w, mu_w)
+        Kf = [self._kernelMatrix(i, self.time, float) for i in nodes]
+        Kw = [self._kernelMatrix(j, self.time, float) for j in weights]
         #we have Q nodes -> j in the paper; we have P y(x)s -> i in the paper
-        first_term = 0 #calculation of the first term of eq.15 of Nguyen & Bonilla (2013)
-        second_term = 0 #calculation of the second term of eq.15 of Nguyen & Bonilla (2013)
-        Lw = self._cholNugget(Kw[0])[0]
-        logKw = np.float(np.sum(np.log(np.diag(Lw))))
+        Lw = self._kernelCholesky(weights[0])
+        logKw = float(np.sum(np.log(np.diag(Lw))))
+        Lf = [self._kernelCholesky(i) for i in nodes]
         muW = mu_w.reshape(self.q, self.p, self.N)
-        sumSigmaF = np.zeros_like(sigma_f[0])
-        for j in range(self.q):
-            Lf = self._cholNugget(Kf[j])[0]
-            logKf = np.float(np.sum(np.log(np.diag(Lf))))
-            muK =  np.linalg.solve(Lf, mu_f[:,j, :].reshape(self.N))
+        sumSigmaF = np.cumsum(sigma_f, axis=0)
+        def nodeTerm(j):
+            logKf = float(np.sum(np.log(np.diag(Lf[j]))))
+            muK =  np.linalg.solve(Lf[j], mu_f[:,j, :].reshape(self.N))
             muKmu = muK @ muK
-            sumSigmaF = sumSigmaF + sigma_f[j]
-            trace = np.trace(np.linalg.solve(Kf[j], sumSigmaF))#sigma_f[j]))
-            first_term += -self.q*logKf - 0.5*(muKmu + trace)
+            trace = np.trace(np.linalg.solve(Kf[j], sumSigmaF[j]))
+            return -self.q*logKf - 0.5*(muKmu + trace)
+        def weightTerm(j, i):
+            muK = np.linalg.solve(Lw, muW[j,i])
+            muKmu = muK @ muK
+            trace = np.trace(np.linalg.solve(Kw[0], sigma_w[j, i, :, :]))
+            return -self.q*logKw - 0.5*(muKmu + trace)
+        #the terms are independent, they are added in a fixed order
+        run = self._executor.map
+        first_term = sum(run(nodeTerm, range(self.q)))
+        second_term = sum(run(weightTerm, *self._weightBlocks()))
+        logp = first_term + second_term
+        return logp
+
+
+    def _expectedLogPriorSemiseparable(self, nodes, weights, sigma_f, mu_f,
+                                       sigma_w, mu_w):
+        """
+        Same as _expectedLogPrior() when the kernel matrices are inverted
+        with their semi-separable factorizations, so that the prior uses the
+        same kernel matrices as the variational covariances
+
+        Parameters
+        ----------
+            nodes: array
+                Node functions 
+            weight: array
+                Weight function
+            sigma_f: array
+                Variational covariance for each node
+            mu_f: array
+                Variational mean for each node
+            sigma_w: array
+                Variational covariance for each weight
+            mu_w: array
+                Variational mean for each weight
+
+        Returns
+        -------
+        logp: float
+            Expected log prior value
+        """
+        Fw = self._kernelFactor(weights[0], True)
+        Ff = [self._kernelFactor(i, True) for i in nodes]
+        muW = mu_w.reshape(self.q, self.p, self.N)
+        sumSigmaF = np.cumsum(sigma_f, axis=0)
+        def nodeTerm(j):
+            muKmu = Ff[j].quadratic(mu_f[:,j, :].reshape(self.N))
+            trace = np.trace(Ff[j].solve(sumSigmaF[j]))
+            return -self.q*0.5*Ff[j].logdet - 0.5*(muKmu + trace)
+        def weightTerm(j, i):
+            muKmu = Fw.quadratic(muW[j,i])
+            trace = np.trace(Fw.solve(sigma_w[j, i, :, :]))
+            return -self.q*0.5*Fw.logdet - 0.5*(muKmu + trace)
+        #the terms are independent, they are added in a fixed order
+        run = self._executor.map
+        first_term = sum(run(nodeTerm, range(self.q)))
+        second_term = sum(run(weightTerm, *self._weightBlocks()))
+        logp = first_term + second_term
+        return logp
+
+
+
+    def _expectedLogPriorDiagonal(self, nodes, weights, sigma_f, mu_f,
+                                  sigma_w, mu_w):
+        """
+        Same as _expectedLogPrior() when the log-determinants and traces of
+        the variational covariances were already computed when updating
+        them, and the kernel matrices are inverted with their cached 
+        eigendecompositions
+
+        Parameters
+        ----------
+            nodes: array
+                Node functions 
+            weight: array
+                Weight function
+            sigma_f: DiagonalCovariance or DenseCovariance
+                Variational covariance for each node
+            mu_f: array
+                Variational mean for each node
+            sigma_w: DiagonalCovariance or DenseCovariance
+                Variational covariance for each weight
+            mu_w: array
+                Variational mean for each weight
+
+        Returns
+        -------
+        logp: float
+            Expected log prior value
+        """
+        semiseparable = self._semiseparable(list(nodes) + [weights[0]])
+        Fw = self._kernelFactor(weights[0], semiseparable)
+        logKw = 0.5 * Fw.logdet
+        muW = mu_w.reshape(self.q, self.p, self.N)
+        first_term, second_term = 0, 0
+        for j in range(self.q):
+            Ff = self._kernelFactor(nodes[j], semiseparable)
+            muKmu = Ff.quadratic(mu_f[:,j, :].reshape(self.N))
+            first_term += -self.q*0.5*Ff.logdet - 0.5*(muKmu + sigma_f.trace[j])
             for i in range(self.p):
-                muK = np.linalg.solve(Lw, muW[j,i])
-                muKmu = muK @ muK
-                trace = np.trace(np.linalg.solve(Kw[0], sigma_w[j, i, :, :]))
-                second_term += -self.q*logKw - 0.5*(muKmu + trace)
+                muKmu = Fw.quadratic(muW[j,i])
+                second_term += -self.q*logKw - 0.5*(muKmu + sigma_w.trace[j,i])
         logp = first_term + second_term
         return logp
 
 
+    def _priorStatistics(self, nodes, weights, sigma_f, mu_f, sigma_w, mu_w):
+        """
+        Writes the expected log prior of _expectedLogPrior() as a sum over
+        the kernels of -0.5*(c*log|K| + tr(K^-1 M)) plus constants, and
+        returns c and M of each kernel, which is what its gradient needs
+
+        Parameters
+        ----------
+            nodes: array
+                Node functions 
+            weight: array
+                Weight function
+            sigma_f: array
+                Variational covariance for each node
+            mu_f: array
+                Variational mean for each node
+            sigma_w: array
+                Variational covariance for each weight
+            mu_w: array
+                Variational mean for each weight
+
+        Returns
+        -------
+        stats: list
+            Pairs (c, M) of the nodes followed by those of the weights
+        """
+        stats = []
+        sumSigmaF = np.zeros_like(sigma_f[0])
+        for j in range(self.q):
+            muF = mu_f[:, j, :].reshape(self.N)
+            sumSigmaF = sumSigmaF + sigma_f[j]
+            stats.append((self.q, np.outer(muF, muF) + sumSigmaF))
+        #all weights share the first weight kernel
+        muW = mu_w.reshape(self.q, self.p, self.N)
+        M = np.zeros((self.N, self.N))
+        for j in range(self.q):
+            for i in range(self.p):
+                M += np.outer(muW[j,i], muW[j,i]) + sigma_w[j, i, :, :]
+        stats.append((self.q * self.q * self.p, M))
+        for _ in weights[1:]:
+            stats.append((0, np.zeros((self.N, self.N))))
+        return stats
+
+
     def _entropy(self, sigma_f, sigma_w):
         """
         Calculates the entropy in mean-field inference, corresponds to eq.14 
@@ -725,13 +1376,17 @@ class inference(object):
         entropy: float
             Final entropy value
         """
-        entropy = 0 #starts at zero then we sum everything
+        if isinstance(sigma_f, DiagonalCovariance):
+            return 0.5 * (np.sum(sigma_f.logdet) + np.sum(sigma_w.logdet))
+        #each node followed by its weights, added in this order
+        blocks = []
         for j in range(self.q):
-            L1 = self._cholNugget(sigma_f[j])
-            entropy += np.sum(np.log(np.diag(L1[0])))
+            blocks.append(sigma_f[j])
             for i in range(self.p):
-                L2 = self._cholNugget(sigma_w[j, i, :, :])
-                entropy += np.sum(np.log(np.diag(L2[0])))
+                blocks.append(sigma_w[j, i, :, :])
+        logdet = lambda sigma: np.sum(np.log(np.diag(
+                                        self._cholNugget(sigma)[0])))
+        entropy = sum(self._executor.map(logdet, blocks))
         return entropy
 
 
@@ -0,0 +1,781 @@
+"""
+    Sparse mean-field inference, with inducing points
+"""
+import numpy as np
+from scipy.linalg import cholesky
+from gprn.covFunction import Linear as covL
+from gprn.covFunction import Polynomial as covP
+from gprn.covFunction import Lags
+from gprn.linearAlgebra import LRUCache, InducingFactor, kernelKey
+from gprn.linearAlgebra import WarmStartCache, squarem, BlockExecutor
+from gprn.linearAlgebra import cholNugget, CholeskyTelemetry
+
+class inference(object):
+    """
+    Class to perform sparse mean field variational inference for GPRNs, as
+    simpleMeanField.inference but with each node and weight represented by
+    its values at M inducing points, following Titsias (2009) and Hensman
+    et al. (2013). The variational distributions are Gaussians on the
+    whitened inducing values, so an iteration costs O(q*p*N*M**2) operations
+    and they take O(q*p*M**2) memory.
+
+    Parameters
+    ----------
+    num_nodes: int
+        Number of latent node functions f(x), called f hat in the article
+    time: array
+        Time coordinates
+    *args: arrays
+        The actual data (or components), it needs be given in order of data1,
+        data1error, data2, data2error, etc...
+    inducing: int or array
+        Times of the inducing points, or their number to place them evenly
+        between the first and last observations
+    cacheSize: int
+        Maximum number of kernel factorizations kept in memory, by default
+        enough for one set of hyperparameters
+    warmStart: int
+        Number of converged variational parameters kept for the last
+        hyperparameters given to optVarParams(), which then starts from
+        those of the closest hyperparameters instead of at random when no mu
+        and var are given. Default: None, always start at random
+    workers: int
+        Number of threads updating the weights of each node concurrently,
+        see linearAlgebra.BlockExecutor. Default: None, one weight after the
+        other
+    """
+    def __init__(self, num_nodes, time, *args, inducing=100, cacheSize=None,
+                 warmStart=None, workers=None):
+        #number of node functions; f(x) in Wilson et al. (2012)
+        self.num_nodes = num_nodes
+        self.q = num_nodes
+        #array of the time
+        self.time = time
+        #number of observations, N in Wilson et al. (2012)
+        self.N = self.time.size
+        #the data, it should be given as data1, data1error, data2, ...
+        self.args = args
+        #number of outputs y(x); p in Wilson et al. (2012)
+        self.p = int(len(self.args)/2)
+        #total number of weights, we will have q*p weights in total
+        self.qp =  self.q * self.p
+        #to organize the data we now join everything
+        self.tt = np.tile(time, self.p) #"extended" time because why not?
+        ys = []
+        yerrs = []
+        for i, j in enumerate(args):
+            if i%2 == 0:
+                ys.append(j)
+            else:
+                yerrs.append(j)
+        self.y = np.array(ys).reshape(self.p, self.N) #matrix p*N of outputs
+        self.yerr = np.array(yerrs).reshape(self.p, self.N) #matrix p*N of errors
+        self.yerr2 = self.yerr**2
+        #inducing points, M in Titsias (2009)
+        if np.ndim(inducing) == 0:
+            inducing = np.linspace(time.min(), time.max(),
+                                   min(int(inducing), self.N))
+        self.inducing = np.array(inducing, dtype=float)
+        self.M = self.inducing.size
+        #lags between the inducing points and between them and the
+        #observations, shared by every kernel; the M x N ones are only built
+        #when a projection of all the observations is needed
+        self._lagsZZ = Lags(self.inducing[:, None] - self.inducing[None, :])
+        self._lagsZX = None
+        #Cholesky factors of the nodes and weights kernels at the inducing
+        #points and their projections on the observations
+        if cacheSize is None:
+            cacheSize = 2 * (self.q + 1)
+        self._cache = LRUCache(cacheSize)
+        #converged variational parameters of the last hyperparameters
+        self._warmStart = WarmStartCache(warmStart) if warmStart else None
+        #evaluation of the independent weights
+        self._executor = BlockExecutor(workers)
+        #how often the Cholesky factorizations needed a nugget
+        self.telemetry = CholeskyTelemetry()
+        #check if the input was correct
+        assert int((len(args)+1)/2) == self.p, \
+        'Given data and number of components dont match'
+
+
+##### mean functions definition ###############################################
+    def _mean(self, means, time=None):
+        """
+        Returns the values of the mean functions
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        m: float
+            Value of the mean
+        """
+        if time is None:
+            time = self.time
+        N = time.size
+        m = np.zeros(N * self.p)
+        for i, meanfun in enumerate(means):
+            if meanfun is None:
+                continue
+            else:
+                m[i*N : (i+1)*N] = meanfun(time)
+        return m
+
+
+##### To create matrices #######################################################
+    def _kernelMatrix(self, kernel, time1, time2, r=None):
+        """
+        Returns the covariance matrix created by evaluating a given kernel
+        between inputs time1 and time2
+
+        Parameters
+        ----------
+        kernel: covFunction
+            Covariance function
+        time1, time2: arrays
+            Time coordinates
+        r: Lags
+            Lags time1 - time2, if they were already computed, otherwise
+            they are taken as lags between different points
+
+        Returns
+        -------
+        K: array
+            Matrix of a covariance function
+        """
+        #to deal with the non-stationary kernels problem
+        if isinstance(kernel, (covL, covP)):
+            return kernel(None, time1[:, None], time2[None, :])
+        if r is None:
+            r = self._crossLags(time1, time2)
+        return kernel.compile()(r)
+
+
+    def _crossLags(self, time1, time2):
+        """
+        Returns the lags time1 - time2 between different points, as the
+        inducing points and the observations. White noise never enters their
+        covariance, even when there are as many of each and the matrix of
+        lags is square.
+
+        Parameters
+        ----------
+        time1, time2: arrays
+            Time coordinates
+
+        Returns
+        -------
+        r: Lags
+            Lags with an all False diagonal mask
+        """
+        r = time1[:, None] - time2[None, :]
+        return Lags(r, diagonal=np.zeros(r.shape, dtype=bool))
+
+
+    def _kernelDiagonal(self, kernel, time):
+        """
+        Returns the diagonal of the covariance matrix of a given kernel at
+        inputs time, without building the matrix
+
+        Parameters
+        ----------
+        kernel: covFunction
+            Covariance function
+        time: array
+            Time coordinates
+
+        Returns
+        -------
+        kdiag: array
+            Variances of the covariance function
+        """
+        if isinstance(kernel, (covL, covP)):
+            return kernel(None, time, time)
+        return kernel(Lags(np.zeros((time.size, 1)))).reshape(time.size)
+
+
+    def _u_to_fhatW(self, u):
+        """
+        Given an array of values at the inducing points, divides it in the
+        corresponding nodes (f hat) and weights (w) parts
+
+        Parameters
+        ----------
+        u: array
+
+        Returns
+        -------
+        f: array
+            Values of the nodes
+        w: array
+            Values of the weights
+        """
+        f = u[:self.q * self.M].reshape((1, self.q, self.M))
+        w = u[self.q * self.M:].reshape((self.p, self.q, self.M))
+        return f, w
+
+
+    def _cholNugget(self, matrix, maximum=10):
+        """
+        Returns the cholesky decomposition to a given matrix, if it is not
+        positive definite, a nugget is added to its diagonal. The
+        factorization is recorded in self.telemetry.
+
+        Parameters
+        ----------
+        matrix: array
+            Matrix to decompose
+        maximum: int
+            Number of times a nugget is added.
+
+        Returns
+        -------
+        L: array
+            Matrix containing the Cholesky factor
+        nugget: float
+            Nugget added to the diagonal, 0 if none was needed
+        """
+        return cholNugget(matrix, maximum, self.telemetry)
+
+
+    def _inducingCholesky(self, kernel):
+        """
+        Returns the Cholesky factor of the kernel matrix of the inducing
+        points for a given kernel, computed with _cholNugget() and cached on
+        the kernel parameters
+
+        Parameters
+        ----------
+        kernel: covFunction
+            Covariance function
+
+        Returns
+        -------
+        L: array
+            Lower triangular Cholesky factor
+        """
+        key = ('L', kernelKey(kernel), id(self.inducing))
+        L = self._cache.get(key)
+        if L is None:
+            Kzz = self._kernelMatrix(kernel, self.inducing, self.inducing,
+                                     self._lagsZZ)
+            L = self._cholNugget(Kzz)[0]
+            L.flags.writeable = False
+            self._cache[key] = L
+        return L
+
+
+    def _inducingFactor(self, kernel, index=None):
+        """
+        Returns the projection of a given kernel on the inducing points. It
+        only depends on the kernel parameters, so it is computed once and
+        reused in all iterations of optVarParams(). The projections of
+        subsets of the observations, as used by optVarParamsSVI(), are not
+        cached.
+
+        Parameters
+        ----------
+        kernel: covFunction
+            Covariance function
+        index: array
+            Indices of the observations to project, by default all of them
+
+        Returns
+        -------
+        factor: InducingFactor
+            Projection of the kernel on the inducing points
+        """
+        if index is not None:
+            time = self.time[index]
+            Kzx = self._kernelMatrix(kernel, self.inducing, time)
+            return InducingFactor(self._inducingCholesky(kernel), Kzx,
+                                  self._kernelDiagonal(kernel, time))
+        key = ('inducing', kernelKey(kernel), id(self.inducing))
+        factor = self._cache.get(key)
+        if factor is None:
+            if self._lagsZX is None:
+                self._lagsZX = self._crossLags(self.inducing, self.time)
+            Kzx = self._kernelMatrix(kernel, self.inducing, self.time,
+                                     self._lagsZX)
+            factor = InducingFactor(self._inducingCholesky(kernel), Kzx,
+                                    self._kernelDiagonal(kernel, self.time))
+            self._cache[key] = factor
+        return factor
+
+
+    def _observations(self, mean, jitter, index=None):
+        """
+        Returns the data without the mean functions and their variances
+
+        Parameters
+        ----------
+        mean: array
+            Mean functions
+        jitter: array
+            Jitter terms
+        index: array
+            Indices of the observations, by default all of them
+
+        Returns
+        -------
+        new_y: array
+            Data minus the mean functions, shape (p, N)
+        noise: array
+            Variances of the data, jitter included, shape (p, N)
+        """
+        if index is None:
+            index = slice(None)
+        time = self.time[index]
+        new_y = self.y[:, index] \
+                - np.array(np.array_split(self._mean(mean, time), self.p))
+        noise = np.array(jitter)[:, None]**2 + self.yerr2[:, index]
+        return new_y, noise
+
+
+    def _marginals(self, Ff, Fw, mu_f, sigma_f, mu_w, sigma_w):
+        """
+        Returns the means and variances of the nodes and weights at the
+        observations projected by Ff and Fw
+
+        Parameters
+        ----------
+        Ff: list
+            InducingFactor of each node
+        Fw: InducingFactor
+            InducingFactor of the weights
+        mu_f, sigma_f: arrays
+            Variational means and covariances of the nodes
+        mu_w, sigma_w: arrays
+            Variational means and covariances of the weights
+
+        Returns
+        -------
+        Ef, Vf: arrays
+            Means and variances of the nodes, shape (q, N)
+        Ew, Vw: arrays
+            Means and variances of the weights, shape (p, q, N)
+        """
+        N = Fw.A.shape[1]
+        Ef, Vf = np.zeros((2, self.q, N))
+        Ew, Vw = np.zeros((2, self.p, self.q, N))
+        for j in range(self.q):
+            Ef[j], Vf[j] = Ff[j].marginals(mu_f[j], sigma_f[j])
+            for i in range(self.p):
+                Ew[i,j], Vw[i,j] = Fw.marginals(mu_w[i,j], sigma_w[i,j])
+        return Ef, Vf, Ew, Vw
+
+
+##### Mean-Field Inference functions ##########################################
+    def optVarParams(self, nodes, weight, mean, jitter, iterations=1000,
+                     mu=None, var=None, history=False, accelerate=False):
+        """
+        Function to use in the the sampling of the GPRN
+
+        Parameters
+        ----------
+        node: array
+            Node functions
+        weight: array
+            Weight function
+        mean: array
+            Mean functions
+        jitter: array
+            Jitter terms
+        iterations: int
+            Number of iterations
+        mu: array
+            Variational means of the whitened inducing values
+        var: array
+            Variational covariances of the whitened inducing values, nodes
+            followed by weights, shape (q*(p+1), M, M)
+        history: bool
+            True to also return the ELBO of every iteration
+        accelerate: bool
+            True to extrapolate the iterations with squarem(), each iteration
+            then takes up to three updates of the variational parameters
+
+        Returns
+        -------
+        ELBO: array
+            Value of the ELBO per iteration
+        mu: array
+            Optimized variational means
+        var: array
+            Optimized variational covariances
+        elboArray: array
+            ELBO of every iteration, only if history is True
+        """
+        #initial variational parameters (they start as random)
+        D = self.M * self.q *(self.p+1)
+        if self._warmStart is not None:
+            pars = self._warmStart.hyperparameters(nodes, weight, mean, jitter)
+            if mu is None and var is None:
+                mu, var = self._warmStart.nearest(pars) or (None, None)
+        if mu is None and var is None:
+            mu = np.random.randn(D, 1)
+            var = np.random.rand(self.q*(self.p+1), self.M)[:, :, None] \
+                    * np.identity(self.M)
+        #one update of the variational parameters, for squarem()
+        def step(state):
+            ELBO, mu, var = self.ELBO(nodes, weight, mean, jitter, *state)
+            return ELBO, [mu, var]
+        positive = lambda state: np.all(np.diagonal(state[1], 0, 1, 2) > 0)
+        elboArray = np.array([-1e15]) #To add new elbo values inside
+        iterNumber = 0
+        while iterNumber < iterations:
+            #Optimize mu and var analytically
+            if accelerate:
+                ELBO, (mu, var) = squarem(step, [mu, var], positive)
+            else:
+                ELBO, mu, var = self.ELBO(nodes, weight, mean, jitter,
+                                          mu, var)
+            elboArray = np.append(elboArray, ELBO)
+            iterNumber += 1
+            #Stoping criteria:
+            criteria = np.abs((elboArray[-2] - ELBO)/ELBO)
+            if elboArray[-2] > ELBO:
+                break
+            if criteria < 1e-1 and criteria !=0:
+                break
+        if self._warmStart is not None:
+            self._warmStart[pars] = (mu, var)
+        if history:
+            return ELBO, mu, var, elboArray[1:]
+        return ELBO, mu, var
+
+
+    def optVarParamsSVI(self, nodes, weight, mean, jitter, iterations=1000,
+                        batchSize=100, learningRate=None, mu=None, var=None):
+        """
+        Stochastic variational inference (Hoffman et al. 2013), instead of
+        optVarParams() for large data sets. Each iteration takes the next
+        batchSize observations of a random permutation of the data, and the
+        nodes and weights take in turn a natural-gradient step with the
+        expected log-likelihood estimated from them. The memory and the time
+        per iteration depend on batchSize and M but not on N.
+
+        Parameters
+        ----------
+        nodes: array
+            Node functions
+        weight: array
+            Weight function
+        mean: array
+            Mean functions
+        jitter: array
+            Jitter terms
+        iterations: int
+            Number of iterations, there is no stopping criteria
+        batchSize: int
+            Number of observations per iteration
+        learningRate: float or function
+            Step size, constant or a function of the iteration number
+            starting at 0. Default: (1 + iteration/100)**-0.6, which keeps
+            large steps for the first iterations since the nodes and weights
+            are strongly coupled
+        mu: array
+            Variational means of the whitened inducing values
+        var: array
+            Variational covariances of the whitened inducing values, nodes
+            followed by weights, shape (q*(p+1), M, M)
+
+        Returns
+        -------
+        ELBO: float
+            Value of the ELBO at the end, using all the observations
+        mu: array
+            Optimized variational means
+        var: array
+            Optimized variational covariances
+        """
+        #initial variational parameters (they start as random)
+        D = self.M * self.q *(self.p+1)
+        if mu is None and var is None:
+            mu = np.random.randn(D, 1)
+            var = np.random.rand(self.q*(self.p+1), self.M)[:, :, None] \
+                    * np.identity(self.M)
+        if learningRate is None:
+            learningRate = lambda iterNumber: (1. + iterNumber/100)**-0.6
+        elif not callable(learningRate):
+            learningRate = lambda iterNumber, rho=learningRate: rho
+        batchSize = min(batchSize, self.N)
+        muF, muW = self._u_to_fhatW(mu.flatten())
+        sigmaF = var[:self.q]
+        sigmaW = var[self.q:].reshape(self.p, self.q, self.M, self.M)
+        start = self.N
+        for iterNumber in range(iterations):
+            if start + batchSize > self.N:
+                order, start = np.random.permutation(self.N), 0
+            index = order[start:start+batchSize]
+            start += batchSize
+            muF, sigmaF, muW, sigmaW = self._updateSigMu(
+                nodes, weight, mean, jitter, muF, sigmaF, muW, sigmaW,
+                index, learningRate(iterNumber))
+        mu = np.concatenate((muF, muW)).reshape(-1, 1)
+        var = np.concatenate((sigmaF, sigmaW.reshape(-1, self.M, self.M)))
+        #the ELBO of all the observations, batchSize at a time
+        ExpLogLike = 0
+        for start in range(0, self.N, batchSize):
+            index = np.arange(start, min(start+batchSize, self.N))
+            ExpLogLike += self._expectedLogLike(nodes, weight, mean, jitter,
+                                                sigmaF, muF, sigmaW, muW,
+                                                index)
+        ELBO = ExpLogLike - self._kullbackLeibler(mu.ravel(), var)
+        return ELBO, mu, var
+
+
+    def ELBO(self, node, weight, mean, jitter, mu, var):
+        """
+        Evidence Lower bound to use in optVarParams()
+
+        Parameters
+        ----------
+        node: array
+            Node functions
+        weight: array
+            Weight function
+        mean: array
+            Mean functions
+        jitter: array
+            Jitter terms
+        mu: array
+            Variational means of the whitened inducing values
+        var: array
+            Variational covariances of the whitened inducing values
+
+        Returns
+        -------
+        ELBO: float
+            Evidence lower bound
+        new_mu: array
+            New variational means
+        new_var: array
+            New variational covariances
+        """
+        #to separate the variational parameters between the nodes and weights
+        muF, muW = self._u_to_fhatW(mu.flatten())
+        sigmaF = var[:self.q]
+        sigmaW = var[self.q:].reshape(self.p, self.q, self.M, self.M)
+        muF, sigmaF, muW, sigmaW = self._updateSigMu(node, weight, mean,
+                                                     jitter, muF, sigmaF,
+                                                     muW, sigmaW)
+        new_mu = np.concatenate((muF, muW)).reshape(-1, 1)
+        new_var = np.concatenate((sigmaF,
+                                  sigmaW.reshape(-1, self.M, self.M)))
+        #Expected log-likelihood
+        ExpLogLike = self._expectedLogLike(node, weight, mean, jitter,
+                                           sigmaF, muF, sigmaW, muW)
+        #Kullback-Leibler divergence from the prior
+        KL = self._kullbackLeibler(new_mu.ravel(), new_var)
+        #Evidence Lower Bound
+        ELBO = ExpLogLike - KL
+        return ELBO, new_mu, new_var
+
+
+    def Prediction(self, node, weights, means, jitter, tstar, mu, std=False,
+                   var=None):
+        """
+        Prediction for sparse mean-field inference
+
+        Parameters
+        ----------
+        node: array
+            Node functions
+        weight: array
+            Weight function
+        means: array
+            Mean functions
+        jitter: array
+            Jitter terms
+        tstar: array
+            Predictions time
+        mu: array
+            Variational means
+        std: bool
+            True to calculate the variance of the prediction, False otherwise
+        var: array
+            Variational covariances, needed when std is True
+
+        Returns
+        -------
+        final_ystar: array
+            Predicted means
+        final_ystd: array
+            Predicted variances, if std is True
+        """
+        muF, muW = self._u_to_fhatW(mu.flatten())
+        means = np.array(np.array_split(self._mean(means, tstar), self.p))
+        Ff = [self._inducingFactor(i) for i in node]
+        Fw = self._inducingFactor(weights[0])
+        #projections of the prediction times on the inducing points
+        projF = [F.project(self._kernelMatrix(k, self.inducing, tstar),
+                           self._kernelDiagonal(k, tstar))
+                 for F, k in zip(Ff, node)]
+        projW = Fw.project(self._kernelMatrix(weights[0], self.inducing, tstar),
+                           self._kernelDiagonal(weights[0], tstar))
+        Ef = np.array([A.T @ muF[0, j] for j, (A, _) in enumerate(projF)])
+        Ew = np.einsum('mt,pqm->pqt', projW[0], muW)
+        final_ystar = np.einsum('pqt,qt->pt', Ew, Ef) + means
+        if not std:
+            return final_ystar
+        assert var is not None, 'the variance needs the covariances var'
+        sigmaF = var[:self.q]
+        sigmaW = var[self.q:].reshape(self.p, self.q, self.M, self.M)
+        Vf = np.array([Ff[j].marginals(muF[0, j], sigmaF[j], *projF[j])[1]
+                       for j in range(self.q)])
+        Vw = np.array([[Fw.marginals(muW[i, j], sigmaW[i, j], *projW)[1]
+                        for j in range(self.q)] for i in range(self.p)])
+        final_ystd = np.sum(Vw*Vf + Vw*Ef*Ef + Ew*Ew*Vf, axis=1)
+        return final_ystar, final_ystd
+
+
+    def _updateSigMu(self, nodes, weight, mean, jitter, muF, sigmaF, muW,
+                     sigmaW, index=None, rho=1.):
+        """
+        Closed-form updates of the variational parameters, the equivalent of
+        eqs. 16, 17, 18, and 19 of Nguyen & Bonilla (2013) for the whitened
+        inducing values: each node and weight gets in turn the Gaussian that
+        maximizes the ELBO given the others. With a subset of the
+        observations, the expected log-likelihood is estimated from it and
+        they take a natural-gradient step of size rho towards that Gaussian.
+
+        Parameters
+        ----------
+        nodes: array
+            Node functions
+        weight: array
+            Weight function
+        mean: array
+            Mean functions
+        jitter: array
+            Jitter terms
+        muF: array
+            Initial variational mean of each node
+        sigmaF: array
+            Initial variational covariance of each node
+        muW: array
+            Initial variational mean of each weight
+        sigmaW: array
+            Initial variational covariance of each weight
+        index: array
+            Indices of the observations, by default all of them
+        rho: float
+            Step size of the natural-gradient steps
+
+        Returns
+        -------
+        mu_f: array
+            Updated variational mean of each node
+        sigma_f: array
+            Updated variational covariance of each node
+        mu_w: array
+            Updated variational mean of each weight
+        sigma_w: array
+            Updated variational covariance of each weight
+        """
+        new_y, noise = self._observations(mean, jitter, index)
+        #the minibatch estimate of the expected log-likelihood is unbiased
+        noise = noise * new_y.shape[1] / self.N
+        Ff = [self._inducingFactor(i, index) for i in nodes]
+        #all weights share the same kernel
+        Fw = self._inducingFactor(weight[0], index)
+        mu_f, sigma_f = muF[0].copy(), np.array(sigmaF)
+        mu_w, sigma_w = muW.copy(), np.array(sigmaW)
+        #means and variances of the nodes and weights at the observations
+        Ef, Vf, Ew, Vw = self._marginals(Ff, Fw, mu_f, sigma_f, mu_w, sigma_w)
+        #we have Q nodes => j in the paper; we have P y(x)s => i in the paper
+        for j in range(self.q):
+            #residuals without the contribution of node j
+            res = new_y - np.einsum('pqn,qn->pn', Ew, Ef) + Ew[:,j]*Ef[j]
+            diag = np.sum((Ew[:,j]**2 + Vw[:,j]) / noise, axis=0)
+            b = np.sum(Ew[:,j] * res / noise, axis=0)
+            mu_f[j], sigma_f[j] = Ff[j].step(diag, b, mu_f[j], sigma_f[j], rho)
+            Ef[j], Vf[j] = Ff[j].marginals(mu_f[j], sigma_f[j])
+        #the weights of a node only depend on the other weights of the same
+        #output, so they are updated together
+        def weightStep(i, j):
+            res = new_y[i] - np.sum(Ew[i]*Ef, axis=0) + Ew[i,j]*Ef[j]
+            diag = (Ef[j]**2 + Vf[j]) / noise[i]
+            b = Ef[j] * res / noise[i]
+            mu, sigma = Fw.step(diag, b, mu_w[i,j], sigma_w[i,j], rho)
+            return (mu, sigma) + tuple(Fw.marginals(mu, sigma))
+        for j in range(self.q):
+            steps = self._executor.map(weightStep, range(self.p), [j]*self.p)
+            for i, (mu, sigma, E, V) in enumerate(steps):
+                mu_w[i,j], sigma_w[i,j] = mu, sigma
+                Ew[i,j], Vw[i,j] = E, V
+        return mu_f[None], sigma_f, mu_w, sigma_w
+
+
+    def _expectedLogLike(self, nodes, weight, mean, jitter, sigma_f, mu_f,
+                         sigma_w, mu_w, index=None):
+        """
+        Calculates the expected log-likelihood in sparse mean-field inference,
+        corresponds to eq.14 in Nguyen & Bonilla (2013) with the means and
+        variances of the nodes and weights given by the inducing points
+
+        Parameters
+        ----------
+        nodes: array
+            Node functions
+        weight: array
+            Weight function
+        jitter: array
+            Jitter terms
+        sigma_f: array
+            Variational covariance for each node
+        mu_f: array
+            Variational mean for each node
+        sigma_w: array
+            Variational covariance for each weight
+        mu_w: array
+            Variational mean for each weight
+        index: array
+            Indices of the observations, by default all of them
+
+        Returns
+        -------
+        logl: float
+            Expected log-likelihood value of the observations
+        """
+        new_y, noise = self._observations(mean, jitter, index)
+        Ff = [self._inducingFactor(i, index) for i in nodes]
+        Fw = self._inducingFactor(weight[0], index)
+        Ef, Vf, Ew, Vw = self._marginals(Ff, Fw, mu_f[0], sigma_f,
+                                         mu_w, sigma_w)
+        logl = -0.5 * np.sum(np.log(noise))
+        Ydiff = new_y - np.einsum('pqn,qn->pn', Ew, Ef)
+        logl += -0.5 * np.sum(Ydiff * Ydiff / noise)
+        value = np.sum(Vw*Vf + Vw*Ef*Ef + Ew*Ew*Vf, axis=1)
+        logl += -0.5 * np.sum(value / noise)
+        return logl
+
+
+    def _kullbackLeibler(self, mu, sigma):
+        """
+        Calculates the Kullback-Leibler divergence of the variational
+        distributions of the whitened inducing values from their N(0, I)
+        prior, it replaces the expected log prior and the entropy of
+        simpleMeanField.inference
+
+        Parameters
+        ----------
+        mu: array
+            Variational means, size q*(p+1)*M
+        sigma: array
+            Variational covariances, shape (q*(p+1), M, M)
+
+        Returns
+        -------
+        kl: float
+            Kullback-Leibler divergence
+        """
+        kl = 0.5 * (mu @ mu - sigma.shape[0]*self.M)
+        for S in sigma:
+            L = cholesky(S, lower=True)
+            kl += 0.5 * (np.trace(S) - 2*np.sum(np.log(np.diag(L))))
+        return kl
+
+
+### END
@@ -0,0 +1,60 @@
+#benchmark of precision='single' against precision='double': error of the
+#ELBO, time of optVarParams() and memory of the variational covariances
+import numpy as np
+import matplotlib.pyplot as plt
+plt.close('all')
+
+from gprn.covFunction import QuasiPeriodic, SquaredExponential, WhiteNoise
+from gprn.meanFunction import Constant
+from gprn.simpleMeanField import inference
+
+from time import time
+
+time2count = [50, 100, 200, 300, 400, 500, 600, 700, 800, 900, 1000]
+iterations = 5
+
+relativeError, finalTimes, memory = [], {}, {}
+for j in time2count:
+    #data
+    t = np.linspace(10, 100, j)
+    y = 10*np.sin(2*np.pi*t/30) + np.random.randn(t.size)
+    yerr = np.random.random(t.size)
+
+    nodes = [QuasiPeriodic(1, 50, 30, 1) + WhiteNoise(0.1)]
+    weight = [SquaredExponential(10, 100)]
+    means = [Constant(0)]
+    jitter = [0.1]
+
+    elbos = {}
+    for precision in ['double', 'single']:
+        GPRN = inference(1, t, y, yerr, precision=precision)
+        #the same random start for both precisions
+        np.random.seed(23011990)
+        start = time()
+        elbo, MU, VAR = GPRN.optVarParams(nodes, weight, means, jitter,
+                                          iterations=iterations)
+        end = time()
+        elbos[precision] = elbo
+        finalTimes.setdefault(precision, []).append(end-start)
+        #memory of the q*p*N*N covariances of the weights
+        sigmaW = GPRN.ELBO(nodes, weight, means, jitter, MU, VAR,
+                           None, None)[4]
+        memory.setdefault(precision, []).append(sigmaW.matrix.nbytes / 1e6)
+    error = np.abs((elbos['single'] - elbos['double']) / elbos['double'])
+    relativeError.append(error)
+    print('{0} points: ELBO = {1} (double), {2} (single), relative error '
+          '= {3:.2e}'.format(j, elbos['double'], elbos['single'], error))
+    print('    time = {0:.3f} sec (double), {1:.3f} sec (single)'.format(
+          finalTimes['double'][-1], finalTimes['single'][-1]))
+
+fig, axs = plt.subplots(3, 1, sharex=True)
+axs[0].semilogy(time2count, relativeError, '-*')
+axs[0].set_ylabel('ELBO relative error')
+for precision in ['double', 'single']:
+    axs[1].plot(time2count, finalTimes[precision], '-^', label=precision)
+    axs[2].plot(time2count, memory[precision], '-^', label=precision)
+axs[1].set_ylabel('Time (s)')
+axs[2].set_ylabel('Memory of sigma_w (MB)')
+axs[2].set_xlabel('Number of points')
+axs[1].legend()
+plt.show()
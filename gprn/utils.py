@@ -1,6 +1,8 @@
 """
 Collection of useful functions
 """
+import os
+import multiprocessing
 from multiprocessing import Pool
 import dynesty
 import emcee
@@ -138,7 +140,8 @@ def phase_folding(t, y, yerr, period):
 
 ##### sampling with dynesty or emcee ##########################################
 def run_sampler(prior_func, elbo_func, mu, var, iterations=1000,
-                sampler='emcee', priors=True, init_values=None):
+                sampler='emcee', priors=True, init_values=None,
+                vectorize=False):
     """
     run_mcmc() allow the user to run emcee or dynesty automatically
 
@@ -167,6 +170,11 @@ def run_sampler(prior_func, elbo_func, mu, var, iterations=1000,
         Initial values of the kernels parameters, only needed if
         priors = False, not implemented for dynesty
         Default: None
+    vectorize: bool
+        True if elbo_func scores all the emcee walkers in one call, taking a
+        (nwalkers, ndim) array and returning nwalkers values, e.g. using the
+        ELBObatch() of the inference classes. Not implemented for dynesty
+        Default: False
 
     Returns
     -------
@@ -178,8 +186,15 @@ def run_sampler(prior_func, elbo_func, mu, var, iterations=1000,
         burns, runs = int(iterations/4), int(3*iterations/4)
         #defining emcee properties
         nwalkers = 2*ndim
-        sampler = emcee.EnsembleSampler(nwalkers, ndim, elbo_func,
-                                        kwargs=dict(MU=mu, VAR=var), threads=4)
+        if vectorize:
+            #the walkers are scored together, no need for extra processes
+            sampler = emcee.EnsembleSampler(nwalkers, ndim, elbo_func,
+                                            kwargs=dict(MU=mu, VAR=var),
+                                            vectorize=True)
+        else:
+            sampler = emcee.EnsembleSampler(nwalkers, ndim, elbo_func,
+                                            kwargs=dict(MU=mu, VAR=var),
+                                            threads=4)
         #Initialize the walkers
         if priors:
             p0 = [prior_func() for i in range(nwalkers)]
@@ -224,9 +239,11 @@ def run_sampler(prior_func, elbo_func, mu, var, iterations=1000,
 
 
 ##### scipy minimization ######################################################
-def run_minimization(elbo_func, init_x, constraints, iterations=1000):
+def run_minimization(elbo_func, init_x, constraints, iterations=1000,
+                     jac=False):
     """
-    run_minimization() allow the user to run the COBYLA minimization method
+    run_minimization() allow the user to run the COBYLA minimization method,
+    or L-BFGS-B when the gradient is available
 
     Parameters
     ----------
@@ -238,12 +255,22 @@ def run_minimization(elbo_func, init_x, constraints, iterations=1000):
         Constraints for ‘trust-constr’
     iterations: int
         Number of iterations;
+    jac: bool
+        True if elbo_func returns both the value and its gradient, e.g. using
+        the ELBOgradient() of the inference classes; L-BFGS-B is then used
+        with the constraints as bounds
+        Default: False
 
     Returns
     -------
     results: array?
         Minimization results
     """
+    if jac:
+        results = minimize(elbo_func, np.array(init_x), jac=True,
+                           method='L-BFGS-B', bounds=constraints,
+                           options={'disp': True, 'maxiter': iterations})
+        return results
     #defining the constraints
     cons = []
     for factor, _ in enumerate(constraints):
@@ -262,6 +289,106 @@ def run_minimization(elbo_func, init_x, constraints, iterations=1000):
     return results
 
 
+##### multi-start variational optimization ###################################
+#environment variables setting the number of threads of the BLAS libraries
+_blasThreads = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+def _optVarParamsStart(inference, seed, args, kwargs):
+    """
+    One start of run_multistart(), it runs in a worker process. The initial
+    variational parameters are drawn from the seed of the start and passed
+    to optVarParams(), so the start neither reads the warm start cache of
+    the inference nor touches the global random state
+    """
+    rng = np.random.default_rng(seed)
+    Q = inference.q * (inference.p+1)
+    if hasattr(inference, 'M'):
+        #sparseMeanField, the variances are matrices over the inducing points
+        mu = rng.standard_normal((Q * inference.M, 1))
+        var = rng.random((Q, inference.M))[:, :, None] \
+                * np.identity(inference.M)
+    else:
+        mu = rng.standard_normal((Q * inference.N, 1))
+        var = rng.random((Q * inference.N, 1))
+    return inference.optVarParams(*args, mu=mu, var=var, history=True,
+                                  **kwargs)
+
+
+def run_multistart(inference, nodes, weight, mean, jitter, starts=4,
+                   iterations=1000, processes=None, seed=None):
+    """
+    run_multistart() optimizes the variational parameters from several
+    random initializations in parallel, and keeps the one with the highest
+    ELBO. Each start runs optVarParams() of the inference in its own process,
+    with its own seed and a single-threaded BLAS, so the starts do not
+    compete for the cores. The starts are independent of each other and of
+    the warm start cache of the inference. The processes are spawned, so scripts calling it
+    need the if __name__ == '__main__': guard
+
+    Parameters
+    ----------
+    inference: object
+        Inference class, e.g. simpleMeanField.inference or
+        sparseMeanField.inference
+    nodes: array
+        Node functions
+    weight: array
+        Weight function
+    mean: array
+        Mean functions
+    jitter: array
+        Jitter terms
+    starts: int
+        Number of random initializations
+    iterations: int
+        Maximum number of iterations of each start
+    processes: int
+        Number of worker processes, by default one per start up to the
+        number of cores; 1 runs the starts in this process
+    seed: int
+        Seed from which the seeds of the starts are drawn, the results do
+        not depend on the number of processes
+
+    Returns
+    -------
+    ELBO: float
+        Highest ELBO
+    mu: array
+        Variational means of the best start
+    var: array
+        Variational variances of the best start
+    trajectories: list
+        ELBO per iteration of every start
+    """
+    seeds = np.random.SeedSequence(seed).generate_state(starts)
+    args = (nodes, weight, mean, jitter)
+    kwargs = dict(iterations=iterations)
+    tasks = [(inference, int(s), args, kwargs) for s in seeds]
+    if processes is None:
+        processes = min(starts, os.cpu_count() or 1)
+    if processes == 1:
+        results = [_optVarParamsStart(*task) for task in tasks]
+    else:
+        #the workers read the number of BLAS threads when importing numpy
+        environ = {name: os.environ.get(name) for name in _blasThreads}
+        os.environ.update({name: '1' for name in _blasThreads})
+        try:
+            context = multiprocessing.get_context('spawn')
+            with context.Pool(processes) as pool:
+                results = pool.starmap(_optVarParamsStart, tasks)
+        finally:
+            for name, value in environ.items():
+                if value is None:
+                    os.environ.pop(name)
+                else:
+                    os.environ[name] = value
+    trajectories = [result[3] for result in results]
+    best = int(np.argmax([result[0] for result in results]))
+    ELBO, mu, var, _ = results[best]
+    return ELBO, mu, var, trajectories
+
+
 ##### truncated cauchy distribution ###########################################
 def truncCauchy_rvs(loc=0, scale=1, a=-1, b=1, size=None):
     """
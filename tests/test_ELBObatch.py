@@ -0,0 +1,42 @@
+"""
+ELBObatch() of an ensemble of hyperparameters against the ELBO of each
+member computed on its own
+"""
+import numpy as np
+
+from gprn.covFunction import QuasiPeriodic, SquaredExponential, WhiteNoise
+from gprn.meanFunction import Constant
+from gprn import simpleMeanField, completeMeanField, completeMeanField2
+
+
+def _ELBO(GPRN, nodes, weight, means, jitter, mu, var):
+    """ ELBO of one member, with the signature of each engine """
+    if isinstance(GPRN, simpleMeanField.inference):
+        return GPRN.ELBO(nodes, weight, means, jitter, mu, var,
+                         None, None)[0]
+    if isinstance(GPRN, completeMeanField.inference):
+        return GPRN.ELBOaux(nodes, weight, means, jitter, mu, var,
+                            None, None)[0]
+    return GPRN.ELBOaux(nodes, weight, means, jitter, mu, var)[0]
+
+
+def test_ELBObatch_members():
+    rng = np.random.RandomState(0)
+    t = np.linspace(10, 100, 60)
+    y, yerr = np.sin(t/5) + 0.1*rng.randn(t.size), 0.1*np.ones(t.size)
+    nodes = [QuasiPeriodic(1, 50, 30, 1) + WhiteNoise(0.1)]
+    weight = [SquaredExponential(10, 100)]
+    means, jitter = [Constant(0)], [0.1]
+    base = np.concatenate([kernel.pars for kernel in nodes + weight])
+    pars = base * (1 + 0.1*rng.rand(4, base.size))
+    mu, var = rng.randn(2*t.size, 1), rng.rand(2*t.size, 1)
+    split = nodes[0].pars.size
+    for module in (simpleMeanField, completeMeanField, completeMeanField2):
+        GPRN = module.inference(1, t, y, yerr)
+        ELBO = GPRN.ELBObatch(nodes, weight, means, jitter, pars, mu, var)
+        for b, member in enumerate(pars):
+            single = module.inference(1, t, y, yerr)
+            expected = _ELBO(single, [nodes[0]._new(member[:split])],
+                             [weight[0]._new(member[split:])], means, jitter,
+                             mu, var)
+            assert np.isclose(ELBO[b], expected, rtol=1e-10), module
@@ -0,0 +1,50 @@
+"""
+The semi-separable and banded backends give the ELBO of the dense one, and
+only the kernels with an exact representation have one
+"""
+import numpy as np
+import pytest
+
+from gprn.covFunction import Matern32, Matern52, Periodic, Piecewise
+from gprn.covFunction import SquaredExponential, QuasiPeriodic
+from gprn.meanFunction import Constant
+from gprn import simpleMeanField, completeMeanField
+
+
+def _ELBO(GPRN, nodes, weight, mu, var):
+    """ ELBO of simpleMeanField or completeMeanField """
+    means, jitter = [Constant(0)], [0.1]
+    if isinstance(GPRN, simpleMeanField.inference):
+        return GPRN.ELBO(nodes, weight, means, jitter, mu, var,
+                         None, None)[0]
+    return GPRN.ELBOaux(nodes, weight, means, jitter, mu, var,
+                        None, None)[0]
+
+
+def test_auto_backend_matches_dense():
+    rng = np.random.RandomState(0)
+    N = simpleMeanField.inference.semiseparableSize
+    t = np.sort(rng.uniform(0, 300, N))
+    y, yerr = np.sin(t/10) + 0.1*rng.randn(N), 0.1*np.ones(N)
+    mu, var = rng.randn(2*N, 1), rng.rand(2*N, 1)
+    weight = [Matern52(1., 50.)]
+    for node in (Matern32(1., 5.), Periodic(1., 20., 2.)*Matern32(1., 40.),
+                 Piecewise(20.)):
+        for module in (simpleMeanField, completeMeanField):
+            dense = module.inference(1, t, y, yerr, backend='dense')
+            auto = module.inference(1, t, y, yerr, backend='auto')
+            assert auto._semiseparable([node] + weight)
+            ELBO = _ELBO(dense, [node], weight, mu, var)
+            assert np.isclose(_ELBO(auto, [node], weight, mu, var), ELBO,
+                              rtol=1e-10, atol=0), (module, node)
+
+
+def test_no_approximate_representation():
+    for kernel in (SquaredExponential(1., 5.), QuasiPeriodic(1., 50., 20., 1.),
+                   Periodic(1., 20., 0.1)):
+        assert kernel.semiseparable() is None
+    t = np.linspace(0, 10, 20)
+    GPRN = simpleMeanField.inference(1, t, np.sin(t), 0.1*np.ones(t.size),
+                                     backend='semiseparable')
+    with pytest.raises(ValueError):
+        GPRN._semiseparable([SquaredExponential(1., 5.)])
@@ -0,0 +1,40 @@
+"""
+The ELBO is a continuous function of the hyperparameters, also where the
+numerical rank of a kernel matrix changes
+"""
+import numpy as np
+
+from gprn.covFunction import SquaredExponential
+from gprn.meanFunction import Constant
+from gprn import simpleMeanField, completeMeanField, completeMeanField2
+
+
+def test_ELBO_rank_change():
+    rng = np.random.RandomState(0)
+    N = 60
+    t = np.linspace(0, 30, N)
+    y, yerr = np.sin(t/3) + 0.1*rng.randn(N), 0.1*np.ones(N)
+    means, jitter = [Constant(0)], [0.1]
+    mu, var = rng.randn(4*N, 1), rng.rand(4*N, 1)
+    #the rank of the smooth node kernels drops several times over this range
+    lengths = np.arange(3.9, 4.4, 0.01)
+    for module in (simpleMeanField, completeMeanField, completeMeanField2):
+        ELBO = []
+        for ell in lengths:
+            GPRN = module.inference(2, t, y, yerr)
+            nodes = [SquaredExponential(1., ell),
+                     SquaredExponential(1., 1.3*ell)]
+            if module is simpleMeanField:
+                weight = [SquaredExponential(1., 10.)]
+                result = GPRN.ELBO(nodes, weight, means, jitter, mu, var,
+                                   None, None)
+            elif module is completeMeanField:
+                weight = [SquaredExponential(1., 10.)] * 2
+                result = GPRN.ELBOaux(nodes, weight, means, jitter, mu, var,
+                                      None, None)
+            else:
+                weight = [SquaredExponential(1., 10.)] * 2
+                result = GPRN.ELBOaux(nodes, weight, means, jitter, mu, var)
+            ELBO.append(result[0])
+        #a smooth curve has second differences much smaller than one
+        assert np.max(np.abs(np.diff(ELBO, 2))) < 0.1, module
@@ -0,0 +1,61 @@
+"""
+The vectorized _expectedLogLike() of the mean-field engines against the
+loops it replaced, with as many, more and fewer nodes than outputs
+"""
+import numpy as np
+
+from gprn.meanFunction import Constant
+from gprn import simpleMeanField, completeMeanField, completeMeanField2
+
+
+def _loops(y, yerr2, jitter, sigma_f, mu_f, sigma_w, mu_w):
+    """ The loops of completeMeanField2 before they were vectorized """
+    p, N = y.shape
+    q = mu_f.shape[1]
+    jitt2 = np.array(jitter)**2
+    logl = 0
+    for i in range(p):
+        for n in range(N):
+            logl += np.log(jitt2[i] + yerr2[i, n])
+    logl = -0.5 * logl
+    sumN = []
+    for n in range(N):
+        for i in range(p):
+            Ydiff = y[i, n] - mu_f[0, :, n] @ mu_w[i, :, n].T
+            bottom = jitt2[i] + yerr2[i, n]
+            sumN.append((Ydiff.T * Ydiff)/bottom)
+    logl += -0.5 * np.sum(sumN)
+    value = 0
+    for i in range(p):
+        for j in range(q):
+            value += np.sum((np.diag(sigma_f[j])*mu_w[i, j]*mu_w[i, j] \
+                             + np.diag(sigma_w[j, i])*mu_f[:, j]*mu_f[:, j] \
+                             + np.diag(sigma_f[j])*np.diag(sigma_w[j, i])) \
+                            / (jitt2[i] + yerr2[i]))
+    return logl - 0.5*value
+
+
+def _covariances(rng, shape, N):
+    """ Random positive definite matrices """
+    A = rng.randn(*(shape + (N, N)))
+    return A @ np.swapaxes(A, -1, -2) / N + np.identity(N)
+
+
+def test_expectedLogLike_loops():
+    rng = np.random.RandomState(23011990)
+    N = 15
+    t = np.linspace(0, 10, N)
+    for q, p in [(1, 1), (2, 2), (1, 3), (2, 3), (3, 2)]:
+        y, yerr = rng.randn(p, N), 0.1 + rng.rand(p, N)
+        data = [array for pair in zip(y, yerr) for array in pair]
+        mean, jitter = [Constant(0)] * p, 0.1 + rng.rand(p)
+        mu_f, mu_w = rng.randn(1, q, N), rng.randn(p, q, N)
+        sigma_f = _covariances(rng, (q,), N)
+        sigma_w = _covariances(rng, (q, p), N)
+        expected = _loops(y, yerr**2, jitter, sigma_f, mu_f, sigma_w, mu_w)
+        for module in (simpleMeanField, completeMeanField,
+                       completeMeanField2):
+            GPRN = module.inference(q, t, *data)
+            logl = GPRN._expectedLogLike(None, None, mean, jitter, sigma_f,
+                                         mu_f, sigma_w, mu_w)
+            assert np.isclose(logl, expected, rtol=1e-10), (module, q, p)
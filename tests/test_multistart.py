@@ -0,0 +1,34 @@
+"""
+The starts of run_multistart() are independent of the warm start cache and
+leave the global random state alone
+"""
+import numpy as np
+
+from gprn.covFunction import SquaredExponential
+from gprn.meanFunction import Constant
+from gprn.utils import run_multistart
+from gprn import simpleMeanField
+
+
+def test_multistart_independent():
+    t = np.linspace(0, 10, 30)
+    y, yerr = np.sin(t), 0.1*np.ones(t.size)
+    GPRN = simpleMeanField.inference(1, t, y, yerr, warmStart=4)
+    nodes, weight = [SquaredExponential(1., 5.)], [SquaredExponential(1., 20.)]
+    np.random.seed(1)
+    state = np.random.get_state()[1].copy()
+    ELBO, _, _, trajectories = run_multistart(GPRN, nodes, weight,
+                                              [Constant(0)], [0.1], starts=3,
+                                              processes=1, seed=42)
+    assert np.array_equal(np.random.get_state()[1], state)
+    #every start begins from its own random initialization, none of them
+    #from the variational parameters of the previous start
+    first = [trajectory[0] for trajectory in trajectories]
+    assert len(set(first)) == 3
+    assert ELBO == max(trajectory[-1] for trajectory in trajectories)
+    #the starts of an inference without warm start are the same
+    GPRN = simpleMeanField.inference(1, t, y, yerr)
+    _, _, _, cold = run_multistart(GPRN, nodes, weight, [Constant(0)], [0.1],
+                                   starts=3, processes=1, seed=42)
+    for a, b in zip(cold, trajectories):
+        assert np.allclose(a, b)
@@ -0,0 +1,37 @@
+"""
+The variational updates of precision='single' are computed in float32, with
+an ELBO that only differs from the one of precision='double' by round-off
+"""
+import numpy as np
+
+from gprn.covFunction import QuasiPeriodic, SquaredExponential, WhiteNoise
+from gprn.meanFunction import Constant
+from gprn import simpleMeanField, completeMeanField, completeMeanField2
+
+
+def test_single_precision_ELBO():
+    rng = np.random.RandomState(0)
+    t = np.sort(rng.uniform(10, 100, 200))
+    y = 10*np.sin(2*np.pi*t/30) + rng.randn(t.size)
+    yerr = 0.1 + rng.rand(t.size)
+    nodes = [QuasiPeriodic(1, 50, 30, 1) + WhiteNoise(0.1)]
+    weight = [SquaredExponential(10, 100)]
+    means, jitter = [Constant(0)], [0.1]
+    for module in (simpleMeanField, completeMeanField, completeMeanField2):
+        D = t.size * 2
+        mu, var = rng.randn(D, 1), rng.rand(D, 1)
+        elbo = {}
+        for precision in ('double', 'single'):
+            GPRN = module.inference(1, t, y, yerr, precision=precision)
+            if module is simpleMeanField:
+                result = GPRN.ELBO(nodes, weight, means, jitter, mu, var,
+                                   None, None)
+            elif module is completeMeanField:
+                result = GPRN.ELBOaux(nodes, weight, means, jitter, mu, var,
+                                      None, None)
+            else:
+                result = GPRN.ELBOaux(nodes, weight, means, jitter, mu, var)
+            elbo[precision] = result[0]
+            factor = GPRN._spectralFactor(nodes[0])
+            assert factor.L.dtype == GPRN.dtype, module
+        assert np.isclose(elbo['single'], elbo['double'], rtol=1e-5), module
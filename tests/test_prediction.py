@@ -0,0 +1,67 @@
+"""
+Predictions at as many times as observations, where the matrix of lags to
+the observations is square, should not differ from those at more times
+"""
+import numpy as np
+
+from gprn.covFunction import Matern32, WhiteNoise, SquaredExponential
+from gprn.meanFunction import Constant
+from gprn import simpleMeanField, completeMeanField, completeMeanField2
+from gprn import sparseMeanField
+
+
+def _data(N=30):
+    t = np.linspace(0, 20, N)
+    y = np.sin(t) + 0.1*np.random.RandomState(1).randn(N)
+    return t, y, 0.1*np.ones(N)
+
+def _times(t):
+    """ The N observation times, then the same with one more time """
+    return t, np.append(t, t[-1] + 1)
+
+
+def test_simpleMeanField_square_prediction():
+    t, y, yerr = _data()
+    GPRN = simpleMeanField.inference(1, t, y, yerr)
+    nodes = [Matern32(1., 2.) + WhiteNoise(0.5)]
+    weight = [SquaredExponential(1., 5.)]
+    means, jitter = [Constant(0)], [0.1]
+    np.random.seed(23011990)
+    _, mu, _ = GPRN.optVarParams(nodes, weight, means, jitter, iterations=5)
+    square, longer = _times(t)
+    ystar = GPRN.Prediction(nodes, weight, means, jitter, square, mu)
+    ystar2 = GPRN.Prediction(nodes, weight, means, jitter, longer, mu)
+    assert np.allclose(ystar, ystar2[:, :t.size])
+
+
+def test_completeMeanField_square_prediction():
+    t, y, yerr = _data()
+    nodes = [Matern32(1., 2.) + WhiteNoise(0.5)]
+    weight = [SquaredExponential(1., 5.)]
+    means, jitter = [Constant(0)], [0.1]
+    for module in (completeMeanField, completeMeanField2):
+        GPRN = module.inference(1, t, y, yerr)
+        _, mu, _ = GPRN.ELBOcalc(nodes, weight, means, jitter, iterations=5)
+        square, longer = _times(t)
+        ystar = GPRN.Prediction(nodes, weight, means, square, mu)
+        ystar2 = GPRN.Prediction(nodes, weight, means, longer, mu)
+        assert np.allclose(ystar, ystar2[:, :t.size])
+
+
+def test_sparseMeanField_square_inducing():
+    t, y, yerr = _data()
+    nodes = [Matern32(1., 2.) + WhiteNoise(0.5)]
+    weight = [SquaredExponential(1., 5.)]
+    means, jitter = [Constant(0)], [0.1]
+    #as many inducing points as observations, and one less
+    GPRN = sparseMeanField.inference(1, t, y, yerr)
+    GPRN2 = sparseMeanField.inference(1, t, y, yerr, inducing=t.size - 1)
+    for G in (GPRN, GPRN2):
+        Kzx = G._kernelMatrix(WhiteNoise(0.5), G.inducing, G.time)
+        assert np.all(Kzx == 0)
+    np.random.seed(23011990)
+    _, mu, _ = GPRN.optVarParams(nodes, weight, means, jitter, iterations=5)
+    square, longer = _times(GPRN.inducing)
+    ystar = GPRN.Prediction(nodes, weight, means, jitter, square, mu)
+    ystar2 = GPRN.Prediction(nodes, weight, means, jitter, longer, mu)
+    assert np.allclose(ystar, ystar2[:, :t.size])
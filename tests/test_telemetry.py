@@ -0,0 +1,40 @@
+"""
+The factorizations of the kernel matrices are recorded in the telemetry of
+the engines
+"""
+import numpy as np
+import pytest
+from scipy.linalg import LinAlgError
+
+from gprn.covFunction import SquaredExponential
+from gprn.meanFunction import Constant
+from gprn.linearAlgebra import CholeskyTelemetry, cholNugget
+from gprn import simpleMeanField
+
+
+def test_cholNugget_counts():
+    telemetry = CholeskyTelemetry()
+    cholNugget(np.identity(3), telemetry=telemetry)
+    #the first nugget, 1e-5 times the mean of the diagonal, is too small
+    cholNugget(np.diag([1., 1., -1e-5]), telemetry=telemetry)
+    with pytest.raises(LinAlgError):
+        cholNugget(-np.identity(3), maximum=2, telemetry=telemetry)
+    summary = telemetry.summary()
+    assert summary['calls'] == 3 and summary['failed'] == 1
+    assert summary['escalated'] == 2
+    #1 + 3 + 3 calls to potrf, the failed matrix is not in levels
+    assert summary['attempts'] == 7
+    assert summary['levels'] == {0: 1, 2: 1}
+
+
+def test_spectral_telemetry():
+    t = np.linspace(0, 10, 50)
+    y, yerr = np.sin(t), 0.1*np.ones(t.size)
+    GPRN = simpleMeanField.inference(1, t, y, yerr, backend='dense')
+    nodes, weight = [SquaredExponential(1., 5.)], [SquaredExponential(1., 20.)]
+    GPRN.optVarParams(nodes, weight, [Constant(0)], [0.1], iterations=3)
+    summary = GPRN.telemetry.summary()
+    #one eigendecomposition per kernel, with the 1e-6 jitter as smallest
+    #eigenvalue of these nearly singular matrices
+    assert summary['spectral'] == 2
+    assert 0 < summary['minEigenvalue'] < 1e-5